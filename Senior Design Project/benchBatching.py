@@ -0,0 +1,59 @@
+# Imports
+import argparse
+import statistics
+import time
+import numpy as np
+from inferenceWorker import InferencePool, frameShape
+from modelLoader import resolveRuntime
+
+# Paths
+model_path = 'rheed_model.pth'
+
+# Submit a burst as fast as the slots allow, the way a reprocessing job or rotation scan would
+def runBurst(pool, frame, count):
+    start = time.perf_counter()
+    futures = [pool.submit(frame) for _ in range(count)]
+    predictions = [future.result() for future in futures]
+    return time.perf_counter() - start, predictions
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Classification throughput across micro-batch sizes")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 2, 4, 8, 16, 32])
+    parser.add_argument('--frames', type = int, default = 256, help = "Frames per measured burst")
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--max-wait-ms', type = float, default = 2.0)
+    args = parser.parse_args()
+
+    modelPath, backend, threads = resolveRuntime(args.model)
+    if threads:
+        threads = max(1, threads // args.workers)
+    frame = np.random.default_rng(0).standard_normal(frameShape).astype(np.float32)
+    print(f"Model {modelPath} ({backend}), {args.workers} worker(s), {args.frames} frames per burst, max wait {args.max_wait_ms} ms")
+    print(f"{'max batch':>9} {'frames/s':>9} {'avg batch':>9} {'batch ms':>9} {'p50 ms':>8} {'p99 ms':>8}")
+
+    for maxBatch in args.batch_sizes:
+        pool = InferencePool(modelPath, workers = args.workers, threads = threads, backend = backend, maxBatch = maxBatch, maxWaitMs = args.max_wait_ms)
+        try:
+            pool.waitReady()
+            runBurst(pool, frame, 2 * maxBatch * args.workers) # Warm-up
+            seconds, predictions = runBurst(pool, frame, args.frames)
+        except RuntimeError as e:
+            print(f"{maxBatch:>9} failed: {e}")
+            continue
+        finally:
+            pool.close()
+
+        latencies = [prediction.latency * 1000 for prediction in predictions]
+        print(
+            f"{maxBatch:>9} {args.frames / seconds:>9.1f} {statistics.mean(p.batchSize for p in predictions):>9.2f}"
+            f" {statistics.median(p.seconds for p in predictions) * 1000:>9.1f}"
+            f" {percentile(latencies, 50):>8.1f} {percentile(latencies, 99):>8.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
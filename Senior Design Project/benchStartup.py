@@ -0,0 +1,88 @@
+# Imports
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Paths
+model_path = 'rheed_model.pth'
+sampleImages = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', '*', '*.JPG')
+
+# Runs in a fresh interpreter so every import is a cold one
+def child(modelPath, legacy, imagePath):
+    start = time.perf_counter()
+    if legacy:
+        # What the old script header pulled in before doing anything useful
+        import tensorflow
+        import keras
+        import torchvision
+    import machineLearning
+    from framePipeline import Frame
+    from modelLoader import loadModel, softmax
+    imported = time.perf_counter()
+
+    model = loadModel(modelPath)
+    loaded = time.perf_counter()
+
+    frame = Frame.load(imagePath).writeTensor()
+    probabilities = softmax(model(frame[None]))[0]
+    classified = time.perf_counter()
+
+    print(json.dumps({
+        'import': imported - start,
+        'load': loaded - imported,
+        'firstClassification': classified - loaded,
+        'class': int(probabilities.argmax()),
+    }))
+
+def runChild(modelPath, legacy, imagePath):
+    command = [sys.executable, os.path.abspath(__file__), '--child', modelPath, imagePath]
+    if legacy:
+        command.append('--legacy')
+
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+    total = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1:]
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['total'] = total
+    return timings, None
+
+def main():
+    parser = argparse.ArgumentParser(description = "Time-to-first-classification for each model artifact")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--image', default = None)
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--child', nargs = 2, metavar = ('MODEL', 'IMAGE'), help = argparse.SUPPRESS)
+    parser.add_argument('--legacy', action = 'store_true', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.legacy, args.child[1])
+        return
+
+    imagePath = args.image or sorted(glob.glob(sampleImages))[0]
+    base = os.path.splitext(args.model)[0]
+    variants = [('legacy header + .pth', args.model, True), ('.pth', args.model, False)]
+    variants += [(suffix, base + suffix, False) for suffix in ('.ts', '.onnx') if os.path.exists(base + suffix)]
+
+    print(f"{'variant':>22} {'import':>8} {'load':>8} {'first':>8} {'total':>8}  (seconds, best of {args.repeats})")
+    for name, modelPath, legacy in variants:
+        runs = []
+        for _ in range(args.repeats):
+            timings, error = runChild(modelPath, legacy, imagePath)
+            if error:
+                print(f"{name:>22} failed: {' '.join(error)}")
+                break
+            runs.append(timings)
+
+        if runs:
+            best = min(runs, key = lambda timings: timings['total'])
+            print(f"{name:>22} {best['import']:8.2f} {best['load']:8.2f} {best['firstClassification']:8.2f} {best['total']:8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Imports
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from imageWatcher import ImageWatcher
+
+# Same scan machineLearning.py used before the watcher existed
+def getRecent(folderPath):
+    files = os.listdir(folderPath)
+    if not files:
+        return None
+    return max([os.path.join(folderPath, f) for f in files], key = os.path.getmtime)
+
+def writeFrame(folderPath, index):
+    path = os.path.join(folderPath, f"frame{index:07d}.jpg")
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8' + os.urandom(2048) + b'\xff\xd9')
+    return path
+
+def fillFolder(folderPath, start, stop):
+    for index in range(start, stop):
+        writeFrame(folderPath, index)
+
+# Time from a frame being closed to getRecent() reporting it
+def benchGetRecent(folderPath, nextIndex, repeats):
+    samples = []
+    for i in range(repeats):
+        path = writeFrame(folderPath, nextIndex + i)
+        start = time.perf_counter()
+        found = getRecent(folderPath)
+        samples.append(time.perf_counter() - start)
+        assert found == path
+    return samples
+
+# Time from a frame being closed to the watcher handing it out (minus the settle window)
+def benchWatcher(watcher, folderPath, nextIndex, repeats):
+    samples = []
+    for i in range(repeats):
+        path = writeFrame(folderPath, nextIndex + i)
+        start = time.perf_counter()
+        found = watcher.wait(timeout = 5)
+        samples.append(time.perf_counter() - start - watcher.settleTime)
+        assert found and found[-1] == path
+    return samples
+
+def report(name, size, samples):
+    samples = sorted(samples)
+    p50 = statistics.median(samples) * 1000
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000
+    print(f"{name:>10} {size:>8} files   p50 {p50:8.3f} ms   p99 {p99:8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Frame pickup latency vs. capture folder size")
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [0, 1000, 10000, 50000])
+    parser.add_argument('--repeats', type = int, default = 20)
+    parser.add_argument('--settle', type = float, default = 0.02)
+    args = parser.parse_args()
+
+    folderPath = tempfile.mkdtemp(prefix = 'rheed_bench_')
+    try:
+        count = 0
+        for size in args.sizes:
+            fillFolder(folderPath, count, size)
+            count = max(count, size)
+
+            report('getRecent', count, benchGetRecent(folderPath, count, args.repeats))
+            count += args.repeats
+
+            for usePolling in (False, True):
+                try:
+                    watcher = ImageWatcher(folderPath, settleTime = args.settle, pollInterval = 0.005, usePolling = usePolling)
+                except OSError:
+                    continue
+                name = 'polling' if usePolling else 'inotify'
+                report(name, count, benchWatcher(watcher, folderPath, count, args.repeats))
+                watcher.close()
+                count += args.repeats
+            print()
+
+    finally:
+        shutil.rmtree(folderPath)
+
+if __name__ == "__main__":
+    main()
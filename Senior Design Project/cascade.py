@@ -0,0 +1,306 @@
+# Imports
+import argparse
+import concurrent.futures
+import json
+import os
+import statistics
+import time
+import numpy as np
+from framePipeline import cropTo, normalize
+from inferenceWorker import classifications
+from modelLoader import loadModel, resolveRuntime, softmax
+
+# Paths
+model_path = 'rheed_model.pth'
+
+# First stage of the cascade: a softmax regression over cheap pattern features, distilled from the
+# ResNet50. Frames it is unsure about are escalated to the full model
+angleBins = 8
+radiusBins = 8
+
+# Frequency grid of the 224x224 crop, computed once
+frequencyY, frequencyX = np.meshgrid(np.fft.fftshift(np.fft.fftfreq(cropTo)), np.fft.fftshift(np.fft.fftfreq(cropTo)), indexing = 'ij')
+angleIndex = (np.mod(np.arctan2(frequencyY, frequencyX), np.pi) / np.pi * angleBins).astype(np.int64).clip(0, angleBins - 1).ravel()
+radius = np.hypot(frequencyX, frequencyY)
+radiusIndex = (radius / 0.5 * radiusBins).astype(np.int64).clip(0, radiusBins - 1).ravel()
+featureNames = (
+    [f'angle_{i}' for i in range(angleBins)] + [f'radius_{i}' for i in range(radiusBins)]
+    + ['anisotropy', 'mean', 'std', 'p90', 'p99', 'bright']
+)
+
+# Streaky (mono) patterns put their spectral energy along one direction and vary across columns
+# far more than across rows; rings and spots (poly) spread it out
+def patternFeatures(cropped):
+    gray = cropped.mean(axis = 2, dtype = np.float32) / 255
+    spectrum = np.log1p(np.abs(np.fft.fftshift(np.fft.fft2(gray - gray.mean())))).ravel()
+    angular = np.bincount(angleIndex, weights = spectrum, minlength = angleBins)
+    radial = np.bincount(radiusIndex, weights = spectrum, minlength = radiusBins)
+    columns, rows = gray.mean(axis = 0), gray.mean(axis = 1)
+    anisotropy = np.log((columns.var() + 1e-6) / (rows.var() + 1e-6))
+    mean, std = gray.mean(), gray.std()
+    p90, p99 = np.percentile(gray, (90, 99))
+    bright = (gray > mean + 2 * std).mean()
+    return np.concatenate([
+        angular / max(angular.sum(), 1e-9), radial / max(radial.sum(), 1e-9),
+        [anisotropy, mean, std, p90, p99, bright],
+    ]).astype(np.float32)
+
+# Identifies the teacher, so a cascade distilled from an older model is not used with a newer one
+def teacherKey(modelPath):
+    stat = os.stat(modelPath)
+    return {'model': os.path.abspath(modelPath), 'modelSize': stat.st_size, 'modelMtime': stat.st_mtime}
+
+def cascadePath(modelPath):
+    return os.path.splitext(modelPath)[0] + '.cascade.json'
+
+# Deterministic three-way split by position in the sorted image list: every holdout-th image is held
+# out of training, and the held images alternate between threshold calibration and evaluation, so
+# the reported numbers never come from images the weights or the threshold were fitted on
+def splitOf(index, holdout):
+    if holdout <= 1:
+        return 'evaluation' # Images the stage has never seen
+    if index % holdout:
+        return 'train'
+    return 'calibration' if (index // holdout) % 2 == 0 else 'evaluation'
+
+class FirstStage:
+    def __init__(self, weights, bias, mean, std, threshold, teacher = None, holdout = None):
+        self.weights = np.asarray(weights, dtype = np.float32)
+        self.bias = np.asarray(bias, dtype = np.float32)
+        self.mean = np.asarray(mean, dtype = np.float32)
+        self.std = np.asarray(std, dtype = np.float32)
+        self.threshold = threshold
+        self.teacher = teacher
+        self.holdout = holdout # Split the stage was trained with, so report can evaluate on the same images
+        self.accepted = 0
+        self.escalated = 0
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(saved['weights'], saved['bias'], saved['mean'], saved['std'], saved['threshold'], saved.get('teacher'), saved.get('holdout'))
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                'features': featureNames, 'weights': self.weights.tolist(), 'bias': self.bias.tolist(),
+                'mean': self.mean.tolist(), 'std': self.std.tolist(), 'threshold': self.threshold, 'teacher': self.teacher,
+                'holdout': self.holdout,
+            }, f, indent = 2)
+        os.replace(path + '.tmp', path)
+
+    def matches(self, modelPath):
+        return self.teacher is None or not os.path.exists(modelPath) or self.teacher == teacherKey(modelPath)
+
+    def probabilities(self, features):
+        return softmax(((features - self.mean) / self.std) @ self.weights + self.bias)
+
+    # (class index, confidence, accepted) for one cropped 224x224 BGR frame
+    def predict(self, cropped):
+        probabilities = self.probabilities(patternFeatures(cropped)[None])[0]
+        preds = int(probabilities.argmax())
+        accepted = probabilities[preds] >= self.threshold
+        if accepted:
+            self.accepted += 1
+        else:
+            self.escalated += 1
+        return preds, float(probabilities[preds]), accepted
+
+    def describe(self):
+        total = self.accepted + self.escalated
+        rate = self.escalated / total if total else 0.0
+        return f"Cascade: {self.accepted} frames settled by the first stage, {self.escalated} escalated ({rate:.1%}), threshold {self.threshold:.3f}"
+
+# Softmax regression fitted to the teacher's probabilities (optionally blended with folder labels)
+def distill(features, targets, epochs = 2000, lr = 0.1, l2 = 1e-3):
+    mean = features.mean(axis = 0)
+    std = features.std(axis = 0) + 1e-6
+    x = (features - mean) / std
+    weights = np.zeros((x.shape[1], targets.shape[1]), dtype = np.float32)
+    bias = np.zeros(targets.shape[1], dtype = np.float32)
+    for _ in range(epochs):
+        gradient = (softmax(x @ weights + bias) - targets) / len(x)
+        weights -= lr * (x.T @ gradient + l2 * weights)
+        bias -= lr * gradient.sum(axis = 0)
+    return weights, bias, mean, std
+
+# Lowest threshold whose accepted frames still agree with the teacher at least `agreement` of the time
+def calibrateThreshold(confidence, agrees, agreement):
+    order = np.argsort(-confidence)
+    runningAgreement = np.cumsum(agrees[order]) / np.arange(1, len(order) + 1)
+    passing = np.flatnonzero(runningAgreement >= agreement)
+    if not len(passing):
+        return 1.01 # Nothing is safe to settle early, everything escalates
+    return float(confidence[order][passing[-1]])
+
+# Pattern features, teacher probabilities and folder labels for every image, plus the first few
+# evaluation crops for timing
+def collect(paths, teacher, batchSize, decodeWorkers, holdout, keepCrops):
+    from embeddingIndex import folderLabel
+    from reclassify import decoded
+
+    batchTensor = np.empty((batchSize, 3, cropTo, cropTo), dtype = np.float32)
+    batches = (paths[i:i + batchSize] for i in range(0, len(paths), batchSize))
+    kept, features, probabilities, labels = [], [], [], []
+    index = 0
+
+    with concurrent.futures.ProcessPoolExecutor(decodeWorkers) as decoders:
+        for crops in decoded(decoders, batches, 4):
+            readable = [(path, crop) for path, crop, _ in crops if crop is not None]
+            if not readable:
+                continue
+            for i, (path, crop) in enumerate(readable):
+                normalize(crop, batchTensor[i])
+                features.append(patternFeatures(crop))
+                label = folderLabel(path, classifications)
+                labels.append(classifications.index(label) if label else -1)
+                if splitOf(index, holdout) == 'evaluation' and len(kept) < keepCrops:
+                    kept.append((path, crop))
+                index += 1
+            probabilities.append(softmax(teacher(batchTensor[:len(readable)])))
+    return kept, np.stack(features), np.concatenate(probabilities), np.array(labels)
+
+# Teacher forward passes with a batch of one, as the station runs it
+def measureTeacher(teacher, crops):
+    latencies = []
+    single = np.empty((1, 3, cropTo, cropTo), dtype = np.float32)
+    for _, crop in crops:
+        normalize(crop, single[0])
+        start = time.perf_counter()
+        teacher(single)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def percentile(values, percent):
+    return float(np.percentile(values, percent)) if len(values) else 0.0
+
+# Escalation rate, agreement and accuracy of the cascade, plus per-frame latency against the ResNet50 alone
+def evaluate(stage, crops, features, teacherProbabilities, labels, teacherLatencies):
+    firstLatencies = []
+    for _, crop in crops[:max(len(teacherLatencies), 1)]:
+        start = time.perf_counter()
+        stage.probabilities(patternFeatures(crop)[None])
+        firstLatencies.append(time.perf_counter() - start)
+
+    probabilities = stage.probabilities(features)
+    firstPreds = probabilities.argmax(axis = 1)
+    accepted = probabilities.max(axis = 1) >= stage.threshold
+    teacherPreds = teacherProbabilities.argmax(axis = 1)
+    cascadePreds = np.where(accepted, firstPreds, teacherPreds)
+    labelled = labels >= 0
+
+    firstMs = 1000 * statistics.mean(firstLatencies)
+    teacherMs = 1000 * statistics.mean(teacherLatencies) if teacherLatencies else 0.0
+    escalation = float(1 - accepted.mean())
+    cascadeMs = firstMs + escalation * teacherMs
+
+    # Per-frame cascade latency: first stage always, plus a teacher pass for each escalated frame
+    sampled = np.array(firstLatencies[:len(teacherLatencies)]) + np.where(accepted[:len(teacherLatencies)], 0.0, teacherLatencies)
+    return {
+        'frames': len(features),
+        'threshold': stage.threshold,
+        'escalation_rate': escalation,
+        'first_stage_agreement': float((firstPreds[accepted] == teacherPreds[accepted]).mean()) if accepted.any() else None,
+        'cascade_agreement': float((cascadePreds == teacherPreds).mean()),
+        'teacher_accuracy': float((teacherPreds[labelled] == labels[labelled]).mean()) if labelled.any() else None,
+        'cascade_accuracy': float((cascadePreds[labelled] == labels[labelled]).mean()) if labelled.any() else None,
+        'latency_ms': {
+            'first_stage': firstMs,
+            'teacher': teacherMs,
+            'cascade_mean': cascadeMs,
+            'cascade_p50': 1000 * percentile(sampled, 50),
+            'cascade_p99': 1000 * percentile(sampled, 99),
+            'teacher_p50': 1000 * percentile(teacherLatencies, 50),
+            'teacher_p99': 1000 * percentile(teacherLatencies, 99),
+        },
+        'saving': 1 - cascadeMs / teacherMs if teacherMs else None,
+    }
+
+def printReport(report):
+    latency = report['latency_ms']
+    print(f"{report['frames']} evaluation frames, threshold {report['threshold']:.3f}")
+    print(f"  Escalated to ResNet50: {report['escalation_rate']:.1%}")
+    if report['first_stage_agreement'] is not None:
+        print(f"  First stage agrees with ResNet50 on {report['first_stage_agreement']:.2%} of the frames it settles")
+    print(f"  Cascade agrees with ResNet50 on {report['cascade_agreement']:.2%} of all frames")
+    if report['cascade_accuracy'] is not None:
+        print(f"  Accuracy on labelled frames: cascade {report['cascade_accuracy']:.2%}, ResNet50 {report['teacher_accuracy']:.2%}")
+    print(
+        f"  Per frame: first stage {latency['first_stage']:.2f} ms, ResNet50 {latency['teacher']:.1f} ms, "
+        f"cascade {latency['cascade_mean']:.1f} ms (p50 {latency['cascade_p50']:.1f}, p99 {latency['cascade_p99']:.1f})"
+    )
+    if report['saving'] is not None:
+        print(f"  End-to-end saving: {report['saving']:.1%}")
+
+def main():
+    from reclassify import listImages
+
+    parser = argparse.ArgumentParser(description = "Distil and evaluate the first stage of the classification cascade")
+    parser.add_argument('command', choices = ['train', 'report'])
+    parser.add_argument('inputs', nargs = '+', help = "Image files or folders (class folders give labels)")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--output', default = None, help = "Cascade file (default <model>.cascade.json)")
+    parser.add_argument('--agreement', type = float, default = 0.995, help = "train: agreement with the ResNet50 required of settled frames")
+    parser.add_argument('--label-weight', type = float, default = 0.0, help = "train: blend of folder labels into the teacher targets")
+    parser.add_argument('--holdout', type = int, default = 5, help = "train: every Nth image is kept out of training, alternately for calibration and the report")
+    parser.add_argument('--unseen', action = 'store_true', help = "report: the inputs were never used in training, evaluate all of them")
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--decode-workers', type = int, default = max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument('--latency-frames', type = int, default = 64)
+    parser.add_argument('--report', default = None, help = "Write the evaluation report as JSON")
+    args = parser.parse_args()
+
+    output = args.output or cascadePath(args.model)
+    paths = listImages(args.inputs)
+    if not paths:
+        raise SystemExit("No images found.")
+    if args.command == 'train':
+        if args.holdout < 4:
+            raise SystemExit("--holdout must be at least 4 to leave both calibration and evaluation images.")
+        holdout = args.holdout
+    else:
+        stage = FirstStage.load(output)
+        if not stage.matches(args.model):
+            print(f"WARNING: {output} was distilled from a different {args.model}, retrain it.\n")
+        if args.unseen:
+            holdout = 1
+        elif stage.holdout:
+            holdout = stage.holdout # Same inputs as train: only its evaluation images
+        else:
+            raise SystemExit(f"{output} does not record its training split, pass --unseen with images it was not trained on.")
+
+    runtimePath, backend, threads = resolveRuntime(args.model)
+    teacher = loadModel(runtimePath, threads or max(1, (os.cpu_count() or 1) - args.decode_workers), backend)
+    crops, features, teacherProbabilities, labels = collect(paths, teacher, args.batch_size, args.decode_workers, holdout, args.latency_frames)
+    split = np.array([splitOf(index, holdout) for index in range(len(features))])
+    train, calibration, evaluation = split == 'train', split == 'calibration', split == 'evaluation'
+    if not evaluation.any():
+        raise SystemExit("Too few images to leave any for evaluation.")
+
+    if args.command == 'train':
+        targets = teacherProbabilities[train].copy()
+        known = labels[train] >= 0
+        if args.label_weight and known.any():
+            onehot = np.eye(len(classifications), dtype = np.float32)[labels[train][known]]
+            targets[known] = (1 - args.label_weight) * targets[known] + args.label_weight * onehot
+        weights, bias, mean, std = distill(features[train], targets)
+        stage = FirstStage(weights, bias, mean, std, 1.0, teacherKey(args.model), holdout)
+
+        probabilities = stage.probabilities(features[calibration])
+        agrees = probabilities.argmax(axis = 1) == teacherProbabilities[calibration].argmax(axis = 1)
+        stage.threshold = calibrateThreshold(probabilities.max(axis = 1), agrees, args.agreement)
+        stage.save(output)
+        print(f"First stage saved to {output} ({int(train.sum())} training, {int(calibration.sum())} calibration frames)")
+
+    teacher(np.zeros((1, 3, cropTo, cropTo), dtype = np.float32)) # Warm-up so lazy initialization is not timed
+    latencies = measureTeacher(teacher, crops)
+    report = evaluate(stage, crops, features[evaluation], teacherProbabilities[evaluation], labels[evaluation], latencies)
+    report['split'] = {'holdout': holdout, 'train': int(train.sum()), 'calibration': int(calibration.sum()), 'evaluation': int(evaluation.sum())}
+    printReport(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# Imports
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import shutil
+import time
+import numpy as np
+from PIL import Image
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+# Paths
+data_dir = "/rheed_images/films/"
+shard_dir = "rheed_shards"
+
+# Stored images are the whole Resize(256) image, uint8 RGB CHW at the top-left of a fixed canvas (the largest
+# resized height and width in the set, at most longSide) with its real size in index.json, so a batch is
+# a single fancy index and augmentation still reaches the sides of 4:3 frames
+storeSize = 256
+longSide = 512 # Sides past this (beyond 2:1 frames) are center-cropped when packing
+cropSize = 224
+imageExtensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+# Same class order as datasets.ImageFolder: sorted folder names
+def listSamples(root):
+    classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+    samples = []
+    for label, name in enumerate(classes):
+        for folder, _, files in sorted(os.walk(os.path.join(root, name))):
+            samples.extend((os.path.join(folder, file), label) for file in sorted(files) if file.lower().endswith(imageExtensions))
+    return classes, samples
+
+# (height, width) after torchvision's Resize(size): shorter side to size, longer side truncated with int()
+def resizedSize(width, height, size = storeSize):
+    if width <= height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+# Only reads the header
+def imageSize(path, size = storeSize):
+    with Image.open(path) as image:
+        return resizedSize(*image.size, size)
+
+# Start of the limit-long window kept of a resized side, placed so that CenterCrop(cropSize) of the kept
+# window is CenterCrop(cropSize) of the whole side
+def keptStart(length, limit):
+    if length <= limit:
+        return 0
+    start = int(round((length - cropSize) / 2.0)) - int(round((limit - cropSize) / 2.0))
+    return min(max(start, 0), length - limit)
+
+# torchvision Resize(size) (bilinear) at the top-left of a zeroed canvas; returns the pixels and the stored (height, width)
+def loadImage(path, size = storeSize, canvas = (storeSize, storeSize)):
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+        height, width = resizedSize(*image.size, size)
+        resized = image.resize((width, height), Image.BILINEAR)
+    keptHeight, keptWidth = min(height, canvas[0]), min(width, canvas[1])
+    top, left = keptStart(height, canvas[0]), keptStart(width, canvas[1])
+    pixels = np.zeros((3,) + tuple(canvas), dtype = np.uint8)
+    pixels[:, :keptHeight, :keptWidth] = np.asarray(resized, dtype = np.uint8)[top:top + keptHeight, left:left + keptWidth].transpose(2, 0, 1)
+    return pixels, (keptHeight, keptWidth)
+
+# Shards are .npy files written through open_memmap into <output>.partial, which replaces output
+# only once its index.json is complete; an interrupted repack never leaves an index over other pixels
+def pack(root, output, shardSize = 1024, size = storeSize, workers = None, limit = longSide):
+    classes, samples = listSamples(root)
+    if not samples:
+        raise SystemExit(f"No images found under {root}")
+    final = output
+    output = final.rstrip(os.sep) + '.partial'
+    shutil.rmtree(output, ignore_errors = True) # Left by an earlier interrupted run
+    os.makedirs(output)
+
+    shards = []
+    sizes = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as decoders:
+        allPaths = [path for path, _ in samples]
+        resized = list(decoders.map(imageSize, allPaths, [size] * len(allPaths), chunksize = 64))
+        canvas = (min(max(height for height, _ in resized), limit), min(max(width for _, width in resized), limit))
+        for first in range(0, len(samples), shardSize):
+            batch = samples[first:first + shardSize]
+            name = f"shard-{len(shards):05d}.npy"
+            array = np.lib.format.open_memmap(os.path.join(output, name), mode = 'w+', dtype = np.uint8, shape = (len(batch), 3) + canvas)
+            paths = [path for path, _ in batch]
+            for i, (pixels, stored) in enumerate(decoders.map(loadImage, paths, [size] * len(paths), [canvas] * len(paths), chunksize = 16)):
+                array[i] = pixels
+                sizes.append(stored)
+            array.flush()
+            del array
+            shards.append({'file': name, 'count': len(batch)})
+            print(f"{first + len(batch)}/{len(samples)} images packed, {(first + len(batch)) / (time.perf_counter() - start):.1f} images/s")
+
+    index = {
+        'classes': classes,
+        'size': size,
+        'canvas': list(canvas),
+        'sizes': sizes,
+        'shards': shards,
+        'labels': [label for _, label in samples],
+        'paths': [os.path.relpath(path, root) for path, _ in samples],
+        'mtimes': [os.path.getmtime(path) for path, _ in samples],
+        'root': os.path.abspath(root),
+    }
+    with open(os.path.join(output, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    # Swap the folders; a crash in between leaves no output at all, never a mixed one
+    previous = final.rstrip(os.sep) + '.old'
+    shutil.rmtree(previous, ignore_errors = True)
+    if os.path.exists(final):
+        os.replace(final, previous)
+    os.replace(output, final)
+    shutil.rmtree(previous, ignore_errors = True)
+    return index
+
+# Packed shards are stale once an image was added, removed or touched after packing
+def stale(root, output):
+    try:
+        with open(os.path.join(output, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return True
+    return staleIndex(root, index)
+
+def staleIndex(root, index):
+    if 'canvas' not in index: # Packed as center squares by an older version
+        return True
+    _, samples = listSamples(root)
+    if [os.path.relpath(path, root) for path, _ in samples] != index['paths']:
+        return True
+    return any(os.path.getmtime(path) != mtime for (path, _), mtime in zip(samples, index['mtimes']))
+
+# Indexed with a list of sample numbers and returns a whole batch; the shards are only memory-mapped
+# on first use, so every DataLoader worker maps the same page-cache pages. transform (evalBatch,
+# BatchAugment) runs on the uint8 batch and its (height, width) sizes inside the worker. Opening compares the index against the
+# source images it was packed from, when they are reachable, and warns if they changed since
+class ShardDataset(Dataset):
+    def __init__(self, folder, transform = None, checkSource = True):
+        self.folder = folder
+        self.transform = transform
+        with open(os.path.join(folder, 'index.json')) as f:
+            index = json.load(f)
+        if 'canvas' not in index:
+            raise SystemExit(f"{folder} holds center-cropped squares from an older datasetShards.py, repack with: python datasetShards.py --data {index['root']} --output {folder} --force")
+        if checkSource and os.path.isdir(index['root']) and staleIndex(index['root'], index):
+            print(f"WARNING: {folder} is out of date with {index['root']}, repack with: python datasetShards.py --data {index['root']} --output {folder}")
+        self.classes = index['classes']
+        self.size = index['size']
+        self.canvas = tuple(index['canvas'])
+        self.sizes = torch.tensor(index['sizes'], dtype = torch.int64).view(-1, 2)
+        self.files = [shard['file'] for shard in index['shards']]
+        counts = [shard['count'] for shard in index['shards']]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.labels = torch.tensor(index['labels'], dtype = torch.int64)
+        self.paths = index['paths']
+        self.shards = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Open mmaps are never pickled into worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def __getitem__(self, indices):
+        if self.shards is None:
+            self.shards = [np.load(os.path.join(self.folder, name), mmap_mode = 'r') for name in self.files]
+        indices = np.atleast_1d(np.asarray(indices, dtype = np.int64))
+        batch = np.empty((len(indices), 3) + self.canvas, dtype = np.uint8)
+        shardOf = np.searchsorted(self.offsets, indices, side = 'right') - 1
+        for shard in np.unique(shardOf):
+            picked = shardOf == shard
+            batch[picked] = self.shards[shard][indices[picked] - self.offsets[shard]]
+        images = torch.from_numpy(batch)
+        return (self.transform(images, self.sizes[indices]) if self.transform else images), self.labels[indices]
+
+# Batches come straight from the dataset (batch_size = None), the sampler hands out index lists
+def shardLoader(dataset, batchSize, shuffle = False, repeats = 1, workers = 0, sampler = None, **options):
+    if sampler is None and shuffle:
+        sampler = RandomSampler(dataset, num_samples = repeats * len(dataset))
+    elif sampler is None:
+        sampler = SequentialSampler(dataset)
+    options.setdefault('persistent_workers', workers > 0)
+    return DataLoader(dataset, batch_size = None, sampler = BatchSampler(sampler, batchSize, drop_last = False), num_workers = workers, **options)
+
+def toFloat(batch):
+    return batch.float().div_(255)
+
+def normalizeBatch(batch):
+    return (batch - mean) / std
+
+# The eval transform on stored images: CenterCrop(224) of each real region, with torchvision's rounding
+def evalBatch(batch, sizes):
+    crops = torch.empty((len(batch), 3, cropSize, cropSize), dtype = torch.uint8)
+    for i, (height, width) in enumerate(sizes.tolist()):
+        top = int(round((height - cropSize) / 2.0))
+        left = int(round((width - cropSize) / 2.0))
+        crops[i] = batch[i, :, top:top + cropSize, left:left + cropSize]
+    return normalizeBatch(toFloat(crops))
+
+# train_transform (flips, RandomRotation(30), RandomResizedCrop(224)) as one affine resample per batch:
+# each output pixel is mapped through crop -> rotation -> flips back into the image, then onto the canvas
+class BatchAugment:
+    def __init__(self, degrees = 30, scale = (0.08, 1.0), ratio = (3 / 4, 4 / 3), size = cropSize, generator = None):
+        self.degrees = degrees
+        self.scale = scale
+        self.logRatio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.size = size
+        self.generator = generator
+
+    def uniform(self, count, low, high):
+        return torch.rand(count, generator = self.generator) * (high - low) + low
+
+    # sizes (count, 2) are the images' (height, width) at the top-left of a canvas (height, width);
+    # without them every image is a square filling the canvas
+    def theta(self, count, sizes = None, canvas = None):
+        if sizes is None:
+            sizes, canvas = torch.ones(count, 2), (1, 1)
+        height, width = sizes[:, 0].float(), sizes[:, 1].float()
+
+        # Area and aspect ratio are in pixels as RandomResizedCrop draws them, the extents in the image's [-1, 1] units
+        area = self.uniform(count, *self.scale)
+        aspect = torch.exp(self.uniform(count, *self.logRatio)) * height / width
+        cropWidth = torch.sqrt(area * aspect).clamp(max = 1.0) # Half-extent in [-1, 1] grid units
+        cropHeight = torch.sqrt(area / aspect).clamp(max = 1.0)
+        centerX = self.uniform(count, -1, 1) * (1 - cropWidth)
+        centerY = self.uniform(count, -1, 1) * (1 - cropHeight)
+
+        # Rotation in pixel space, seen in the image's [-1, 1] coordinates
+        angle = torch.deg2rad(self.uniform(count, -self.degrees, self.degrees))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rotation = ((cos, -sin * height / width), (sin * width / height, cos))
+        flips = (
+            torch.where(torch.rand(count, generator = self.generator) < 0.5, -1.0, 1.0),
+            torch.where(torch.rand(count, generator = self.generator) < 0.5, -1.0, 1.0),
+        )
+
+        # input = P F R (S out + c), P placing the image's [-1, 1] square at the top-left of the canvas
+        theta = torch.empty(count, 2, 3)
+        for row, (flip, (along, across), place) in enumerate(zip(flips, rotation, (width / canvas[1], height / canvas[0]))):
+            theta[:, row, 0] = place * flip * along * cropWidth
+            theta[:, row, 1] = place * flip * across * cropHeight
+            theta[:, row, 2] = place * flip * (along * centerX + across * centerY) + place - 1
+        return theta
+
+    def __call__(self, batch, sizes = None):
+        images = toFloat(batch)
+        theta = self.theta(len(images), sizes, images.shape[-2:])
+        grid = torch.nn.functional.affine_grid(theta, (len(images), 3, self.size, self.size), align_corners = False)
+        warped = torch.nn.functional.grid_sample(images, grid, mode = 'bilinear', padding_mode = 'zeros', align_corners = False)
+        return normalizeBatch(warped)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Pack an ImageFolder of RHEED frames into memory-mapped uint8 shards")
+    parser.add_argument('--data', default = data_dir)
+    parser.add_argument('--output', default = shard_dir)
+    parser.add_argument('--shard-size', type = int, default = 1024, help = "Images per .npy shard")
+    parser.add_argument('--workers', type = int, default = None, help = "Decode processes")
+    parser.add_argument('--long-side', type = int, default = longSide, help = "Canvas limit, longer resized sides are center-cropped to it")
+    parser.add_argument('--force', action = 'store_true', help = "Repack even if the shards are up to date")
+    args = parser.parse_args()
+
+    if not args.force and not stale(args.data, args.output):
+        print(f"{args.output} is up to date with {args.data}.")
+        return
+    index = pack(args.data, args.output, args.shard_size, workers = args.workers, limit = args.long_side)
+    print(f"Packed {len(index['labels'])} images of {index['classes']} into {len(index['shards'])} shard(s) in {args.output}.")
+
+if __name__ == "__main__":
+    main()
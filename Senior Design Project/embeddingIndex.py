@@ -0,0 +1,261 @@
+# Imports
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Paths
+model_path = 'rheed_model.pth'
+defaultIndex = 'rheed_embeddings'
+
+# Below this many frames a full scan is already interactive; above it the coarse index pays off
+coarseThreshold = 100000
+chunkRows = 8192 # Rows converted to float32 at a time (64 MB at 2048-d)
+
+def normalizeRows(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype = np.float32))
+    norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# Keeps the k best (score, row) per query across chunks
+def mergeTopK(bestScores, bestRows, scores, rows, k):
+    scores = np.concatenate([bestScores, scores], axis = 1)
+    rows = np.concatenate([bestRows, np.broadcast_to(rows, (len(scores), len(rows)))], axis = 1)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis = 1)
+        rows = np.take_along_axis(rows, keep, axis = 1)
+    return scores, rows
+
+# Spherical k-means on a sample, enough to split the archive into probe lists
+def trainCentroids(vectors, lists, iterations, seed):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace = False)].copy()
+    for _ in range(iterations):
+        assignment = (vectors @ centroids.T).argmax(axis = 1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength = lists) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace = False)] # Reseed empty lists
+        centroids = normalizeRows(sums)
+    return centroids
+
+# Unit-normalized float16 feature vectors in one memory-mapped file, metadata as JSON lines
+# A row only counts once its metadata line is written, so a crash mid-add never leaves a half row
+class EmbeddingIndex:
+    def __init__(self, directory, dim = 2048):
+        self.directory = directory
+        self.dim = dim
+        self.vectorPath = os.path.join(directory, 'vectors.f16')
+        self.metaPath = os.path.join(directory, 'rows.jsonl')
+        self.coarsePath = os.path.join(directory, 'ivf.npz')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+        self.meta = []
+        if os.path.exists(self.metaPath):
+            with open(self.metaPath) as f:
+                self.meta = [json.loads(line) for line in f if line.strip()]
+        self.count = len(self.meta)
+        self.capacity = 0
+        self.vectors = None
+        self.reserve(max(self.count, 4096))
+
+        self.centroids = None
+        self.assignments = None
+        if os.path.exists(self.coarsePath):
+            self.loadCoarse()
+
+    def __len__(self):
+        return self.count
+
+    # Grows the file by doubling; older maps stay valid for searches already running
+    def reserve(self, rows):
+        if rows <= self.capacity:
+            return
+        existing = os.path.getsize(self.vectorPath) // (self.dim * 2) if os.path.exists(self.vectorPath) else 0
+        capacity = max(rows, 2 * self.capacity, existing)
+        with open(self.vectorPath, 'ab') as f:
+            f.truncate(capacity * self.dim * 2)
+        self.vectors = np.memmap(self.vectorPath, dtype = np.float16, mode = 'r+', shape = (capacity, self.dim))
+        self.capacity = capacity
+
+    # vectors (N, dim) and one metadata dict per row, returns the first new row number
+    def add(self, vectors, metas):
+        vectors = normalizeRows(vectors).astype(np.float16)
+        with self.lock:
+            first = self.count
+            self.reserve(first + len(vectors))
+            self.vectors[first:first + len(vectors)] = vectors
+            self.vectors.flush()
+            with open(self.metaPath, 'a') as f:
+                for meta in metas:
+                    f.write(json.dumps(meta) + '\n')
+            self.meta.extend(metas)
+            if self.centroids is not None:
+                self.assignments = np.concatenate([self.assignments, self.assign(vectors.astype(np.float32))])
+            self.count = first + len(vectors)
+        return first
+
+    def assign(self, vectors):
+        return (vectors @ self.centroids.T).argmax(axis = 1).astype(np.int32)
+
+    # IVF coarse index: k-means centroids plus each row's list, rows added later are assigned on the fly
+    def buildCoarse(self, lists = None, sample = 50000, iterations = 10, seed = 0):
+        count = self.count
+        if not count:
+            raise ValueError(f"{self.directory} has no rows to cluster")
+        lists = lists or max(16, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        picked = np.sort(rng.choice(count, min(sample, count), replace = False))
+        centroids = trainCentroids(self.vectors[picked].astype(np.float32), min(lists, len(picked)), iterations, seed)
+
+        self.centroids = centroids
+        self.assignments = np.concatenate([
+            self.assign(self.vectors[start:min(start + chunkRows, count)].astype(np.float32))
+            for start in range(0, count, chunkRows)
+        ])
+        np.savez(self.coarsePath + '.tmp.npz', centroids = centroids, assignments = self.assignments)
+        os.replace(self.coarsePath + '.tmp.npz', self.coarsePath)
+
+    def loadCoarse(self):
+        with np.load(self.coarsePath) as saved:
+            self.centroids = saved['centroids']
+            assignments = saved['assignments'][:self.count]
+        tail = self.vectors[len(assignments):self.count].astype(np.float32)
+        self.assignments = np.concatenate([assignments, self.assign(tail)]) if len(tail) else assignments
+
+    # Rows whose list is among the nprobe closest centroids to any of the queries
+    def candidates(self, queries, nprobe):
+        scores = queries @ self.centroids.T
+        probes = np.unique(np.argpartition(-scores, min(nprobe, scores.shape[1]) - 1, axis = 1)[:, :nprobe])
+        return np.flatnonzero(np.isin(self.assignments[:self.count], probes))
+
+    # Top-k cosine neighbours for each query: [[(score, row, meta), ...], ...]
+    def search(self, queries, k = 5, nprobe = 8, exact = False):
+        queries = normalizeRows(queries)
+        count = self.count
+        vectors = self.vectors
+        useCoarse = not exact and self.centroids is not None and count >= coarseThreshold
+        rows = self.candidates(queries, nprobe) if useCoarse else None
+        total = len(rows) if useCoarse else count
+
+        bestScores = np.empty((len(queries), 0), dtype = np.float32)
+        bestRows = np.empty((len(queries), 0), dtype = np.int64)
+        for start in range(0, total, chunkRows):
+            stop = min(start + chunkRows, total)
+            chunk = rows[start:stop] if useCoarse else np.arange(start, stop)
+            block = vectors[chunk] if useCoarse else vectors[start:stop]
+            scores = queries @ block.astype(np.float32).T
+            bestScores, bestRows = mergeTopK(bestScores, bestRows, scores, chunk, k)
+
+        results = []
+        for scores, rows in zip(bestScores, bestRows):
+            order = np.argsort(-scores)
+            results.append([(float(scores[i]), int(rows[i]), self.meta[rows[i]]) for i in order])
+        return results
+
+# Label of an archived frame: its class folder (Data/Monocrystalline/...) when there is one
+def folderLabel(path, classNames):
+    parent = os.path.basename(os.path.dirname(path)).lower()
+    return parent if parent in classNames else None
+
+def describeNeighbour(score, meta):
+    label = meta.get('label') or f"predicted {meta.get('predicted')}"
+    source = f"run {meta['run']}" if meta.get('run') else meta.get('source', 'archive')
+    sample = f", sample {meta['sample']}" if meta.get('sample') else ''
+    return f"{score:.3f}  {label}  ({source}{sample})  {meta.get('path', '')}"
+
+# Archived frames are embedded with the same decode pool and batching as reclassify.py
+def addImages(index, paths, modelPath, batchSize, decodeWorkers):
+    from framePipeline import cropTo, normalize
+    from inferenceWorker import classifications
+    from modelLoader import loadModel, softmax
+    from reclassify import decoded
+
+    model = loadModel(modelPath, max(1, (os.cpu_count() or 1) - decodeWorkers))
+    if not getattr(model, 'embeds', False):
+        raise SystemExit(f"{modelPath} cannot return features, use the .pth or an ONNX export from exportModel.py")
+    batchTensor = np.empty((batchSize, 3, cropTo, cropTo), dtype = np.float32)
+    batches = (paths[i:i + batchSize] for i in range(0, len(paths), batchSize))
+    added = 0
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(decodeWorkers) as decoders:
+        for crops in decoded(decoders, batches, 4):
+            readable = [(path, crop) for path, crop, _ in crops if crop is not None]
+            if not readable:
+                continue
+            for i, (_, crop) in enumerate(readable):
+                normalize(crop, batchTensor[i])
+            logits, features = model.embed(batchTensor[:len(readable)])
+            probabilities = softmax(logits)
+            metas = [
+                {
+                    'path': path, 'label': folderLabel(path, classifications), 'predicted': classifications[int(p.argmax())],
+                    'confidence': float(p.max()), 'source': 'archive', 'ts': os.path.getmtime(path),
+                }
+                for (path, _), p in zip(readable, probabilities)
+            ]
+            index.add(features, metas)
+            added += len(metas)
+            print(f"{added}/{len(paths)} frames embedded, {added / (time.perf_counter() - start):.1f} frames/s")
+    return added
+
+def main():
+    from reclassify import listImages
+
+    parser = argparse.ArgumentParser(description = "Embedding index of past RHEED frames for nearest-neighbour lookup")
+    parser.add_argument('--index', default = defaultIndex)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    add = commands.add_parser('add', help = "Embed archived images (labels come from class folder names)")
+    add.add_argument('inputs', nargs = '+')
+    add.add_argument('--model', default = model_path)
+    add.add_argument('--batch-size', type = int, default = 32)
+    add.add_argument('--decode-workers', type = int, default = max(1, min(4, (os.cpu_count() or 2) // 2)))
+
+    build = commands.add_parser('build', help = "Train the IVF coarse index")
+    build.add_argument('--lists', type = int, default = None, help = "Default sqrt(rows)")
+
+    query = commands.add_parser('query', help = "Nearest stored frames to an image")
+    query.add_argument('image')
+    query.add_argument('--model', default = model_path)
+    query.add_argument('-k', type = int, default = 5)
+    query.add_argument('--nprobe', type = int, default = 8)
+    query.add_argument('--exact', action = 'store_true', help = "Scan every row even with a coarse index")
+
+    commands.add_parser('info')
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.index)
+    if args.command == 'add':
+        paths = listImages(args.inputs)
+        if not paths:
+            raise SystemExit("No images found.")
+        addImages(index, paths, args.model, args.batch_size, args.decode_workers)
+    elif args.command == 'build':
+        start = time.perf_counter()
+        index.buildCoarse(args.lists)
+        print(f"{len(index.centroids)} lists over {len(index)} rows in {time.perf_counter() - start:.1f} s")
+    elif args.command == 'query':
+        from framePipeline import Frame
+        from modelLoader import loadModel
+        model = loadModel(args.model)
+        if not getattr(model, 'embeds', False):
+            raise SystemExit(f"{args.model} cannot return features, use the .pth or an ONNX export from exportModel.py")
+        _, features = model.embed(Frame.load(args.image).writeTensor()[None])
+        start = time.perf_counter()
+        neighbours = index.search(features, args.k, args.nprobe, args.exact)[0]
+        print(f"{len(index)} rows searched in {(time.perf_counter() - start) * 1000:.1f} ms")
+        for score, _, meta in neighbours:
+            print(describeNeighbour(score, meta))
+    else:
+        coarse = f", IVF with {len(index.centroids)} lists" if index.centroids is not None else ''
+        print(f"{args.index}: {len(index)} rows of {index.dim}-d float16 ({os.path.getsize(index.vectorPath) / 1e6:.0f} MB file){coarse}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Imports
+import argparse
+import os
+import numpy as np
+from modelLoader import FeatureTap, buildModel, loadModel
+
+# Paths
+model_path = 'rheed_model.pth'
+
+# Frozen, inference-optimized TorchScript
+def exportTorchScript(model, example, outputPath):
+    import torch
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example)
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    frozen.save(outputPath)
+
+# ONNX graph with a dynamic batch dimension; the pooled features are a second output for the embedding index
+def exportOnnx(model, example, outputPath):
+    import torch
+
+    class WithFeatures(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+            self.tap = FeatureTap(model)
+
+        def forward(self, image):
+            return self.model(image), self.tap.features
+
+    torch.onnx.export(
+        WithFeatures(model), example, outputPath,
+        input_names = ['image'], output_names = ['logits', 'features'],
+        dynamic_axes = {'image': {0: 'batch'}, 'logits': {0: 'batch'}, 'features': {0: 'batch'}},
+        opset_version = 17,
+    )
+
+# Exported artifact must agree with the eager model before it is used
+def verify(outputPath, reference, example):
+    exported = loadModel(outputPath)
+    difference = np.abs(exported(example.numpy()) - reference).max()
+    print(f"{outputPath}: max logit difference {difference:.2e}")
+    return difference < 1e-3
+
+def main():
+    parser = argparse.ArgumentParser(description = "Export rheed_model.pth for fast startup")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--format', nargs = '+', choices = ['torchscript', 'onnx'], default = ['torchscript', 'onnx'])
+    args = parser.parse_args()
+
+    import torch
+    model = buildModel(args.model)
+    example = torch.randn(2, 3, 224, 224)
+    with torch.inference_mode():
+        reference = model(example).numpy()
+
+    base = os.path.splitext(args.model)[0]
+    exporters = {'torchscript': ('.ts', exportTorchScript), 'onnx': ('.onnx', exportOnnx)}
+    failed = False
+    for name in args.format:
+        suffix, exporter = exporters[name]
+        outputPath = base + suffix
+        exporter(model, example, outputPath)
+        if not verify(outputPath, reference, example):
+            print(f"{outputPath} does not match the trained model, removing it.")
+            os.remove(outputPath)
+            failed = True
+
+    if failed:
+        raise SystemExit(1)
+    print("Export complete.")
+
+if __name__ == "__main__":
+    main()
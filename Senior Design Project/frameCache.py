@@ -0,0 +1,80 @@
+# Imports
+import collections
+
+# Bits two perceptual hashes may differ by and still count as the same frame (out of 64)
+defaultDistance = 4
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+# LRU memo of classification results keyed by Frame.fingerprint()
+# Exact content matches are a dict lookup and count everywhere; near-duplicates (rewritten or retaken
+# frames) are found by scanning the perceptual hashes, which stays cheap at a few hundred entries.
+# RHEED patterns of different films can look alike at 64 bits, so a near match only counts inside
+# the scope it was stored under (the host uses the run and scan azimuth), never across runs, samples or azimuths
+class ResultCache:
+    def __init__(self, capacity = 256, maxDistance = defaultDistance):
+        self.capacity = capacity
+        self.maxDistance = maxDistance # None only accepts identical pixels
+        self.entries = collections.OrderedDict() # content hash -> (perceptual hash, result, scope)
+        self.hits = 0
+        self.nearHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, fingerprint, scope = None):
+        content, perceptual = fingerprint
+        entry = self.entries.get(content)
+        if entry is not None:
+            self.entries.move_to_end(content)
+            self.hits += 1
+            return entry[1]
+
+        if self.maxDistance is not None and scope is not None:
+            best, bestDistance = None, self.maxDistance + 1
+            for key, (other, _, otherScope) in self.entries.items():
+                if otherScope != scope:
+                    continue
+                distance = hammingDistance(perceptual, other)
+                if distance < bestDistance:
+                    best, bestDistance = key, distance
+            if best is not None:
+                self.entries.move_to_end(best)
+                self.nearHits += 1
+                return self.entries[best][1]
+
+        self.misses += 1
+        return None
+
+    def put(self, fingerprint, result, scope = None):
+        content, perceptual = fingerprint
+        self.entries[content] = (perceptual, result, scope)
+        self.entries.move_to_end(content)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.nearHits + self.misses
+        return {
+            'entries': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'near_hits': self.nearHits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.nearHits) / lookups if lookups else 0.0,
+        }
+
+    def describe(self):
+        stats = self.stats()
+        return (
+            f"Result cache: {stats['entries']}/{stats['capacity']} entries, {stats['hits']} exact and {stats['near_hits']} near hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['evictions']} evictions"
+        )
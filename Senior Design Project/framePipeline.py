@@ -0,0 +1,122 @@
+# Imports
+import cv2
+import functools
+import hashlib
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Same geometry and normalization as the torchvision transforms used in training
+resizeTo = 256
+cropTo = 224
+mean = np.array([0.485, 0.456, 0.406], dtype = np.float32)
+std = np.array([0.229, 0.224, 0.225], dtype = np.float32)
+
+# (pixel / 255 - mean) / std folded into one multiply-subtract per channel, in BGR order
+scale = (1 / (255 * std))[::-1].reshape(3, 1, 1).copy()
+offset = (mean / std)[::-1].reshape(3, 1, 1).copy()
+
+# Pillow's antialiased bilinear resize, which torchvision's Resize runs on PIL images: triangle filter
+# widened by the downscale factor, 22-bit fixed-point weights, horizontal pass rounded to uint8 first
+precisionBits = 22
+
+# First source pixel and fixed-point weights of a fixed-width window for outputs first .. first + count - 1
+# of an inSize -> outSize resize, so only the pixels CenterCrop keeps are ever computed
+@functools.lru_cache(maxsize = 16)
+def resampleTaps(inSize, outSize, first, count):
+    scale = inSize / outSize
+    filterScale = max(scale, 1.0)
+    support = filterScale # Bilinear support is 1 input pixel at scale 1
+    taps = min(int(math.ceil(support)) * 2 + 1, inSize)
+    starts = np.zeros(count, dtype = np.intp)
+    weights = np.zeros((count, taps), dtype = np.int32)
+    for row in range(count):
+        center = (first + row + 0.5) * scale
+        low = max(int(center - support + 0.5), 0)
+        high = min(int(center + support + 0.5), inSize)
+        kernel = np.maximum(0.0, 1.0 - np.abs((np.arange(low, high) - center + 0.5) * (1.0 / filterScale)))
+        total = kernel.sum()
+        if total:
+            kernel /= total
+        starts[row] = min(low, inSize - taps) # Window shifted left at the right edge, padded with zero weights
+        offset = low - starts[row]
+        weights[row, offset:offset + high - low] = np.floor(0.5 + kernel * (1 << precisionBits))
+    return starts, weights
+
+# One pass along axis 0 (rows) or 1 (columns) of an HxWx3 uint8 image
+def applyTaps(pixels, starts, weights, axis):
+    if axis == 0: # Whole rows per tap, one multiply-add each
+        rows = pixels.reshape(len(pixels), -1)
+        total = np.full((len(starts), rows.shape[1]), 1 << (precisionBits - 1), dtype = np.int32)
+        for tap in range(weights.shape[1]):
+            total += rows[starts + tap] * weights[:, tap, None]
+        total = total.reshape((len(starts),) + pixels.shape[1:])
+    else: # Each output's columns as a strided window, dotted with its weights
+        windows = sliding_window_view(pixels, weights.shape[1], axis = 1)[:, starts]
+        total = (windows.astype(np.int32) @ weights[:, :, None])[..., 0] + (1 << (precisionBits - 1))
+    return np.clip(total >> precisionBits, 0, 255).astype(np.uint8)
+
+# A captured frame decoded exactly once, shared by the display and the classifier
+class Frame:
+    def __init__(self, path, pixels):
+        self.path = path
+        self.pixels = pixels # HxWx3 uint8, BGR as OpenCV decodes it
+        self.hashes = None
+
+    @classmethod
+    def load(cls, path):
+        pixels = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION) # As stored, like PIL and torchvision
+        if pixels is None:
+            raise ValueError(f"Could not decode {path}")
+        return cls(path, pixels)
+
+    # cv2.imshow takes the decoded buffer as-is
+    def preview(self):
+        return self.pixels
+
+    # (content hash, perceptual hash): the first only matches identical pixels,
+    # the second is a 64-bit difference hash that survives noise and small shifts
+    def fingerprint(self):
+        if self.hashes is None:
+            pixels = np.ascontiguousarray(self.pixels)
+            digest = hashlib.blake2b(pixels, digest_size = 16)
+            digest.update(str(pixels.shape).encode())
+
+            gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(gray, (9, 8), interpolation = cv2.INTER_AREA)
+            bits = np.packbits(small[:, 1:] > small[:, :-1])
+            self.hashes = (digest.hexdigest(), int.from_bytes(bits.tobytes(), 'big'))
+        return self.hashes
+
+    # Resize(256) + CenterCrop(224) with torchvision's geometry and Pillow's arithmetic, so the model
+    # sees the pixels it was trained on; only the 224x224 kept region is resampled
+    def cropped(self):
+        height, width = self.pixels.shape[:2]
+        if width <= height:
+            outWidth, outHeight = resizeTo, int(resizeTo * height / width)
+        else:
+            outWidth, outHeight = int(resizeTo * width / height), resizeTo
+        top = int(round((outHeight - cropTo) / 2.0))
+        left = int(round((outWidth - cropTo) / 2.0))
+        rowStarts, rowWeights = resampleTaps(height, outHeight, top, cropTo)
+        columnStarts, columnWeights = resampleTaps(width, outWidth, left, cropTo)
+
+        # Horizontal pass only over the source rows the vertical pass reads
+        low, high = int(rowStarts[0]), int(rowStarts[-1]) + rowWeights.shape[1]
+        band = applyTaps(self.pixels[low:high], columnStarts, columnWeights, 1)
+        return applyTaps(band, rowStarts - low, rowWeights, 0)
+
+    # Normalized (3, 224, 224) float32 RGB tensor, written straight into out when given
+    def writeTensor(self, out = None):
+        return normalize(self.cropped(), out)
+
+# Cropped 224x224 BGR uint8 -> normalized (3, 224, 224) RGB float32, so crops can be made elsewhere
+def normalize(cropped, out = None):
+    if out is None:
+        out = np.empty((3, cropTo, cropTo), dtype = np.float32)
+
+    # HWC BGR view -> CHW, then flip channels to RGB while normalizing
+    chw = cropped.transpose(2, 0, 1)
+    np.multiply(chw, scale, out = out[::-1])
+    np.subtract(out[::-1], offset, out = out[::-1])
+    return out
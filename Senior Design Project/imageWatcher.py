@@ -0,0 +1,261 @@
+# Imports
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify flags (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+eventHeader = struct.Struct('iIII') # wd, mask, cookie, len
+
+# Only these files are treated as captured frames
+imageExtensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# Thin ctypes wrapper around the Linux inotify API (no extra packages needed on the lab PC)
+class Inotify:
+    def __init__(self, folderPath, mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(folderPath), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"Cannot watch {folderPath}")
+
+    def fileno(self):
+        return self.fd
+
+    # Drain every queued event without blocking, returns (mask, name) pairs
+    def read(self):
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = eventHeader.unpack_from(buffer, offset)
+                offset += eventHeader.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# Watches the capture folder and keeps an incremental index of the newest frame
+class ImageWatcher:
+    def __init__(self, folderPath, settleTime = 0.2, pollInterval = 0.5, rescanInterval = 5.0, usePolling = None):
+        self.folderPath = folderPath
+        self.settleTime = settleTime # A file must stay unchanged this long before it counts
+        self.pollInterval = pollInterval
+        self.rescanInterval = rescanInterval # Safety net for mounts with coarse directory mtimes
+        self.known = {} # name -> mtime of every finished frame
+        self.pending = {} # name -> (size, mtime, firstSeen) of frames still being written
+        self.newestPath = None
+        self.newestTime = -1.0
+        self.dirStamp = None
+        self.lastRescan = 0.0
+        self.inotify = None
+
+        # inotify first, polling for network shares and other odd mounts
+        if usePolling is not True:
+            try:
+                self.inotify = Inotify(folderPath)
+            except (OSError, AttributeError, TypeError):
+                if usePolling is False:
+                    raise
+                self.inotify = None
+
+        self.rescan(seed = True)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    # Most recent finished frame, O(1)
+    def newest(self):
+        return self.newestPath
+
+    def isImage(self, name):
+        return name.lower().endswith(imageExtensions)
+
+    def updateNewest(self, name, mtime):
+        if mtime >= self.newestTime:
+            self.newestTime = mtime
+            self.newestPath = os.path.join(self.folderPath, name)
+
+    # Only walks the in-memory index, never touches the disk
+    def forget(self, name):
+        self.pending.pop(name, None)
+        if self.known.pop(name, None) is None:
+            return
+
+        if self.newestPath == os.path.join(self.folderPath, name):
+            self.newestPath = None
+            self.newestTime = -1.0
+            for other, mtime in self.known.items():
+                self.updateNewest(other, mtime)
+
+    def track(self, name, now):
+        if name in self.known or name in self.pending or not self.isImage(name):
+            return
+        try:
+            stat = os.stat(os.path.join(self.folderPath, name))
+        except FileNotFoundError:
+            return
+        self.pending[name] = (stat.st_size, stat.st_mtime, now)
+
+    # Full directory walk: once at startup, then only when something looks off
+    def rescan(self, seed = False):
+        now = time.monotonic()
+        self.lastRescan = now
+        try:
+            self.dirStamp = os.stat(self.folderPath).st_mtime_ns
+            names = set(os.listdir(self.folderPath))
+        except FileNotFoundError:
+            names = set()
+
+        for name in list(self.known):
+            if name not in names:
+                self.forget(name)
+
+        for name in names:
+            if seed and self.isImage(name):
+                # Frames already on disk at startup are complete
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.folderPath, name))
+                except FileNotFoundError:
+                    continue
+                self.known[name] = mtime
+                self.updateNewest(name, mtime)
+            else:
+                self.track(name, now)
+
+    # Polling fallback: one stat of the folder per pass, a listdir only when it changed
+    def poll(self):
+        now = time.monotonic()
+        try:
+            stamp = os.stat(self.folderPath).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        if stamp != self.dirStamp or now - self.lastRescan >= self.rescanInterval:
+            self.rescan()
+
+    def drainEvents(self):
+        now = time.monotonic()
+        for mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.rescan()
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.forget(name)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                # Re-check files that were written to again before settling
+                self.pending.pop(name, None)
+                self.track(name, now)
+
+    # Promote pending files whose size and mtime have stopped changing
+    def settle(self):
+        now = time.monotonic()
+        ready = []
+        for name, (size, mtime, firstSeen) in list(self.pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.folderPath, name))
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+
+            if stat.st_size != size or stat.st_mtime != mtime or stat.st_size == 0:
+                self.pending[name] = (stat.st_size, stat.st_mtime, now)
+            elif now - firstSeen >= self.settleTime:
+                del self.pending[name]
+                self.known[name] = mtime
+                self.updateNewest(name, mtime)
+                ready.append((mtime, os.path.join(self.folderPath, name)))
+
+        ready.sort()
+        return [path for _, path in ready]
+
+    # One non-blocking pass, returns newly finished frames oldest first
+    def step(self):
+        if self.inotify:
+            self.drainEvents()
+        else:
+            self.poll()
+        return self.settle() if self.pending else []
+
+    # How long it is safe to sleep before the next step
+    def nextDelay(self):
+        if self.pending:
+            now = time.monotonic()
+            remaining = min(firstSeen + self.settleTime - now for _, _, firstSeen in self.pending.values())
+            return max(remaining, 0.01)
+        if self.inotify:
+            return None
+        return self.pollInterval
+
+    # Blocking wait for new frames, returns [] on timeout
+    def wait(self, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ready = self.step()
+            if ready:
+                return ready
+
+            delay = self.nextDelay()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                delay = remaining if delay is None else min(delay, remaining)
+
+            if self.inotify:
+                select.select([self.inotify], [], [], delay)
+            else:
+                time.sleep(delay)
+
+    # Async stream of new frames for the pipeline
+    async def frames(self):
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        # The reader is level-triggered: drain the fd right here, or it stays readable (and this
+        # callback spins the loop) for as long as the consumer is suspended at yield
+        def onReadable():
+            self.drainEvents()
+            wake.set()
+
+        if self.inotify:
+            loop.add_reader(self.inotify.fileno(), onReadable)
+
+        try:
+            while True:
+                for path in self.step():
+                    yield path
+
+                try:
+                    await asyncio.wait_for(wake.wait(), self.nextDelay())
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+
+        finally:
+            if self.inotify:
+                loop.remove_reader(self.inotify.fileno())
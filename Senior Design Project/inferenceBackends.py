@@ -0,0 +1,189 @@
+# Imports
+import argparse
+import itertools
+import json
+import os
+import statistics
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from modelLoader import buildModel, reportPath, tapFeatures
+
+# Paths
+model_path = 'rheed_model.pth'
+
+# Every CPU variant the lab PC can run, fp32 is the reference
+backendNames = ['fp32', 'channels_last', 'bf16', 'int8_dynamic', 'int8_static']
+classifications = ['monocrystalline','polycrystalline']
+
+# Calibrated static INT8 graph saved next to the trained weights
+def staticInt8Path(modelPath):
+    return os.path.splitext(modelPath)[0] + '.int8_static.ts'
+
+# numpy in, numpy logits out, same interface as modelLoader.TorchModel
+class BackendModel:
+    def __init__(self, model, channelsLast = False, bfloat16 = False):
+        self.model = model
+        self.channelsLast = channelsLast
+        self.bfloat16 = bfloat16
+        self.tap = tapFeatures(model)
+        self.embeds = self.tap is not None
+
+    def forward(self, batch):
+        if self.channelsLast:
+            batch = batch.contiguous(memory_format = torch.channels_last)
+        with torch.inference_mode(), torch.autocast('cpu', dtype = torch.bfloat16, enabled = self.bfloat16):
+            return self.model(batch).float()
+
+    def __call__(self, batch):
+        return self.forward(torch.from_numpy(batch)).numpy()
+
+    def embed(self, batch):
+        logits = self(batch)
+        return logits, self.tap.features.float().numpy()
+
+# Post-training static quantization (FX graph mode) calibrated on real frames
+def quantizeStatic(model, calibrationBatches):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    example = (calibrationBatches[0],)
+    prepared = prepare_fx(model, get_default_qconfig_mapping('x86'), example)
+    with torch.inference_mode():
+        for batch in calibrationBatches:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+
+    # TorchScript is how quantized graphs get saved and reloaded
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(quantized, example))
+
+def buildBackend(modelPath, backend, threads = None, calibrationBatches = None):
+    if threads:
+        torch.set_num_threads(threads)
+
+    if backend == 'int8_static':
+        if calibrationBatches is not None:
+            return BackendModel(quantizeStatic(buildModel(modelPath), calibrationBatches))
+        if not os.path.exists(staticInt8Path(modelPath)):
+            raise FileNotFoundError(f"{staticInt8Path(modelPath)} missing, run inferenceBackends.py first")
+        return BackendModel(torch.jit.load(staticInt8Path(modelPath), map_location = 'cpu'))
+
+    model = buildModel(modelPath)
+    if backend == 'fp32':
+        return BackendModel(model)
+    if backend == 'channels_last':
+        return BackendModel(model.to(memory_format = torch.channels_last), channelsLast = True)
+    if backend == 'bf16':
+        return BackendModel(model.to(memory_format = torch.channels_last), channelsLast = True, bfloat16 = True)
+    if backend == 'int8_dynamic':
+        return BackendModel(torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype = torch.qint8))
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+# 1, 2, 4, ... and every core: the thread counts swept when --threads is not given
+def threadCounts():
+    cores = os.cpu_count() or 1
+    return [1 << power for power in range(cores.bit_length()) if 1 << power < cores] + [cores]
+
+# Accuracy (overall and per class) on the testML.py evaluation set
+def measure(model, test_loader):
+    confusion = np.zeros((2, 2), dtype = np.int64)
+    for inputs, labels in test_loader:
+        outputs = model.forward(inputs)
+        predicted = outputs.argmax(1)
+        for label, prediction in zip(labels.tolist(), predicted.tolist()):
+            confusion[label, prediction] += 1
+
+    perClass = 100 * confusion.diagonal() / np.maximum(confusion.sum(1), 1)
+    return {
+        'accuracy': float(100 * confusion.trace() / confusion.sum()),
+        'perClass': dict(zip(classifications, perClass.tolist())),
+    }
+
+# Median batch-of-one latency at each thread count, warmed up again after every switch
+def sweepThreads(model, frames, counts):
+    latencies = {}
+    for threads in counts:
+        torch.set_num_threads(threads)
+        model.forward(frames[0])
+        timings = []
+        for frame in frames:
+            start = time.perf_counter()
+            model.forward(frame)
+            timings.append(time.perf_counter() - start)
+        latencies[threads] = 1000 * statistics.median(timings)
+    return latencies
+
+# A variant is rejected if overall or any single class drops more than threshold points
+# Each variant's latency is swept over counts and its fastest thread count recorded with it
+def validate(modelPath, dataDir, threshold, counts, backends, latencyFrames = 32):
+    from testML import loadTestSet
+
+    torch.set_num_threads(max(counts))
+    # Gate on the live station's Frame preprocessing, not the training transform
+    _, test_loader = loadTestSet(dataDir, batch_size = 16, pipeline = 'frame')
+    calibrationBatches = [inputs for inputs, _ in itertools.islice(test_loader, 8)]
+    frames = list(torch.cat(calibrationBatches)[:latencyFrames].split(1))
+
+    results = {}
+    baseline = None
+    for backend in ['fp32'] + [name for name in backends if name != 'fp32']:
+        if backend != 'fp32' and baseline is None:
+            results[backend] = {'accepted': False, 'error': 'no fp32 reference to compare against'}
+            continue
+        try:
+            model = buildBackend(modelPath, backend, max(counts), calibrationBatches if backend == 'int8_static' else None)
+            model.forward(frames[0]) # Warm-up so lazy initialization is not timed
+            result = measure(model, test_loader)
+            latencies = sweepThreads(model, frames, counts)
+        except (RuntimeError, NotImplementedError, AssertionError) as e:
+            results[backend] = {'accepted': False, 'error': repr(e)}
+            print(f"{backend:>14}: unavailable ({e})")
+            continue
+        result['threads'] = min(latencies, key = latencies.get)
+        result['latencyMs'] = latencies[result['threads']]
+        result['threadLatencyMs'] = latencies
+
+        if baseline is None:
+            baseline = result
+        drops = [baseline['accuracy'] - result['accuracy']]
+        drops += [baseline['perClass'][name] - result['perClass'][name] for name in classifications]
+        result['accepted'] = max(drops) <= threshold
+        results[backend] = result
+
+        if backend == 'int8_static' and result['accepted']:
+            model.model.save(staticInt8Path(modelPath))
+
+        verdict = 'accepted' if result['accepted'] else f'REJECTED (drop {max(drops):.2f} pts)'
+        sweep = ', '.join(f"{threads}: {ms:.1f}" for threads, ms in latencies.items())
+        print(f"{backend:>14}: {result['accuracy']:6.2f}% accuracy, {result['latencyMs']:7.2f} ms/frame at {result['threads']} threads ({sweep}), {verdict}")
+
+    report = {'threshold': threshold, 'threadCounts': counts, 'variants': results}
+    accepted = {name: result for name, result in results.items() if result.get('accepted')}
+    if not accepted:
+        # Only happens when fp32 itself could not run, so there is no measured thread count either
+        print("No backend could be validated, the station falls back to fp32 with the default thread count")
+        return dict(report, selected = 'fp32', threads = None)
+    selected = min(accepted, key = lambda name: accepted[name]['latencyMs'])
+    return dict(report, selected = selected, threads = accepted[selected]['threads'])
+
+def main():
+    from testML import data_dir
+
+    parser = argparse.ArgumentParser(description = "Validate CPU inference backends against the evaluation set")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--data', default = data_dir)
+    parser.add_argument('--threshold', type = float, default = 1.0, help = "Largest allowed accuracy drop in percentage points")
+    parser.add_argument('--threads', type = int, nargs = '+', default = threadCounts(), help = "Thread counts to sweep")
+    parser.add_argument('--backends', nargs = '+', choices = backendNames, default = backendNames)
+    args = parser.parse_args()
+
+    report = validate(args.model, args.data, args.threshold, sorted(set(args.threads)), args.backends)
+    with open(reportPath(args.model), 'w') as f:
+        json.dump(report, f, indent = 2)
+    threads = report['threads'] or 'default'
+    print(f"Selected backend: {report['selected']} ({threads} threads)")
+
+if __name__ == "__main__":
+    main()
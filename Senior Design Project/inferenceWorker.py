@@ -0,0 +1,239 @@
+# Imports
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import threading
+import time
+import numpy as np
+from instrumentation import profileInference
+from modelLoader import loadModel, softmax
+
+# Preprocessed frame layout shared with the workers
+frameShape = (3, 224, 224)
+featureDim = 2048 # Pooled ResNet50 features returned when the pool is built with embeddings = True
+classifications = ['monocrystalline','polycrystalline']
+
+# What each future resolves to: seconds is the forward pass of the whole batch,
+# latency runs from submit() to the result being handed back, features is None unless embedding
+Prediction = collections.namedtuple('Prediction', ['classIndex', 'confidence', 'seconds', 'batchSize', 'latency', 'features'], defaults = (None,))
+
+# Collects up to maxBatch jobs, waiting at most maxWaitMs after the first one for the rest
+def nextBatch(requests, maxBatch, maxWaitMs):
+    job = requests.get()
+    if job is None:
+        return [], True
+    batch = [job]
+    deadline = time.perf_counter() + maxWaitMs / 1000
+    while len(batch) < maxBatch:
+        remaining = deadline - time.perf_counter()
+        try:
+            job = requests.get(timeout = remaining) if remaining > 0 else requests.get_nowait()
+        except queue.Empty:
+            break
+        if job is None:
+            return batch, True
+        batch.append(job)
+    return batch, False
+
+# Worker process: reads frames straight out of shared memory, only ids cross the queues
+def workerMain(index, modelPath, backend, shmName, featureName, slots, threads, maxBatch, maxWaitMs, requests, results):
+    block = shared_memory.SharedMemory(name = shmName)
+    frames = np.ndarray((slots,) + frameShape, dtype = np.float32, buffer = block.buf)
+    featureBlock = shared_memory.SharedMemory(name = featureName) if featureName else None
+    features = np.ndarray((slots, featureDim), dtype = np.float32, buffer = featureBlock.buf) if featureBlock else None
+
+    try:
+        model = loadModel(modelPath, threads, backend)
+    except Exception as e:
+        results.put((None, index, None, 0.0, repr(e)))
+        return
+    embedding = features is not None and getattr(model, 'embeds', False)
+    results.put((None, index, embedding, 0.0, None)) # Ready, and whether this backend can return features
+
+    stopping = False
+    while not stopping:
+        batch, stopping = nextBatch(requests, maxBatch, maxWaitMs)
+        if not batch:
+            break
+
+        batchSlots = [slot for _, slot in batch]
+        first = batchSlots[0]
+        if batchSlots == list(range(first, first + len(batch))):
+            inputs = frames[first:first + len(batch)] # Consecutive slots are a view, not a copy
+        else:
+            inputs = frames[batchSlots]
+
+        start = time.perf_counter()
+        try:
+            with profileInference(batch[0][0]):
+                if embedding:
+                    logits, features[batchSlots] = model.embed(inputs)
+                else:
+                    logits = model(inputs)
+                probabilities = softmax(logits)
+            preds = probabilities.argmax(axis = 1)
+            predictions = [(int(p), float(probabilities[i, p])) for i, p in enumerate(preds)]
+            results.put((batch, index, predictions, time.perf_counter() - start, None))
+        except Exception as e:
+            results.put((batch, index, None, time.perf_counter() - start, repr(e)))
+
+    del frames
+    block.close()
+    if featureBlock:
+        del features
+        featureBlock.close()
+
+# Pool of long-lived inference processes fed through shared-memory frame slots
+# With maxBatch > 1 each worker forms micro-batches from whatever is queued (bursts, reprocessing);
+# the live station keeps maxBatch = 1 so a single frame never waits for company
+class InferencePool:
+    def __init__(self, modelPath, workers = 1, slots = None, threads = None, backend = 'fp32', maxBatch = 1, maxWaitMs = 2.0, embeddings = False):
+        self.workers = workers
+        self.maxBatch = maxBatch
+        self.slots = slots or workers * (maxBatch + 1) # A batch in flight plus one frame being filled per worker
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+        frameBytes = int(np.prod(frameShape)) * np.dtype(np.float32).itemsize
+        self.block = shared_memory.SharedMemory(create = True, size = self.slots * frameBytes)
+        self.frames = np.ndarray((self.slots,) + frameShape, dtype = np.float32, buffer = self.block.buf)
+        self.embeddings = embeddings # Cleared if any worker's backend cannot tap the features
+        self.featureBlock = shared_memory.SharedMemory(create = True, size = self.slots * featureDim * 4) if embeddings else None
+        self.features = np.ndarray((self.slots, featureDim), dtype = np.float32, buffer = self.featureBlock.buf) if embeddings else None
+
+        self.freeSlots = queue.Queue()
+        for slot in range(self.slots):
+            self.freeSlots.put(slot)
+        self.asyncSlots = None
+
+        # Spawn so the workers never inherit the display, serial port or event loop
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(
+                target = workerMain, daemon = True,
+                args = (
+                    index, modelPath, backend, self.block.name, self.featureBlock.name if embeddings else None,
+                    self.slots, threads, maxBatch, maxWaitMs, self.requests, self.results,
+                ),
+            )
+            for index in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+        self.jobIds = itertools.count()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.readyCount = 0
+        self.ready = threading.Event()
+        self.failure = None
+        self.closed = False
+        self.collector = threading.Thread(target = self.collectResults, daemon = True)
+        self.collector.start()
+
+    def waitReady(self, timeout = None):
+        self.ready.wait(timeout)
+        if self.failure:
+            raise RuntimeError(f"Inference worker failed: {self.failure}")
+        return self.ready.is_set()
+
+    # Resolve futures as results come back, fail them all if a worker dies
+    def collectResults(self):
+        while not self.closed:
+            try:
+                batch, worker, predictions, seconds, error = self.results.get(timeout = 1)
+            except queue.Empty:
+                if not self.closed and any(not process.is_alive() for process in self.processes):
+                    self.fail("worker process exited")
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+
+            if batch is None:
+                if error:
+                    self.fail(error)
+                    return
+                if self.embeddings and not predictions:
+                    self.embeddings = False
+                    print("WARNING: This inference backend cannot return features, embeddings are off (export ONNX or use the .pth).\n")
+                self.readyCount += 1
+                if self.readyCount == self.workers:
+                    self.ready.set()
+                continue
+
+            finished = time.perf_counter()
+            for position, (jobId, slot) in enumerate(batch):
+                with self.lock:
+                    future, submitted = self.pending.pop(jobId, (None, 0.0))
+                features = self.features[slot].copy() if self.embeddings and not error else None
+                self.freeSlots.put(slot)
+                if future is None:
+                    continue
+                if error:
+                    future.set_exception(RuntimeError(error))
+                else:
+                    classIndex, confidence = predictions[position]
+                    future.set_result(Prediction(classIndex, confidence, seconds, len(batch), finished - submitted, features))
+
+    def fail(self, reason):
+        self.failure = reason
+        self.ready.set()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            future.set_exception(RuntimeError(f"Inference worker failed: {reason}"))
+
+    # Place a preprocessed (3, 224, 224) frame in a free slot, returns a Future of a Prediction
+    # frame is either an array to copy or a callable that writes the tensor into the slot itself
+    def submit(self, frame):
+        if self.failure:
+            raise RuntimeError(f"Inference worker failed: {self.failure}")
+
+        submitted = time.perf_counter()
+        slot = self.freeSlots.get()
+        if callable(frame):
+            frame(self.frames[slot])
+        else:
+            np.copyto(self.frames[slot], frame, casting = 'same_kind')
+        future = concurrent.futures.Future()
+        jobId = next(self.jobIds)
+        with self.lock:
+            self.pending[jobId] = (future, submitted)
+        self.requests.put((jobId, slot))
+        return future
+
+    # Event-loop friendly submit: waits for a slot and fills it without blocking the loop
+    async def classifyAsync(self, frame):
+        if self.asyncSlots is None:
+            self.asyncSlots = asyncio.Semaphore(self.slots)
+        async with self.asyncSlots:
+            loop = asyncio.get_running_loop()
+            future = await loop.run_in_executor(None, self.submit, frame)
+            return await asyncio.wrap_future(future)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join(timeout = 5)
+            if process.is_alive():
+                process.terminate()
+        self.collector.join(timeout = 2)
+
+        del self.frames
+        self.block.close()
+        self.block.unlink()
+        if self.featureBlock:
+            del self.features
+            self.featureBlock.close()
+            self.featureBlock.unlink()
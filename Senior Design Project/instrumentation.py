@@ -0,0 +1,196 @@
+# Imports
+import contextlib
+import json
+import math
+import os
+import signal
+import threading
+import time
+
+# Turned on with RHEED_TRACE=1, everything below is a no-op otherwise
+enabled = os.environ.get('RHEED_TRACE', '') not in ('', '0')
+traceDir = os.environ.get('RHEED_TRACE_DIR', '.')
+profileMode = os.environ.get('RHEED_PROFILE', '') # 'cprofile' (host) or 'torch' (inference worker)
+profileEvery = int(os.environ.get('RHEED_PROFILE_EVERY', '50'))
+collectStages = False # Set by the host when per-stage times are stored with each frame
+
+# Capture-cycle stages in the order they happen
+stages = [
+    'serial_received', 'frame_detected', 'decode', 'display', 'ready_sent',
+    'proceed_received', 'first_stage', 'preprocess', 'inference', 'cache_hit',
+]
+
+# HDR-style histogram: 16 linear sub-buckets per power of two of microseconds (~6% resolution)
+subBuckets = 16
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+
+    @staticmethod
+    def bucketOf(micros):
+        if micros < subBuckets:
+            return int(micros)
+        exponent = math.frexp(micros)[1] - 5 # micros / 2**exponent lands in [16, 32)
+        return (exponent + 1) * subBuckets + int(micros / (1 << exponent)) - subBuckets
+
+    @staticmethod
+    def upperBound(bucket):
+        if bucket < subBuckets:
+            return bucket + 1
+        octave, mantissa = divmod(bucket, subBuckets)
+        return (mantissa + subBuckets + 1) * (1 << (octave - 1))
+
+    def record(self, seconds):
+        micros = max(0.0, seconds * 1000000)
+        bucket = self.bucketOf(micros)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+
+    # Upper edge of the bucket holding the given percentile, in seconds
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        target = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.upperBound(bucket) / 1000000, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.minimum if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.maximum,
+        }
+
+histograms = {}
+lock = threading.RLock() # Reentrant so a SIGUSR1 dump can interrupt record()
+
+def record(name, seconds):
+    if not enabled:
+        return
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+# One capture cycle, each mark() records the time since the previous mark under that stage
+class Cycle:
+    def __init__(self, number, first, timestamp = None):
+        self.number = number
+        self.last = time.perf_counter() if timestamp is None else timestamp
+        self.started = self.last
+        self.stages = {} # {stage: seconds} for this cycle only
+        self.profiler = startProfile(number) if profileMode == 'cprofile' and number % profileEvery == 0 else None
+        record(first, 0.0)
+
+    def mark(self, stage, timestamp = None):
+        now = time.perf_counter() if timestamp is None else timestamp
+        record(stage, now - self.last)
+        self.stages[stage] = self.stages.get(stage, 0.0) + max(0.0, now - self.last)
+        self.last = max(self.last, now)
+
+    def end(self):
+        record('cycle_total', self.last - self.started)
+        if self.profiler:
+            stopProfile(self.profiler, self.number)
+            self.profiler = None
+
+# Stand-in when tracing is off, so call sites never need their own checks
+class NullCycle:
+    number = -1
+    stages = {}
+
+    def mark(self, stage, timestamp = None):
+        pass
+
+    def end(self):
+        pass
+
+nullCycle = NullCycle()
+cycleCount = 0
+
+def begin(first = 'serial_received', timestamp = None):
+    global cycleCount
+    if not enabled and not profileMode and not collectStages:
+        return nullCycle
+    cycleCount += 1
+    return Cycle(cycleCount, first, timestamp)
+
+def startProfile(number):
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stopProfile(profiler, number):
+    profiler.disable()
+    os.makedirs(traceDir, exist_ok = True)
+    profiler.dump_stats(os.path.join(traceDir, f"cycle_{number:06d}.prof"))
+
+# Wraps every Nth forward pass in the inference worker with torch.profiler
+@contextlib.contextmanager
+def profileInference(jobNumber):
+    if profileMode != 'torch' or jobNumber % profileEvery != 0:
+        yield
+        return
+
+    import torch.profiler
+    with torch.profiler.profile(activities = [torch.profiler.ProfilerActivity.CPU], record_shapes = True) as profiler:
+        yield
+    os.makedirs(traceDir, exist_ok = True)
+    profiler.export_chrome_trace(os.path.join(traceDir, f"inference_{os.getpid()}_{jobNumber:06d}.json"))
+
+def snapshot():
+    with lock:
+        return {name: histogram.summary() for name, histogram in histograms.items()}
+
+def toJson():
+    return json.dumps({'stages': stages, 'histograms': snapshot()}, indent = 2)
+
+# Prometheus text exposition format, one histogram per stage
+def toPrometheus():
+    lines = [
+        '# HELP rheed_stage_seconds Time spent in each capture-cycle stage.',
+        '# TYPE rheed_stage_seconds histogram',
+    ]
+    with lock:
+        for name, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bucket in sorted(histogram.counts):
+                cumulative += histogram.counts[bucket]
+                bound = histogram.upperBound(bucket) / 1000000
+                lines.append(f'rheed_stage_seconds_bucket{{stage="{name}",le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'rheed_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'rheed_stage_seconds_sum{{stage="{name}"}} {histogram.total:.9g}')
+            lines.append(f'rheed_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+def dump():
+    if not enabled:
+        return
+    os.makedirs(traceDir, exist_ok = True)
+    with open(os.path.join(traceDir, 'rheed_latency.json'), 'w') as f:
+        f.write(toJson())
+    with open(os.path.join(traceDir, 'rheed_latency.prom'), 'w') as f:
+        f.write(toPrometheus())
+
+# `kill -USR1 <pid>` writes both dumps without stopping the station
+def installDumpSignal():
+    if enabled and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
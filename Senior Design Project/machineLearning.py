@@ -1,46 +1,61 @@
 # Imports
 import asyncio
+from cascade import FirstStage, cascadePath
+from collections import deque, namedtuple
 import cv2
-import numpy as np
+from embeddingIndex import EmbeddingIndex, describeNeighbour
+from frameCache import ResultCache, defaultDistance
+from framePipeline import Frame
+from imageWatcher import ImageWatcher
+from inferenceWorker import InferencePool, classifications
+import instrumentation
+from modelLoader import resolveRuntime
+from rheedProtocol import (
+    MSG_BEAM_OFF, MSG_BEAM_ON, MSG_CRITICAL, MSG_HANG, MSG_HELLO, MSG_HELLO_ACK, MSG_INCORRECT,
+    MSG_PASSWORD, MSG_PASSWORD_REQUEST, MSG_PROCEED, MSG_PULSE, MSG_READY, MSG_REDO, MSG_SCAN_CONFIG,
+    MSG_SNAP, MSG_STOP, MSG_TELEMETRY, MSG_TELEMETRY_RATE, MSG_TIMEOUT, MSG_VERIFY, encodeU16, messageNames,
+)
 import os
-from PIL import Image
+from runStore import RunStore
 import serial
 import serial.tools.list_ports
-import tensorflow as tf
-from keras import layers, models
+from serialTransport import SerialLink
+from telemetry import TelemetryLog
 import time
-import torch
-from torchvision import datasets, transforms, models
-from torch.utils.data import DataLoader, Dataset
-import torch.nn as nn
-import torch.optim as optim
 
 # Paths
-recentImages = '/rheed_images'
+recentImages = os.environ.get('RHEED_IMAGES', '/rheed_images')
 model_path = 'rheed_model.pth'
+inferenceWorkers = 1 # Raise to classify back-to-back frames in parallel
 flatline = True
-doPrediction = None
 beamTimer = 0
 lastImage = None
+telemetryMs = int(os.environ.get('RHEED_TELEMETRY_MS', '250')) # Requested Pico telemetry period
+telemetryLog = TelemetryLog()
+scanAngles = int(os.environ.get('RHEED_SCAN_ANGLES', '1')) # Azimuths per run, more than 1 turns on scan mode
+snaps = deque() # Snap per camera trigger whose image has not landed yet, oldest first
+scan = [] # (classification task, deferred stores) for the azimuths of the scan in progress
+backgroundTasks = set() # The event loop only keeps weak references to tasks
+historyPath = os.environ.get('RHEED_HISTORY', 'rheed_history.db') # Empty turns the run history off
+sampleId = os.environ.get('RHEED_SAMPLE_ID') or None
+history = None
+runId = None # Run in progress, from BEAM_ON to BEAM_OFF
+runNumber = 0 # Counts BEAM_ONs, near-duplicate cache hits never cross it
+runOutcome = 'completed'
+lastState = None
+cacheSize = int(os.environ.get('RHEED_CACHE_SIZE', '256')) # 0 turns the result cache off
+cacheDistance = os.environ.get('RHEED_CACHE_DISTANCE', str(defaultDistance)) # 'exact' only reuses identical frames
+embeddingPath = os.environ.get('RHEED_EMBEDDINGS', '') # Index folder, set to look up similar past frames
+neighbourCount = int(os.environ.get('RHEED_NEIGHBOURS', '5'))
+embeddings = None
+cascadeFile = os.environ.get('RHEED_CASCADE', cascadePath(model_path)) # First-stage model from cascade.py, 'off' disables
+firstStage = None
+resultCache = ResultCache(cacheSize, None if cacheDistance == 'exact' else int(cacheDistance)) if cacheSize > 0 else None
 
-# Prepare for classification
-model = models.resnet50(pretrained = False)
-model.fc = nn.Linear(model.fc.in_features, 2)
-model.load_state_dict(torch.load(model_path))
-model.eval()
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model.to(device)
-
-# Transformation definitions
-transform = transforms.Compose([ 
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
-
-# Function to find the serial port
+# Function to find the serial port (RHEED_SERIAL_PORT overrides, e.g. for picoSimulator.py)
 def find_serial_port():
+    if os.environ.get('RHEED_SERIAL_PORT'):
+        return os.environ['RHEED_SERIAL_PORT']
     ports = serial.tools.list_ports.comports()
     for port in ports:
         if 'USB' in port.description:
@@ -48,191 +63,501 @@ def find_serial_port():
     return None
 
 # Connect to microcontroller
-def connectionTest():
+async def connectionTest():
     port = find_serial_port()
     global flatline
     
     if port:
+        link = None
         try:
             # Use 115200 baud rate to match the microcontroller's setting
-            ser = serial.Serial(port, 115200, timeout=1)
+            ser = serial.Serial(port, 115200, timeout=0)
             print(f"Connected to {port}\n")
-            ser.write(b'MARCO!')
+            link = SerialLink(ser)
+            link.start()
+            await link.send(MSG_HELLO, os.urandom(2)) # Session id, so the Pico tells a retransmitted HELLO from a reconnect
 
             # Listening for connection confirmation
             while True:
-                if ser.in_waiting > 0:
-                    piPico = ser.read().strip()
-                    if piPico == b'POLO!':
-                        flatline = False
-                        print("Successfully connected to Raspberry Pi Pico!\n")
-                        break
-
-            return ser
+                piPico, _, _ = await link.readMessage(timeout = 5)
+                if piPico == MSG_HELLO_ACK:
+                    flatline = False
+                    print("Successfully connected to Raspberry Pi Pico!\n")
+                    break
+
+            await link.send(MSG_TELEMETRY_RATE, encodeU16(telemetryMs))
+            await link.send(MSG_SCAN_CONFIG, bytes((max(1, min(255, scanAngles)),)))
+
+            return link
         
-        except serial.SerialException as e:
+        except (serial.SerialException, ConnectionError, asyncio.TimeoutError) as e:
             print("Failed to connect:\n", e)
+            if link:
+                link.close()
             return False
     else:
         print("No port found.\n")
         return False
 
 # Ensure the connection is always there
-async def heartbeat(ser, event):
+async def heartbeat(link, event):
     global flatline
     while not flatline:
         await event.wait()
         try:
             # Send heartbeat signal every 5 seconds
-            await ser.write(b'PULSE')       
+            await link.send(MSG_PULSE)
             await asyncio.sleep(5)
-            flatline = False
             
-        except serial.SerialException:
+        except ConnectionError:
             print("Lost connection. Microcontroller will end process soon.\n")
             flatline = True
             break
 
-# Handle incoming data without blocking
-async def incomingSignals(ser, event):
-    global flatline
-    global doPrediction
+# Ask the operator without stalling heartbeats
+async def askPassword(link, event, prompt):
+    loop = asyncio.get_running_loop()
+    attemptPassword = await loop.run_in_executor(None, input, prompt)
+    event.clear()
+    await link.send(MSG_PASSWORD, str(attemptPassword).encode())
+    await asyncio.sleep(1)
+    event.set()
+
+def beamTimeText():
+    return f"Beam Timer: {beamTimer // 60} minutes and {beamTimer % 60} seconds.\n"
+
+# Handlers for each Pico message, all take (link, event, decisions, payload, arrival)
+def onStop(link, event, decisions, payload, arrival):
+    global runOutcome
+    print("Ending current process.\n")
+    runOutcome = 'stopped'
+    resetScan()
+
+def onTelemetry(link, event, decisions, payload, arrival):
     global beamTimer
-    minutes = 0
-    seconds = 0
+    global lastState
+    sample = telemetryLog.add(payload, arrival)
+    beamTimer = sample['exposure_ms'] // 1000
+    if history and sample['state'] != lastState:
+        lastState = sample['state']
+        history.event(runId, 'state', lastState)
+
+def onBeamOn(link, event, decisions, payload, arrival):
+    global runId
+    global runNumber
+    global runOutcome
+    print("Beam was just unblanked.\n")
+    runNumber += 1
+    resetScan()
+    while not decisions.empty(): # Left over from a run that ended while a frame was on screen
+        decisions.get_nowait()
+    if history:
+        endRun('interrupted') # BEAM_OFF never arrived for the previous run
+        runId = history.beginRun(sampleId, max(1, scanAngles), exposureSeconds())
+        runOutcome = 'completed'
+    print(beamTimeText()) # In the event of consecutive runs
+
+def onBeamOff(link, event, decisions, payload, arrival):
+    print("Beam was just blanked.\n")
+    print(beamTimeText())
+    print(telemetryLog.describe(60)) # Exposure and FSM loop health over the last minute
+    endRun(runOutcome)
+    resetScan()
+
+def onVerify(link, event, decisions, payload, arrival):
+    print("Hold down the GREEN or RED button until the white LED turns off.\n")
+    print("GREEEN continues with classification and RED retakes the image.\n")
+
+def onProceed(link, event, decisions, payload, arrival):
+    print("Ready to classify.\n")
+    decisions.put_nowait((True, arrival))
+
+def onRedo(link, event, decisions, payload, arrival):
+    print("Retaking image.\n")
+    print(beamTimeText())
+    decisions.put_nowait((False, arrival))
+
+def onPasswordRequest(link, event, decisions, payload, arrival):
+    spawn(askPassword(link, event, "Please enter the correct password to unlock the microcontroller.\n"))
+
+def onIncorrect(link, event, decisions, payload, arrival):
+    spawn(askPassword(link, event, "The password you entered was incorrect. Please try again.\n"))
+
+def onCritical(link, event, decisions, payload, arrival):
+    global runOutcome
+    runOutcome = 'critical'
+    print("WARNING: Pi Pico suspects that the beam has been on too long. Locking finite state machine.\n")
+    print(beamTimeText())
+    resetScan()
+    decisions.put_nowait((False, arrival)) # Release a frame still waiting for GREEN/RED
+
+def onHang(link, event, decisions, payload, arrival):
+    global runOutcome
+    runOutcome = 'hang'
+    print("WARNING: The finite state machine entered an unreachable state. Ending current process.\n")
+    resetScan()
+    decisions.put_nowait((False, arrival))
+
+def onTimeout(link, event, decisions, payload, arrival):
+    global runOutcome
+    runOutcome = 'timeout'
+    print("WARNING: Pi Pico never heard that the image was displayed. Closing the shutter and blanking the beam.\n")
+    resetScan()
+    decisions.put_nowait((False, arrival)) # Release a frame still waiting for GREEN/RED
+
+# Camera trigger, remembered until its image lands so a late frame still gets its own azimuth
+Snap = namedtuple('Snap', ['index', 'count', 'capture', 'cycle'])
+
+def onSnap(link, event, decisions, payload, arrival):
+    cycle = instrumentation.begin('serial_received', arrival)
+    if len(payload) >= 3:
+        snaps.append(Snap(payload[0], payload[1], payload[2], cycle))
+        if payload[1] > 1:
+            print(f"Capturing azimuth {payload[0] + 1} of {payload[1]}.\n")
+    else:
+        snaps.append(Snap(0, 1, None, cycle))
+
+# Forget triggers and azimuth results of a scan that will not be verified (STOP, CRITICAL, BEAM_OFF, disconnect);
+# classifications already running finish on their own and are ignored
+def resetScan():
+    snaps.clear()
+    scan.clear()
+
+# Fire-and-forget task that is not garbage collected before it finishes
+def spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    backgroundTasks.add(task)
+    task.add_done_callback(backgroundTasks.discard)
+    return task
+
+handlers = {
+    MSG_STOP: onStop,
+    MSG_TELEMETRY: onTelemetry,
+    MSG_BEAM_ON: onBeamOn,
+    MSG_BEAM_OFF: onBeamOff,
+    MSG_VERIFY: onVerify,
+    MSG_PROCEED: onProceed,
+    MSG_REDO: onRedo,
+    MSG_PASSWORD_REQUEST: onPasswordRequest,
+    MSG_INCORRECT: onIncorrect,
+    MSG_CRITICAL: onCritical,
+    MSG_HANG: onHang,
+    MSG_SNAP: onSnap,
+    MSG_TIMEOUT: onTimeout,
+}
+
+# Handle incoming data without blocking, one table lookup per message
+async def incomingSignals(link, event, decisions):
+    global flatline
 
     while not flatline:
-        heartbeat.set()
-        tag = b'PWD:' # To properly detect password
-        if ser.any():
-            received = ser.readline().strip().decode()
-            
-            if received.startswith('STOP'):
-                print("Ending current process.\n")
+        try:
+            msgType, payload, arrival = await link.readMessage()
+        except ConnectionError:
+            flatline = True
+            break
 
-            elif received.isdigit():
-                beamTimer = int(received)
-                minutes = beamTimer // 60
-                seconds = beamTimer % 60
+        handler = handlers.get(msgType)
+        if handler:
+            handler(link, event, decisions, payload, arrival)
+        if history and msgType != MSG_TELEMETRY:
+            history.event(runId, messageNames.get(msgType, str(msgType)))
 
-            elif received.startswith('BEAM ON'):
-                print("Beam was just unblanked.\n")
-                print(f"Beam Timer: {minutes} minutes and {seconds} seconds.\n") # In the event of consecutive runs
+        # Time from the last byte arriving to the command being handled
+        recordReaction(messageNames.get(msgType, str(msgType)), time.perf_counter() - arrival)
 
-            elif received.startswith('BEAM OFF'):
-                print("Beam was just blanked.\n")
-                print(f"Beam Timer: {minutes} minutes and {seconds} seconds.\n")
-            
-            elif received.startswith('VERIFY'):
-                print("Hold down the GREEN or RED button until the white LED turns off.\n")
-                print("GREEEN continues with classification and RED retakes the image.\n")
+# Accumulated beam exposure as last reported by the Pico, in seconds
+def exposureSeconds():
+    latest = telemetryLog.latest
+    return latest['exposure_ms'] / 1000 if latest else None
 
-            elif received.startswith('PROCEED'):
-                print("Ready to classify.\n")
-                doPrediction = True
-            
-            elif received.startswith('REDO'):
-                print("Retaking image.\n")
-                print(f"Beam Timer: {minutes} minutes and {seconds} seconds.\n")
-                doPrediction = False
-
-            elif received.startswith('PASSWORD'):
-                attemptPassword = input("Please enter the correct password to unlock the microcontroller.\n")
-                tryPassword = tag + str(attemptPassword).encode()
-                event.clear()
-                await ser.write(tryPassword)
-                await asyncio.sleep(1)
-                event.set()
-
-            elif received.startswith('INCORRECT'):
-                attemptPassword = input("The password you entered was incorrect. Please try again.\n")
-                tryPassword = tag + attemptPassword
-                event.clear()
-                await ser.write(tryPassword)
-                await asyncio.sleep(1)
-                event.set()
-
-            elif received.startswith('CRITICAL'):
-                print("WARNING: Pi Pico suspects that the beam has been on too long. Locking finite state machine.\n")
-                print(f"Beam Timer: {minutes} minutes and {seconds} seconds\n")
-
-            elif received.startswith('HANG'):
-                print("WARNING: The finite state machine entered an unreachable state. Ending current process.\n")
-
-# Get the most recent image from folder
-def getRecent(folderPath):
-    files = os.listdir(folderPath)
-    if not files:
-        return None
-    
-    # Get the most recent by modification time
-    recentFile = max([os.path.join(folderPath, f) for f in files], key = os.path.getmtime)
-    return recentFile
-
-# Display image
-def displayImage(imagePath, ser, event):
-    picture = cv2.imread(imagePath)
-    cv2.imshow("Image Viewer", picture)
+def endRun(outcome):
+    global runId
+    if history and runId is not None:
+        history.endRun(runId, outcome, exposureSeconds())
+    runId = None
+
+# Command-to-reaction latency per message type (count, total, worst)
+reactionTimes = {}
+
+def recordReaction(command, elapsed):
+    count, total, worst = reactionTimes.get(command, (0, 0.0, 0.0))
+    reactionTimes[command] = (count + 1, total + elapsed, max(worst, elapsed))
+
+def printReactionTimes():
+    for command, (count, total, worst) in sorted(reactionTimes.items()):
+        print(f"{command}: {count} messages, avg {total / count * 1000:.3f} ms, max {worst * 1000:.3f} ms")
+
+# Display image (READY, echoing the capture number, is only sent for frames the operator has to verify)
+async def displayImage(frame, link, event, cycle, capture = None, sendReady = True):
+    cv2.imshow("Image Viewer", frame.preview())
     cv2.waitKey(1)
+    cycle.mark('display')
+    if not sendReady:
+        return
     event.clear()
-    time.sleep(1)
-    ser.write(b'READY')
+    await asyncio.sleep(1)
+    await link.send(MSG_READY, bytes((capture,)) if capture is not None else b'')
+    cycle.mark('ready_sent')
     event.set()
 
-# Classification function
-def classify():
-    global recentImages 
+# Decode plus fingerprint, both run off the event loop
+def loadFrame(path):
+    frame = Frame.load(path)
+    if resultCache is not None or history:
+        frame.fingerprint()
+    return frame
 
-    imagePath = getRecent(recentImages)
-    image = Image.open(imagePath)
-    image = transform(image)
-    image = image.unsqueeze(0)
-    image = image.to(device)
+# Classification function (the worker pool normalizes the already decoded frame into shared memory)
+# Identical frames, and near-identical ones from the same run and azimuth (rewrites, REDO retakes), reuse the cached
+# result instead, and frames the cheap first stage is confident about never reach the ResNet50.
+# Writes to the result cache, embedding index and run history only happen for verified frames: with deferred
+# (scan azimuths classified ahead of GREEN/RED) they are appended there for commitStores after PROCEED
+async def classify(frame, pool, cycle, report = True, azimuth = 0, deferred = None):
+    run = runId # The beam may be blanked before the result comes back
+    scope = (runNumber, azimuth) # Adjacent azimuths of a scan look alike at 64 bits but each needs its own inference
 
-    with torch.no_grad():
-        outputs = model(image)
-        _, preds = torch.max(outputs, 1)
-    
-    classifications = ['monocrystalline','polycrystalline']
-    print(f"Classified as: {classifications[preds]}")
+    def fill(out):
+        frame.writeTensor(out)
+        cycle.mark('preprocess')
+
+    cached = resultCache.get(frame.fingerprint(), scope) if resultCache is not None else None
+    early = None
+    if not cached and firstStage:
+        early = await asyncio.get_running_loop().run_in_executor(None, lambda: firstStage.predict(frame.cropped()))
+        cycle.mark('first_stage')
+
+    if cached:
+        preds, confidence, features = cached
+        cycle.mark('cache_hit')
+    elif early and early[2]:
+        preds, confidence, features = early[0], early[1], None
+    else:
+        try:
+            prediction = await pool.classifyAsync(fill)
+        except RuntimeError as e:
+            print(f"Classification failed: {e}\n")
+            cycle.end()
+            return None
+        cycle.mark('inference')
+        instrumentation.record('inference_compute', prediction.seconds)
+        preds, confidence, features = prediction.classIndex, prediction.confidence, prediction.features
+    cycle.end()
+
+    loop = asyncio.get_running_loop()
+    stores = []
+    if resultCache is not None and not cached:
+        result = (preds, confidence, features)
+        stores.append(lambda: resultCache.put(frame.fingerprint(), result, scope))
+
+    neighbours = []
+    if embeddings is not None and features is not None:
+        neighbours = await loop.run_in_executor(None, searchNeighbours, features)
+        if not cached: # A repeat of a stored frame is looked up but not stored again
+            meta = {
+                'path': frame.path, 'label': None, 'predicted': classifications[preds], 'confidence': confidence,
+                'run': run, 'sample': sampleId, 'azimuth': azimuth, 'ts': time.time(),
+            }
+            stores.append(lambda: loop.run_in_executor(None, embeddings.add, features, [meta]))
+
+    if history:
+        stages = dict(cycle.stages)
+        stores.append(lambda: history.frame(run, sampleId, frame.path, frame.fingerprint()[0], azimuth, preds, classifications[preds], confidence, stages))
+    if deferred is None:
+        await commitStores(stores)
+    else:
+        deferred.extend(stores)
+    if report:
+        source = ' [cached]' if cached else ' [first stage]' if early and early[2] else ''
+        print(f"Classified as: {classifications[preds]} ({confidence:.1%} confidence){source}")
+        printNeighbours(neighbours)
+    return preds, confidence, neighbours
+
+# Searched before the frame is added, so it never finds itself
+def searchNeighbours(features):
+    return embeddings.search(features, neighbourCount)[0]
+
+# Stores are plain calls, the embedding one hands back the executor future to wait for
+async def commitStores(stores):
+    for store in stores:
+        pending = store()
+        if pending is not None:
+            await pending
+
+def printNeighbours(neighbours, limit = None):
+    if neighbours:
+        print("Most similar past frames:")
+        for score, _, meta in neighbours[:limit]:
+            print(f"  {describeNeighbour(score, meta)}")
+
+# Confidence-weighted vote over the azimuths of one scan: (class, share of total confidence, azimuths agreeing)
+def scanVerdict(results):
+    scores = {}
+    for preds, confidence, _ in results:
+        scores[preds] = scores.get(preds, 0.0) + confidence
+    verdict = max(scores, key = scores.get)
+    agreeing = sum(1 for preds, _, _ in results if preds == verdict)
+    return verdict, scores[verdict] / sum(scores.values()), agreeing
+
+# Scan mode: each azimuth is classified while the next one is captured, the operator verifies the set
+async def scanFrame(frame, link, event, decisions, pool, cycle, snap):
+    last = snap.index + 1 >= snap.count
+    if snap.index == 0:
+        scan.clear() # A new scan never continues an earlier one
+    stores = []
+    scan.append((spawn(classify(frame, pool, cycle, report = False, azimuth = snap.index, deferred = stores)), stores))
+    await displayImage(frame, link, event, cycle, snap.capture, sendReady = last)
+    if not last:
+        return
+
+    azimuths = list(scan)
+    doPrediction, arrival = await decisions.get()
+    scan.clear()
+    if not doPrediction:
+        return # Already running classifications finish on their own, their stores are dropped
+
+    results = await asyncio.gather(*(task for task, _ in azimuths))
+    for _, stores in azimuths: # Verified now, so the azimuths join the cache, index and history like any PROCEEDed frame
+        await commitStores(stores)
+    recordReaction('PROCEED->verdict', time.perf_counter() - arrival)
+    for index, result in enumerate(results):
+        if result is not None:
+            print(f"  Azimuth {index + 1}: {classifications[result[0]]} ({result[1]:.1%} confidence)")
+            printNeighbours(result[2], 1)
+
+    results = [result for result in results if result is not None]
+    if not results:
+        print("Scan could not be classified.\n")
+        return
+    verdict, share, agreeing = scanVerdict(results)
+    print(f"Scan verdict: {classifications[verdict]} ({share:.1%} of confidence, {agreeing}/{len(results)} azimuths agree)\n")
+
+# Show each new frame and wait for the operator's GREEN/RED decision
+async def watchImages(link, event, decisions, toClassify, pool):
+    global lastImage
+    loop = asyncio.get_running_loop()
+    watcher = ImageWatcher(recentImages) # Sleeps on inotify instead of rescanning every file
+
+    try:
+        async for newImage in watcher.frames():
+            if newImage == lastImage:
+                continue
+            lastImage = newImage
+            snap = snaps.popleft() if snaps else Snap(0, 1, None, instrumentation.begin('frame_detected')) # Taken before decoding
+            cycle = snap.cycle
+            cycle.mark('frame_detected')
+
+            # Decoded once here, reused for both the preview and the model input
+            try:
+                frame = await loop.run_in_executor(None, loadFrame, newImage)
+            except ValueError as e:
+                print(f"{e}\n")
+                cycle.end()
+                continue
+            cycle.mark('decode')
+
+            if snap.capture is None: # No trigger waiting for it (late frame of a stopped run), nothing to verify
+                await displayImage(frame, link, event, cycle, sendReady = False)
+                cycle.end()
+                continue
+
+            if snap.count > 1:
+                await scanFrame(frame, link, event, decisions, pool, cycle, snap)
+                continue
+
+            await displayImage(frame, link, event, cycle, snap.capture)
+
+            doPrediction, arrival = await decisions.get()
+            cycle.mark('proceed_received', arrival)
+            if doPrediction:
+                toClassify.put_nowait((frame, arrival, cycle))
+            else:
+                cycle.end()
+
+    finally:
+        watcher.close()
+
+# Hand frames to the worker pool; several can be in flight at once
+async def classifyImages(toClassify, pool):
+    running = set()
+    while True:
+        frame, arrival, cycle = await toClassify.get()
+        recordReaction('PROCEED->classify', time.perf_counter() - arrival)
+        task = asyncio.create_task(classify(frame, pool, cycle))
+        running.add(task)
+        task.add_done_callback(running.discard)
 
 # Main function
-def main(ser):
-    global doPrediction
+async def main(link, pool):
     global flatline
-    global lastImage
 
     event = asyncio.Event()
     event.set()
+    decisions = asyncio.Queue()
+    toClassify = asyncio.Queue()
 
-    asyncio.run(incomingSignals(ser, event))
-    asyncio.run(heartbeat(ser, event))
+    # Everything shares one event loop; losing the link (the first two return) or any task failing ends the session
+    tasks = [
+        asyncio.create_task(incomingSignals(link, event, decisions)),
+        asyncio.create_task(heartbeat(link, event)),
+        asyncio.create_task(watchImages(link, event, decisions, toClassify, pool)),
+        asyncio.create_task(classifyImages(toClassify, pool)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
 
-    while (flatline != True):
-        newImage = getRecent(recentImages)
-        if (newImage and newImage != lastImage):
-            lastImage = newImage
-            displayImage(lastImage, ser, event)
-            while (flatline != True):
-                if (doPrediction != None):
-                    if (doPrediction == True):
-                        classify()
-                        doPrediction == None
-                        break
+    finally:
+        flatline = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        link.close()
+        endRun('disconnected')
+        resetScan()
+        printReactionTimes()
+        if resultCache is not None:
+            print(resultCache.describe())
+        if firstStage:
+            print(firstStage.describe())
+        instrumentation.dump()
 
-                    elif (doPrediction == False):
-                        doPrediction == None
-                        break
-
-                else:
-                    continue
+    # A crashed watcher or classifier is a bug, not a lost link: stop instead of reconnecting into it again
+    for task in done:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
 
+async def run(pool):
+    while True:
+        link = await connectionTest()
+        if link:
+            await main(link, pool)
         else:
-            continue
+            await asyncio.sleep(1)
 
 if __name__ == "__main__":
-    while True:
-        connect = connectionTest()
-        if connect:
-            ser = serial.Serial(connect, 115200)
-            main(ser)
\ No newline at end of file
+    instrumentation.installDumpSignal()
+    if embeddingPath:
+        embeddings = EmbeddingIndex(embeddingPath)
+    if cascadeFile not in ('', 'off') and os.path.exists(cascadeFile):
+        firstStage = FirstStage.load(cascadeFile)
+        if not firstStage.matches(model_path):
+            print(f"WARNING: {cascadeFile} was distilled from an older {model_path}, every frame goes to the ResNet50 until cascade.py train is rerun.\n")
+            firstStage = None
+        elif embeddings is not None:
+            print("Embedding lookup needs the ResNet50 features, so the cascade first stage is off.\n")
+            firstStage = None
+    if historyPath:
+        history = RunStore(historyPath) # Written from a background thread, never from the event loop
+        instrumentation.collectStages = True
+
+    # Workers load the model (validated backend or exported artifact) while the serial port is being found
+    modelPath, backend, threads = resolveRuntime(model_path)
+    if threads:
+        threads = max(1, threads // inferenceWorkers)
+    pool = InferencePool(modelPath, workers = inferenceWorkers, threads = threads, backend = backend, embeddings = embeddings is not None)
+    try:
+        asyncio.run(run(pool))
+    finally:
+        pool.close()
+        if history:
+            history.close()
@@ -1,436 +1,737 @@
 # Imports
 import time
 import uasyncio
+from array import array
 import machine
+from machine import Pin, PWM
+from micropython import const
+from rheedProtocol import (
+    FLAG_BEAM_ON, FLAG_BLUE, FLAG_GREEN, FLAG_LOCKOUT, FLAG_RED, FLAG_SNAP, FLAG_WHITE, FLAG_YELLOW,
+    MSG_BEAM_OFF, MSG_BEAM_ON, MSG_CRITICAL, MSG_HANG, MSG_HELLO, MSG_HELLO_ACK, MSG_INCORRECT,
+    MSG_PASSWORD, MSG_PASSWORD_REQUEST, MSG_PROCEED, MSG_PULSE, MSG_READY, MSG_REDO, MSG_SCAN_CONFIG,
+    MSG_SNAP, MSG_STOP, MSG_TELEMETRY, MSG_TIMEOUT, MSG_TELEMETRY_RATE, MSG_VERIFY, Session, decodeU16, encodeTelemetry,
+)
 from top_secret import password
 
-# Global Variables
-globalVariables = {
-    # LEDs
-    'rLED' : Pin(2, Pin.OUT), # Lock controls
-    'yLED' : Pin(3, Pin.OUT), # Warning
-    'gLED' : Pin(6, Pin.OUT), # Idle/new run
-    'bLED' : Pin(5, Pin.OUT), # Process in progress
-    'wLED' : Pin(4, Pin.OUT), # User input needed; won't continue
-    'toggle': False, # For FSM to avoid unnecessary toggling
-    'toggle4Timer' : False, # For checkTimer() to avoid unnecessary toggling
-
-    # State Machine
-    'S0' : 0, # Idle
-    'S1' : 1, # Unblank Beam
-    'S2' : 2, # Open Shutter
-    'S3' : 3, # Take Photo
-    'S4' : 4, # Verify Image
-    'S5' : 5, # Close Shutter
-    'S6' : 6, # Blank Beam
-    'S7' : 7, # Lock Controls
-
-    # Buttons
-    'start' : Pin(0, Pin.OUT), # Start process/confirm image
-    'stop' : Pin(8, Pin.OUT), # Stop process/ retake image
-
-    # Servo Motor
-    'servoPin' : Pin(7, Pin.OUT),
-    'servoPWM' : None,
-
-    # Beam
-    'beamOn' : 0, # Blanks when low, unblanks when high
-    'beamTimer' : 0, ## Indicates how long the beam gas been on
-
-    # User Input
-    'password' : None, # To unlock controls
-
-    # Connections
-    'uart' : machine.UART(0, baudrate=115200), 
-    'flatline' : True, # Detrmines if FSM can run or not
-    'pulse' : None, # Checks if communication still exists
-
-    # Flags and Triggers
-    'stopFlag' : 0, # End current process
-    'snapPicture' : 0, # For triggering the camera
-    'ready' : False, # For image display
-    'validFlag' : None, # For image verification
-    'unlockControls' : None, # For controls lock (proceed or remain locked)
-    'rFlag' : 0 # Trigger control locking
-}
+# LEDs
+rLED = Pin(2, Pin.OUT) # Lock controls
+yLED = Pin(3, Pin.OUT) # Warning
+gLED = Pin(6, Pin.OUT) # Idle/new run
+bLED = Pin(5, Pin.OUT) # Process in progress
+wLED = Pin(4, Pin.OUT) # User input needed; won't continue
+
+# Servo Motor
+servoPin = Pin(7, Pin.OUT)
+
+# Stepper Motor (sample rotation knob), STEP/DIR driver
+stepPin = Pin(10, Pin.OUT)
+dirPin = Pin(11, Pin.OUT)
+
+# Connections
+uart = machine.UART(0, baudrate=115200)
+
+# State Machine
+S0 = const(0) # Idle
+S1 = const(1) # Unblank Beam
+S2 = const(2) # Open Shutter
+S3 = const(3) # Take Photo
+S4 = const(4) # Verify Image
+S5 = const(5) # Close Shutter
+S6 = const(6) # Blank Beam
+S7 = const(7) # Lock Controls
+S8 = const(8) # Rotate Sample (scan mode)
+
+# Timing
+tickMs = const(5) # FSM period, so STOP and CRITICAL are acted on within one tick
+pulseTimeoutMs = const(10000) # Assume disconnect after 2 missed pulses
+exposeMs = const(10000) # Let beam hit the sample for a bit
+snapMs = const(3000) # Camera trigger held high
+verifyDelayMs = const(1000)
+readyTimeoutMs = const(15000) # Host has this long to show the frame before the run is aborted
+shutterOpenDeg = const(60)
+shutterStepDeg = const(3) # Ramp profile: 3 degrees per 20 ms PWM frame (150 deg/s)
+shutterStepMs = const(20)
+shutterSettleMs = const(100) # Let the horn stop before reporting arrival
+debounceMs = const(50)
+longPressMs = const(1000) # "Hold GREEN/RED until the white LED turns off"
+minTelemetryMs = const(50) # Fastest telemetry rate the host may ask for
+stepsPerRev = const(200) # Full steps per turn of the rotation knob
+stepPeriodMs = const(2)
+stepSettleMs = const(50) # Let the sample stop wobbling before the next frame
+
+# Button events
+NO_EVENT = const(0)
+START_PRESS = const(1)
+START_LONG = const(2)
+STOP_PRESS = const(3)
+STOP_LONG = const(4)
+
+# Everything the tasks share; attribute access instead of string-keyed dict lookups
+class Station:
+    __slots__ = (
+        'state', 'step', 'deadline', 'beamOn', 'beamTimer', 'password', 'flatline', 'lastPulse',
+        'stopFlag', 'snapPicture', 'ready', 'validFlag', 'unlockControls', 'rFlag', 'button', 'telemetryMs',
+        'scanAngles', 'scanCount', 'scanIndex', 'snapId',
+    )
+
+    def __init__(self):
+        self.state = S0
+        self.step = 0 # Progress inside the current state
+        self.deadline = 0 # time.ticks_ms() value the current state is waiting for
+        self.beamOn = 0 # Blanks when low, unblanks when high
+        self.beamTimer = 0 # Indicates how long the beam has been on
+        self.password = None # To unlock controls
+        self.flatline = True # Determines if FSM can run or not
+        self.lastPulse = 0 # Last time anything arrived from the host
+        self.stopFlag = 0 # End current process
+        self.snapPicture = 0 # For triggering the camera
+        self.ready = -1 # Capture number the host last confirmed displaying
+        self.validFlag = False # For image verification
+        self.unlockControls = None # For controls lock (proceed or remain locked)
+        self.rFlag = 0 # Trigger control locking
+        self.button = NO_EVENT # Button event being handled this tick
+        self.telemetryMs = 250 # Period of the telemetry packet, the host can change it
+        self.scanAngles = 1 # Azimuths per run requested by the host, applied when the next run starts
+        self.scanCount = 1 # Azimuths in the run in progress
+        self.scanIndex = 0 # Azimuth being captured
+        self.snapId = 0 # Counts camera triggers, so a late READY for an older frame is not taken for this one
+
+fsm = Station()
+
+# Fixed-size event queue, written from the pin IRQs and read by the FSM (no allocation in the IRQ)
+class EventRing:
+    __slots__ = ('events', 'head', 'tail', 'mask', 'overflows')
+
+    def __init__(self, size = 16): # size must be a power of two
+        self.events = bytearray(size)
+        self.head = 0 # Next slot the IRQ writes
+        self.tail = 0 # Next slot the FSM reads
+        self.mask = size - 1
+        self.overflows = 0
+
+    def put(self, event):
+        head = self.head
+        nextHead = (head + 1) & self.mask
+        if nextHead == self.tail: # Full, drop the newest event
+            self.overflows += 1
+            return
+        self.events[head] = event
+        self.head = nextHead
+
+    def get(self):
+        tail = self.tail
+        if tail == self.head:
+            return NO_EVENT
+        self.tail = (tail + 1) & self.mask
+        return self.events[tail]
+
+    def clear(self):
+        self.tail = self.head
+
+buttonEvents = EventRing()
+
+# Active-low push button: falling-edge IRQ with timestamp debounce, long press checked while held,
+# release only once the pin has read high for debounceMs (a bouncing contact reads high for a few ms)
+class Button:
+    __slots__ = ('pin', 'pressEvent', 'longEvent', 'lastEdge', 'pressedAt', 'held', 'longSent', 'highSince')
+
+    def __init__(self, id, pressEvent, longEvent):
+        self.pin = Pin(id, Pin.IN, Pin.PULL_UP)
+        self.pressEvent = pressEvent
+        self.longEvent = longEvent
+        self.lastEdge = time.ticks_ms()
+        self.pressedAt = 0
+        self.held = False
+        self.longSent = False
+        self.highSince = -1 # Tick the pin was first read high while held, -1 while it reads low
+        self.pin.irq(handler = self.onFalling, trigger = Pin.IRQ_FALLING)
+
+    def onFalling(self, pin):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.lastEdge) < debounceMs or self.held: # Contact bounce
+            return
+        self.lastEdge = now
+        self.pressedAt = now
+        self.held = True
+        self.longSent = False
+        self.highSince = -1
+        buttonEvents.put(self.pressEvent)
+
+    # Called every FSM tick, costs one pin read and only while the button is down
+    def check(self, now):
+        if not self.held:
+            return
+        if self.pin.value(): # Released, or a bounce
+            if self.highSince < 0:
+                self.highSince = now
+            elif time.ticks_diff(now, self.highSince) >= debounceMs:
+                self.held = False
+                self.lastEdge = now # Debounce the release bounce too
+            return
+        self.highSince = -1
+        if not self.longSent and time.ticks_diff(now, self.pressedAt) >= longPressMs:
+            self.longSent = True
+            buttonEvents.put(self.longEvent)
 
-currentState = globalVariables['S0'] # Initial state
+startButton = Button(0, START_PRESS, START_LONG) # Start process/confirm image
+stopButton = Button(8, STOP_PRESS, STOP_LONG) # Stop process/ retake image
 
-def connectionTest():
-    global globalVariables
+# Framed messages with CRC, sequence numbers and retransmission (see rheedProtocol.py)
+session = Session(uart.write, time.ticks_ms, time.ticks_diff)
 
-    while True:
-        if globalVariables['uart'].any():  # Check if there's data available
-            data = globalVariables['uart'].read().strip()
-            if data == b'MARCO!':
-                globalVariables['uart'].write(b'POLO!')
-                break
-        time.sleep(0.1)
+def send(msgType, payload = b''):
+    session.send(msgType, payload)
 
-    globalVariables['flatline'] = False
-    globalVariables['pulse'] = True
-
-# Start other async functions and check incoming data
-async def main():
-    global globalVariables
-    uasyncio.run(heartbeat())
-    uasyncio.run(timer())
-    uasyncio.run(checkTimer())
-    uasyncio.run(pollStop())
-    while (globalVariables['flatline'] == False):
-        if globalVariables['uart'].any():
-            received = globalVariables['uart'].readline().strip().decode()
-            if received.startswith('PULSE'):
-                globalVariables['pulse'] = True
-
-            elif received.startswith('PWD:'):
-                globalVariables['pulse'] = True
-                globalVariables['password'] = received
-
-            elif received.startswith('READY'):
-                globalVariables['ready'] = True
+def connectionTest():
+    connected = False
+    while not connected:
+        if uart.any():  # Check if there's data available
+            for msgType, payload in session.receive(uart.read()):
+                if msgType == MSG_HELLO:
+                    send(MSG_HELLO_ACK)
+                    connected = True
+                elif connected and msgType in handlers: # Settings sent right after HELLO
+                    handlers[msgType](payload)
+        time.sleep(0.1)
 
-            else:
-                globalVariables['pulse'] = True
+    fsm.flatline = False
+    fsm.lastPulse = time.ticks_ms()
 
-        uasyncio.run(heartbeat())
+# Host messages, looked up by type instead of a startswith chain
+def onPulse(payload):
+    pass # Receiving anything already refreshes lastPulse
 
-# Suspect connection lost 
-async def heartbeat():
-    globalVariables['pulse'] == False
-    count = 0
+def onPassword(payload):
+    fsm.password = payload.decode()
 
-    while (count != 10): # Wait for 2 missed pulses
-        await uasyncio.sleep(1)
-        if globalVariables['pulse'] == True:
-            globalVariables['flatline'] = False # Connection is still there
-            return
-        
-        else:
-            count += 1 # Give it a chance to update
-    
-    # Assume disconnect
-    globalVariables['flatline'] = True
-
-# Toggles green, blue, and white LEDs
-async def toggleLED(led):
-    global globalVariables
-    while (globalVariables['toggle'] == True):
-        if led.on():
-            led.off()
-            await uasyncio.sleep(0.5)
-        
-        else:
-            led.on()
-            await uasyncio.sleep(0.5)
-
-# Toggles yellow and red LEDs
-async def toggleLED4Timer(led):
-    global globalVariables
-    while (globalVariables['toggle4Timer'] == True):
-        if led.on():
-            led.off()
-            await uasyncio.sleep(0.5)
-        
-        else:
-            led.on()
-            await uasyncio.sleep(0.5)
+def onReady(payload):
+    if payload:
+        fsm.ready = payload[0]
 
-# Beam timer
-async def timer():
-    global globalVariables
-    while True:
-        while (globalVariables['beamOn'] == 1):
-            globalVariables['beamTimer'] += 1
-            
-        while (globalVariables['beamOn'] == 0):
-            if globalVariables['beamTimer'] == 0:
-                globalVariables['toggle4Timer'] = False
-                globalVariables['yLED'].off()
-                globalVariables['rLED'].off()
-                globalVariables['rFlag'] = 0
+def onTelemetryRate(payload):
+    fsm.telemetryMs = max(minTelemetryMs, decodeU16(payload))
 
-            else:
-                globalVariables['beamTimer'] -= 1
-                
-# Checks if stop went low except in S4
-async def pollStop():
-    global globalVariables
-    global currentState
-
-    while not globalVariables['flatline']:
-        if (globalVariables['stop'] == 0):
-            if (currentState != globalVariables['S4']):
-                globalVariables['stopFlag'] = 1
+def onScanConfig(payload):
+    fsm.scanAngles = max(1, payload[0])
 
-            else:
-                continue
+handlers = {
+    MSG_PULSE: onPulse,
+    MSG_PASSWORD: onPassword,
+    MSG_READY: onReady,
+    MSG_TELEMETRY_RATE: onTelemetryRate,
+    MSG_SCAN_CONFIG: onScanConfig,
+}
 
+# Check incoming data and suspect a lost connection after missed pulses
+async def hostLink():
+    while not fsm.flatline:
+        if uart.any():
+            for msgType, payload in session.receive(uart.read()):
+                fsm.lastPulse = time.ticks_ms() # Any traffic from the host proves it is alive
+                handler = handlers.get(msgType)
+                if handler:
+                    handler(payload)
+        session.service() # Resend anything the host has not acknowledged
+
+        if time.ticks_diff(time.ticks_ms(), fsm.lastPulse) > pulseTimeoutMs:
+            fsm.flatline = True # Assume disconnect
+        await uasyncio.sleep_ms(tickMs)
+
+# Blinks one LED as a background task until stopped
+class Blinker:
+    __slots__ = ('led', 'task')
+
+    def __init__(self):
+        self.led = None
+        self.task = None
+
+    def start(self, led):
+        self.stop()
+        self.led = led
+        self.task = uasyncio.create_task(self.run(led))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+            self.led.off()
+
+    async def run(self, led):
+        while True:
+            led.value(not led.value())
+            await uasyncio.sleep_ms(500)
+
+statusBlink = Blinker() # Blue and white LEDs
+
+# Beam has been on for 5 min, 6 min + 30 s, 8 min and 9 min + 30 s
+thresholdsMs = (300000, 390000, 480000, 570000)
+
+# Beam exposure, integrated from ticks_ms so thresholds follow wall time, not loop speed
+class BeamAccount:
+    __slots__ = ('exposureMs', 'since', 'band', 'blinkLed', 'changed')
+
+    def __init__(self):
+        self.exposureMs = 0 # Grows while the beam is on, decays 1:1 while it is off
+        self.since = time.ticks_ms()
+        self.band = -1
+        self.blinkLed = None # Warning LED toggled by the blink timer, if any
+        self.changed = None # Event that wakes the accountant early when the beam switches
+
+    def update(self, now):
+        elapsed = time.ticks_diff(now, self.since)
+        self.since = now
+        if fsm.beamOn == 1:
+            self.exposureMs += elapsed
         else:
+            self.exposureMs = max(0, self.exposureMs - elapsed)
+        fsm.beamTimer = self.exposureMs // 1000
+
+    # Milliseconds until the exposure crosses the next threshold in the current direction
+    def untilNext(self):
+        exposure = self.exposureMs
+        if fsm.beamOn == 1:
+            for threshold in thresholdsMs:
+                if exposure < threshold:
+                    return threshold - exposure
+        else:
+            for threshold in reversed(thresholdsMs):
+                if exposure >= threshold:
+                    return exposure - threshold + 1
+        return None
+
+    def applyBand(self):
+        exposure = self.exposureMs
+        band = 0
+        while band < len(thresholdsMs) and exposure >= thresholdsMs[band]:
+            band += 1
+        if band == self.band:
+            return
+        self.band = band
+
+        # 0: < 5 min, 1: yellow blinks, 2: yellow on, 3: red blinks, 4: red on and lock controls
+        self.blinkLed = yLED if band == 1 else rLED if band == 3 else None
+        yLED.value(band == 2)
+        rLED.value(band == 4)
+        fsm.rFlag = 1 if band == 4 else 0
+
+    def wake(self):
+        if self.changed:
+            self.changed.set()
+
+beam = BeamAccount()
+
+# One periodic timer drives whichever warning LED should blink
+def blinkWarning(timer):
+    led = beam.blinkLed
+    if led is not None:
+        led.toggle()
+
+warningTimer = machine.Timer(-1, mode = machine.Timer.PERIODIC, period = 500, callback = blinkWarning)
+
+def setBeam(on):
+    beam.update(time.ticks_ms()) # Close out the time spent in the previous state first
+    fsm.beamOn = on
+    beam.wake()
+
+# Sleeps until the next threshold crossing (or beam switch) instead of checking in a loop
+async def beamAccountant():
+    beam.changed = uasyncio.Event()
+    while not fsm.flatline:
+        beam.update(time.ticks_ms())
+        beam.applyBand()
+
+        wait = beam.untilNext()
+        beam.changed.clear()
+        if wait is None: # No threshold ahead until the beam switches
+            await beam.changed.wait()
             continue
-
-# Update variables based on value of beam timer
-async def checkTimer():
-    while True:
-        if globalVariables['beamTimer'] >= 300 and globalVariables['beamTimer'] < 390: # Beam has bean on for at least 5 minutes
-            globalVariables['toggle4Timer'] = True
-            uasyncio.run(toggleLED4Timer(globalVariables['yLED']))
-            globalVariables['rLED'].off()
-            globalVariables['rFlag'] = 0
-                
-        elif globalVariables['beamTimer'] >= 390 and globalVariables['beamTimer'] < 480: # Beam has bean on for at least 6 minutes + 30 seconds
-            globalVariables['toggle4Timer'] = False
-            await uasyncio.sleep(0.1)
-            globalVariables['yLED'].on()
-            globalVariables['rLED'].off()
-            globalVariables['rFlag'] = 0
-
-        elif globalVariables['beamTimer'] >= 480 and globalVariables['beamTimer'] < 570: # Beam has bean on for at least 8 minutes
-            globalVariables['yLED'].off()
-            globalVariables['toggle4Timer'] = True
-            uasyncio.run(toggleLED4Timer(globalVariables['rLED']))
-            globalVariables['rFlag'] = 0
-
-        elif globalVariables['beamTimer'] >= 570: # Beam has bean on for at least 9 minutes + 30 seconds
-            globalVariables['toggle4Timer'] = False
-            await uasyncio.sleep(0.1)
-            globalVariables['yLED'].off()
-            globalVariables['rLED'].on()
-            globalVariables['rFlag'] = 1
-
-        else: # Beam has been on for less than 5 minutes
-            globalVariables['toggle4Timer'] = False
-            globalVariables['yLED'].off()
-            globalVariables['rLED'].off()
-            globalVariables['rFlag'] = 0
-
-def runProcess():
-    global globalVariables
-    global currentState
-    uasyncio.run(main())
-    
-    while not globalVariables['flatline']: # Stop if connection is lost
-        globalVariables['uart'].write(str(globalVariables['beamTimer'].enconde()))
-        time.sleep(1)
-
-        if (currentState == globalVariables['S0']): #Idle
-            globalVariables['bLED'].off()
-            globalVariables['wLED'].off()
-            globalVariables['gLED'].on()
-            globalVariables['toggle'] = False
-            
-            # Reset variables
-            globalVariables['beamOn'] = 0
-            globalVariables['password'] = None
-            globalVariables['validFlag'] = False
-            globalVariables['unlockControls'] = None
-            globalVariables['stopFlag'] = 0
-            globalVariables['ready'] = False
-
-            if (globalVariables['rFlag'] != 1 and globalVariables['start'] == 0):
-                nextState = globalVariables['S1']
-                globalVariables['gLED'].off()
-
-            elif (globalVariables['rFlag'] == 1):
-                globalVariables['uart'].write(b'CRITICAL')
-                nextState = globalVariables['S7']
-            
-            else:
-                nextState = globalVariables['S0']
-
-            globalVariables['stopFlag'] = 0 # Only valid once process has started
-
-        elif (currentState == globalVariables['S1']): # Unblank Beam
-            globalVariables['gLED'].off()
-            globalVariables['bLED'].on()
-            
-            if (globalVariables['rFlag'] != 1 and globalVariables['stopFlag'] != 1):
-                globalVariables['beamOn'] = 1
-                globalVariables['uart'].write(b'BEAM_ON')
-                nextState = globalVariables['S2']
-    
-            elif (globalVariables['rFlag'] == 1):
-                globalVariables['uart'].write(b'CRITICAL')
-                nextState = globalVariables['S7']
-
-            elif (globalVariables['stopFlag'] == 1):
-                globalVariables['toggle'] = True
-                uasyncio.run(toggleLED(globalVariables['bLED']))
-                nextState = globalVariables['S0']
-
+        try:
+            await uasyncio.wait_for_ms(beam.changed.wait(), wait)
+        except uasyncio.TimeoutError:
+            pass
+
+# FSM loop health between telemetry packets
+class LoopStats:
+    __slots__ = ('ticks', 'maxGapMs', 'maxStepUs', 'last')
+
+    def __init__(self):
+        self.last = time.ticks_ms()
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.maxGapMs = 0 # Worst time between ticks, bounds how late STOP/CRITICAL can be seen
+        self.maxStepUs = 0 # Worst time spent inside one step()
+
+    def record(self, now, stepUs):
+        gap = time.ticks_diff(now, self.last)
+        self.last = now
+        self.ticks += 1
+        if gap > self.maxGapMs:
+            self.maxGapMs = gap
+        if stepUs > self.maxStepUs:
+            self.maxStepUs = stepUs
+
+loopStats = LoopStats()
+
+def telemetryFlags():
+    return (
+        (FLAG_BEAM_ON if fsm.beamOn == 1 else 0) | (FLAG_LOCKOUT if fsm.rFlag == 1 else 0)
+        | (FLAG_SNAP if fsm.snapPicture else 0) | (FLAG_RED if rLED.value() else 0)
+        | (FLAG_YELLOW if yLED.value() else 0) | (FLAG_GREEN if gLED.value() else 0)
+        | (FLAG_BLUE if bLED.value() else 0) | (FLAG_WHITE if wLED.value() else 0)
+    )
+
+# One compact packet per period instead of a write on every loop pass
+# (unacked and numbered apart from VERIFY/SNAP/BEAM_OFF, so a long run never wraps their seq)
+async def telemetry():
+    while not fsm.flatline:
+        await uasyncio.sleep_ms(fsm.telemetryMs)
+        beam.update(time.ticks_ms())
+        send(MSG_TELEMETRY, encodeTelemetry(
+            beam.exposureMs, fsm.state, telemetryFlags(), shutter.angle,
+            loopStats.ticks, loopStats.maxGapMs, loopStats.maxStepUs,
+        ))
+        loopStats.reset()
+
+def expired(now):
+    return time.ticks_diff(now, fsm.deadline) >= 0
+
+# Shutter servo: one PWM instance, duty per whole degree computed once, moves run as a task
+class Shutter:
+    __slots__ = ('pwm', 'duty', 'angle', 'target', 'moving', 'task', 'arrived')
+
+    def __init__(self, pin):
+        self.pwm = PWM(pin)
+        self.pwm.freq(50)
+        self.duty = array('H', [int((angle / 180) * (115 - 40) + 40) << 4 for angle in range(181)])
+        self.angle = 0 # Last angle written, the servo has no position sensor
+        self.target = 0
+        self.moving = False
+        self.task = None
+        self.arrived = None # Event set when the current move has settled
+
+    def write(self, angle):
+        self.angle = angle
+        self.pwm.duty_u16(self.duty[angle])
+
+    # Start a ramp from wherever the horn is now, replacing any move in progress
+    def moveTo(self, target, stepDeg = shutterStepDeg):
+        if self.task:
+            self.task.cancel()
+        self.target = target
+        self.moving = True
+        self.arrived = uasyncio.Event()
+        self.task = uasyncio.create_task(self.ramp(target, stepDeg))
+
+    async def ramp(self, target, stepDeg):
+        while self.angle != target:
+            if self.angle < target:
+                self.write(min(target, self.angle + stepDeg))
             else:
-                nextState = globalVariables['S6']
-        
-        elif (currentState == globalVariables['S2']): # Open Shutter
-            if (globalVariables['rFlag'] != 1 and globalVariables['stopFlag'] != 1):
-                globalVariables['servoPWM'] = PWM(globalVariables['servoPin'])
-                globalVariables['servoPWM'].freq(50)
-                dutyCycle = int((60 / 180) * (115 - 40) + 40)
-                globalVariables['servoPWM'].duty_u16(dutyCycle << 4)
-                time.sleep(10) # Let beam hit the sample for a bit
-                nextState = globalVariables['S3']
-
-            elif (globalVariables['rFlag'] == 1):
-                globalVariables['uart'].write(b'CRITICAL')
-                nextState = globalVariables['S6']
-            
-            elif (globalVariables['stopFlag'] == 1):
-                globalVariables['toggle'] = True
-                uasyncio.run(toggleLED(globalVariables['bLED']))
-                nextState = globalVariables['S6']
-
-            else:
-                nextState = globalVariables['S5']
-        
-        elif (currentState == globalVariables['S3']): # Take Photo
-            # Reset in case previous state was S4
-            globalVariables['validFlag'] = False
-            globalVariables['ready'] = False
-            
-            if (globalVariables['rFlag'] != 1 and globalVariables['stopFlag'] != 1):
-                globalVariables['snapPicture'] = 1
-                time.sleep(3)
-                globalVariables['snapPicture'] = 0
-                nextState = globalVariables['S4']
-
-            elif (globalVariables['rFlag'] == 1):
-                globalVariables['uart'].write(b'CRITICAL')
-                nextState = globalVariables['S5']
-            
-            elif (globalVariables['stopFlag'] == 1):
-                globalVariables['toggle'] = True
-                uasyncio.run(toggleLED(globalVariables['bLED']))
-                nextState = globalVariables['S5']
-
-            else:
-                nextState = globalVariables['S5']
-        
-        elif (currentState == globalVariables['S4']): # Verify Image
-            # Dummy loop until the new image is displayed
-            while (globalVariables['ready'] != True):
-                continue
-            
-            globalVariables['uart'].write(b'VERIFY')
-            time.sleep(1)
-            while (globalVariables['validFlag'] != True and globalVariables['flatline'] == False):
-                globalVariables['wLED'].on()
-                if (globalVariables['rFlag'] != 1):
-                    if (globalVariables['start']) == 0:
-                        globalVariables['validFlag'] = True
-                        globalVariables['uart'].write(b'PROCEED')
-                        nextState = globalVariables['S5']
-                        globalVariables['wLED'].off()
-                        break
-
-                    elif (globalVariables['stop']) == 0:
-                        globalVariables['validFlag'] = True
-                        globalVariables['uart'].write(b'REDO')
-                        nextState = globalVariables['S3']
-                        globalVariables['wLED'].off()
-                        break
-
-                    else:
-                        globalVariables['validFlag'] = False
-
-                else:
-                    globalVariables['uart'].write(b'CRITICAL') 
-                    nextState = globalVariables['S5']       
-                    break
-        
-        elif (currentState == globalVariables['S5']): # Close Shutter
-            globalVariables['wLED'].off()
-            globalVariables['servoPWM'] = PWM(globalVariables['servoPin'])
-            globalVariables['servoPWM'].freq(50)
-            dutyCycle = int((0 / 180) * (115 - 40) + 40)
-            globalVariables['servoPWM'].duty_u16(dutyCycle << 4)
-            time.sleep(1)
-
-            nextState = globalVariables['S6']
-        
-        elif (currentState == globalVariables['S6']): # Blank Beam
-            globalVariables['beamOn'] = 0
-            globalVariables['uart'].write(b'BEAM_OFF')
-            if (globalVariables['rFlag'] != 1):
-                nextState = globalVariables['S0']
-            
-            else:
-                nextState = globalVariables['S7']
-            
-            globalVariables['bLED'].off()
-
-        elif (currentState == globalVariables['S7']): # Lock Controls
-            globalVariables['unlockControls'] = False
-            globalVariables['uart'].write(b'PASSWORD')
-            globalVariables['toggle'] = True
-            uasyncio.run(toggleLED(globalVariables['wLED']))
-            
-            while (globalVariables['unlockControls'] != True and globalVariables['flatline'] == False):
-                time.sleep(5) # Give chance for user to enter a new password
-                if (globalVariables['password'] != None):
-                    if (globalVariables['password'] == password):
-                        globalVariables['unlockControls'] = True
-                        break
-
-                    else:
-                        globalVariables['uart'].write(b'INCORRECT')
-                        time.sleep(1)
-                        globalVariables['unlockControls'] = False
-                
-                else:
-                    globalVariables['unlockControls'] = False
-
-                uasyncio.run(heartbeat())  
-            nextState = globalVariables['S0']
-            globalVariables['toggle'] = False
-            globalVariables['wLED'].off()
-        
-        else: # Handle Hang/Unreachable State
-            globalVariables['uart'].write(b'HANG')
-            nextState = globalVariables['S5'] # make sure the shutter closes and beam is turned off
-
-        currentState = nextState
-    
-    # Assume disconnect
-    if (currentState == globalVariables['S0'] or currentState == globalVariables['S1'] or currentState == globalVariables['S7']):
-        pass
-
-    elif (currentState == globalVariables['S2'] or currentState == globalVariables['S6']):
-        globalVariables['beamOn'] = 0
-        globalVariables['uart'].write(b'BEAM_OFF')
-
-    elif (currentState == globalVariables['S3'] or currentState == globalVariables['S4'] or currentState == globalVariables['S5']):
-        globalVariables['servoPWM'] = PWM(globalVariables['servoPin'])
-        globalVariables['servoPWM'].freq(50)
-        dutyCycle = int((0 / 180) * (115 - 40) + 40)
-        globalVariables['servoPWM'].duty_u16(dutyCycle << 4)
-        globalVariables['beamOn'] = 0
-        globalVariables['uart'].write(b'BEAM_OFF')
-
+                self.write(max(target, self.angle - stepDeg))
+            await uasyncio.sleep_ms(shutterStepMs)
+        await uasyncio.sleep_ms(shutterSettleMs)
+        self.moving = False
+        self.task = None
+        self.arrived.set()
+
+    # Immediate move, for when the event loop is going away
+    def jump(self, target):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.target = target
+        self.moving = False
+        self.write(target)
+
+shutter = Shutter(servoPin)
+shutter.write(0) # Closed on power-up
+
+# Sample rotation stepper, position counted in steps from the first azimuth (0 to stepsPerRev - 1)
+class Rotator:
+    __slots__ = ('position', 'moving', 'task')
+
+    def __init__(self):
+        self.position = 0
+        self.moving = False
+        self.task = None
+
+    def moveTo(self, target):
+        self.stop()
+        self.moving = True
+        self.task = uasyncio.create_task(self.run(target))
+
+    async def run(self, target):
+        direction = 1 if target > self.position else -1
+        dirPin.value(direction > 0)
+        while self.position != target:
+            stepPin.on() # Driver steps on the rising edge
+            stepPin.off()
+            self.position += direction
+            await uasyncio.sleep_ms(stepPeriodMs)
+        self.position %= stepsPerRev
+        await uasyncio.sleep_ms(stepSettleMs)
+        self.moving = False
+        self.task = None
+
+    # Back to the first azimuth the short way round, the knob turns freely
+    def home(self):
+        if self.position:
+            self.moveTo(stepsPerRev if self.position * 2 > stepsPerRev else 0)
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.moving = False
+
+rotator = Rotator()
+
+def azimuthSteps(index):
+    return index * stepsPerRev // fsm.scanCount
+
+# Each state has an enter action and an update that returns the next state (or None to stay)
+def enterIdle(now):
+    bLED.off()
+    wLED.off()
+    gLED.on()
+    statusBlink.stop()
+
+    # Reset variables
+    setBeam(0)
+    fsm.password = None
+    fsm.validFlag = False
+    fsm.unlockControls = None
+    fsm.stopFlag = 0 # Only valid once process has started
+    fsm.ready = -1
+    fsm.scanIndex = 0
+
+def updateIdle(now):
+    if fsm.button == START_PRESS:
+        gLED.off()
+        return S1
+    return None
+
+def enterUnblank(now):
+    gLED.off()
+    bLED.on()
+    fsm.scanCount = fsm.scanAngles
+    fsm.scanIndex = 0
+
+def updateUnblank(now):
+    setBeam(1)
+    send(MSG_BEAM_ON)
+    return S2
+
+def enterOpenShutter(now):
+    shutter.moveTo(shutterOpenDeg)
+    rotator.home() # In case a disconnect left it off the first azimuth
+
+def updateOpenShutter(now):
+    if fsm.step == 0: # Exposure is timed from the moment the shutter is fully open
+        if not shutter.moving and not rotator.moving:
+            fsm.deadline = time.ticks_add(now, exposeMs)
+            fsm.step = 1
+        return None
+    return S3 if expired(now) else None
+
+def enterTakePhoto(now):
+    # Reset in case previous state was S4
+    fsm.validFlag = False
+    fsm.snapId = (fsm.snapId + 1) & 0xFF
+    fsm.snapPicture = 1
+    send(MSG_SNAP, bytes((fsm.scanIndex, fsm.scanCount, fsm.snapId)))
+    fsm.deadline = time.ticks_add(now, snapMs)
+
+def updateTakePhoto(now):
+    if expired(now):
+        fsm.snapPicture = 0
+        if fsm.scanIndex + 1 < fsm.scanCount: # Scan mode: next azimuth under the same exposure
+            fsm.scanIndex += 1
+            return S8
+        return S4
+    return None
+
+def enterRotate(now):
+    if fsm.scanIndex == 0: # Retaking the scan
+        rotator.home()
     else:
-        globalVariables['servoPWM'] = PWM(globalVariables['servoPin'])
-        globalVariables['servoPWM'].freq(50)
-        dutyCycle = int((0 / 180) * (115 - 40) + 40)
-        globalVariables['servoPWM'].duty_u16(dutyCycle << 4)
-        globalVariables['beamOn'] = 0
-        globalVariables['uart'].write(b'BEAM_OFF')
-
-    globalVariables['servoPWM'] = None
-    globalVariables['password'] = None
-    globalVariables['snapPicture'] = 0
-    globalVariables['unlockControls'] = None
-    globalVariables['validFlag'] = False
-    globalVariables['rFlag'] = 0
-    globalVariables['gLED'] = 0
-    globalVariables['bLED'] = 0
-    globalVariables['wLED'] = 0
-    globalVariables['ready'] = 0
-    globalVariables['toggle'] = False
-    globalVariables['toggle4Timer'] = False
-    globalVariables['beamOn'] = 0
-    globalVariables['pulse'] = None
-    globalVariables['stopFlag']
+        rotator.moveTo(azimuthSteps(fsm.scanIndex))
+
+def updateRotate(now):
+    return None if rotator.moving else S3
+
+def enterVerify(now):
+    if fsm.ready != fsm.snapId:
+        fsm.ready = -1 # Only a READY for the last capture counts, it may already have come in during S3
+    fsm.deadline = time.ticks_add(now, readyTimeoutMs)
+
+def updateVerify(now):
+    if fsm.step == 0: # Wait until the new image is displayed
+        if fsm.ready == fsm.snapId:
+            send(MSG_VERIFY)
+            fsm.deadline = time.ticks_add(now, verifyDelayMs)
+            fsm.step = 1
+        elif expired(now): # READY lost or never sent, don't leave the beam on waiting for it
+            send(MSG_TIMEOUT, bytes((S4,)))
+            return S5
+        return None
+
+    if fsm.step == 1 and expired(now):
+        wLED.on()
+        fsm.step = 2
+
+    # A hold that completes before the white LED comes on still counts
+    if fsm.button == START_LONG:
+        fsm.validFlag = True
+        send(MSG_PROCEED)
+        wLED.off()
+        return S5
+
+    elif fsm.button == STOP_LONG:
+        fsm.validFlag = True
+        send(MSG_REDO)
+        wLED.off()
+        if fsm.scanCount > 1: # Retake the whole scan from the first azimuth
+            fsm.scanIndex = 0
+            return S8
+        return S3
+
+    return None
+
+def enterCloseShutter(now):
+    wLED.off()
+    fsm.snapPicture = 0
+    shutter.moveTo(0) # Reverses from the current angle if it was still opening
+    rotator.home() # Back to the first azimuth for the next run
+
+def updateCloseShutter(now):
+    return None if shutter.moving or rotator.moving else S6
+
+def enterBlank(now):
+    setBeam(0)
+    send(MSG_BEAM_OFF)
+    bLED.off()
+
+def updateBlank(now):
+    return S7 if fsm.rFlag == 1 else S0
+
+def enterLock(now):
+    fsm.unlockControls = False
+    fsm.password = None
+    send(MSG_PASSWORD_REQUEST)
+    statusBlink.start(wLED)
+
+def updateLock(now):
+    if fsm.password is None: # Give chance for user to enter a new password
+        return None
+
+    if fsm.password == password:
+        fsm.unlockControls = True
+        statusBlink.stop()
+        wLED.off()
+        return S0
+
+    send(MSG_INCORRECT)
+    fsm.password = None
+    return None
+
+# Transition table indexed by state: (enter, update, next state on STOP, next state on CRITICAL)
+# None means the event is not acted on in that state
+stateTable = (
+    (enterIdle, updateIdle, None, S7), # S0
+    (enterUnblank, updateUnblank, S0, S7), # S1
+    (enterOpenShutter, updateOpenShutter, S5, S5), # S2
+    (enterTakePhoto, updateTakePhoto, S5, S5), # S3
+    (enterVerify, updateVerify, None, S5), # S4, holding RED means retake here
+    (enterCloseShutter, updateCloseShutter, None, None), # S5
+    (enterBlank, updateBlank, None, None), # S6
+    (enterLock, updateLock, None, None), # S7
+    (enterRotate, updateRotate, S5, S5), # S8
+)
+
+def enterState(state, now):
+    fsm.state = state
+    fsm.step = 0
+    stateTable[state][0](now)
+
+# One FSM tick: preemption first, then the state's own update with at most one button event
+def step(now):
+    startButton.check(now)
+    stopButton.check(now)
+    fsm.button = buttonEvents.get() # Events the current state does not use are dropped
+
+    if fsm.state >= len(stateTable): # Handle Hang/Unreachable State
+        send(MSG_HANG)
+        return S5 # make sure the shutter closes and beam is turned off
+
+    enter, update, onStop, onCritical = stateTable[fsm.state]
+    if onCritical is not None and fsm.rFlag == 1:
+        send(MSG_CRITICAL)
+        return onCritical
+
+    if onStop is not None and fsm.button == STOP_PRESS:
+        fsm.stopFlag = 1
+        statusBlink.start(bLED)
+        send(MSG_STOP) # Lets the host's run history tell a stopped run from a finished one
+        return onStop
+
+    return update(now)
+
+async def runFSM():
+    enterState(fsm.state, time.ticks_ms())
+    loopStats.last = time.ticks_ms()
+    while not fsm.flatline: # Stop if connection is lost
+        now = time.ticks_ms()
+        started = time.ticks_us()
+        nextState = step(now)
+        if nextState is not None:
+            enterState(nextState, now)
+        loopStats.record(now, time.ticks_diff(time.ticks_us(), started))
+        await uasyncio.sleep_ms(tickMs)
+
+# Leave the hardware safe once the host is gone
+def shutdown():
+    if shutter.angle != 0 or shutter.moving:
+        shutter.jump(0)
+
+    rotator.stop()
+
+    if fsm.beamOn == 1 or fsm.state in (S2, S3, S4, S5, S6, S8):
+        setBeam(0) # Exposure keeps decaying while disconnected, caught up on the next update
+        send(MSG_BEAM_OFF)
+
+    statusBlink.stop()
+    beam.blinkLed = None
+    beam.band = -1 # Warning LEDs are reapplied after reconnecting
+    for led in (rLED, yLED, gLED, bLED, wLED):
+        led.off()
+
+    fsm.state = S0
+    fsm.password = None
+    fsm.snapPicture = 0
+    fsm.unlockControls = None
+    fsm.validFlag = False
+    fsm.rFlag = 0
+    fsm.ready = -1
+    fsm.stopFlag = 0
+
+async def runProcess():
+    buttonEvents.clear() # Nothing pressed while disconnected carries over
+    tasks = [uasyncio.create_task(task()) for task in (hostLink, beamAccountant, telemetry)]
+    try:
+        await runFSM()
+    finally:
+        for task in tasks:
+            task.cancel()
+        shutdown()
 
 # Run code
-while True:
-    connectionTest()
-    runProcess()
+def start():
+    while True:
+        connectionTest()
+        uasyncio.run(runProcess())
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,136 @@
+# Imports (torch, torchvision and onnxruntime are only imported once a model is actually loaded)
+import json
+import os
+import numpy as np
+
+# Exported artifacts sit next to the trained weights, fastest first
+exportSuffixes = ['.onnx', '.ts']
+
+# Same network trainML.py produces
+def buildModel(modelPath):
+    import torch
+    import torch.nn as nn
+    from torchvision import models
+
+    model = models.resnet50(weights = None)
+    model.fc = nn.Linear(model.fc.in_features, 2)
+    model.load_state_dict(torch.load(modelPath, map_location = 'cpu'))
+    model.eval()
+    return model
+
+# Keeps the pooled 2048-d penultimate activations of an eager ResNet from the normal forward pass
+class FeatureTap:
+    def __init__(self, model):
+        self.features = None
+        model.avgpool.register_forward_hook(self.capture)
+
+    def capture(self, module, inputs, output):
+        self.features = output.flatten(1)
+
+# Traced and scripted graphs drop hooks, so only eager modules can be tapped
+def tapFeatures(model):
+    import torch
+    if isinstance(model, torch.jit.ScriptModule) or not hasattr(model, 'avgpool'):
+        return None
+    return FeatureTap(model)
+
+# Eager state dict or frozen TorchScript
+class TorchModel:
+    def __init__(self, modelPath, threads = None):
+        import torch
+        self.torch = torch
+        if threads:
+            torch.set_num_threads(threads)
+
+        if modelPath.endswith('.ts'):
+            self.model = torch.jit.load(modelPath, map_location = 'cpu')
+        else:
+            self.model = buildModel(modelPath)
+        self.model.eval()
+        self.tap = tapFeatures(self.model)
+        self.embeds = self.tap is not None
+
+    # (N, 3, 224, 224) float32 array in, (N, 2) logits out
+    def __call__(self, batch):
+        with self.torch.inference_mode():
+            return self.model(self.torch.from_numpy(batch)).numpy()
+
+    # (logits, (N, 2048) float32 features) from one forward pass
+    def embed(self, batch):
+        logits = self(batch)
+        return logits, self.tap.features.float().numpy()
+
+# ONNX Runtime session, no torch import at all
+class OnnxModel:
+    def __init__(self, modelPath, threads = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(modelPath, options, providers = ['CPUExecutionProvider'])
+        self.inputName = self.session.get_inputs()[0].name
+        self.embeds = len(self.session.get_outputs()) > 1 # exportModel.py adds a 'features' output
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.inputName: batch})[0]
+
+    def embed(self, batch):
+        logits, features = self.session.run(None, {self.inputName: batch})[:2]
+        return logits, features
+
+def onnxAvailable():
+    try:
+        import onnxruntime
+    except ImportError:
+        return False
+    return True
+
+# Prefer an exported artifact that is at least as new as the .pth it came from
+def resolveModelPath(modelPath):
+    base, extension = os.path.splitext(modelPath)
+    if extension != '.pth' or not os.path.exists(modelPath):
+        return modelPath
+
+    trained = os.path.getmtime(modelPath)
+    for suffix in exportSuffixes:
+        candidate = base + suffix
+        if suffix == '.onnx' and not onnxAvailable():
+            continue
+        if os.path.exists(candidate) and os.path.getmtime(candidate) >= trained:
+            return candidate
+    return modelPath
+
+# Written by inferenceBackends.py after checking each variant against the evaluation set
+def reportPath(modelPath):
+    return os.path.splitext(modelPath)[0] + '.backends.json'
+
+# Fastest backend that passed validation for this exact model file
+def selectBackend(modelPath):
+    path = reportPath(modelPath)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(modelPath):
+        return 'fp32', None
+    with open(path) as f:
+        report = json.load(f)
+    return report['selected'], report['threads']
+
+# Validated backend if one beats fp32, otherwise the fastest fp32 artifact
+def resolveRuntime(modelPath):
+    backend, threads = selectBackend(modelPath) if os.path.exists(modelPath) else ('fp32', None)
+    if backend != 'fp32':
+        return modelPath, backend, threads
+    return resolveModelPath(modelPath), backend, threads
+
+def loadModel(modelPath, threads = None, backend = 'fp32'):
+    if backend != 'fp32':
+        from inferenceBackends import buildBackend
+        return buildBackend(modelPath, backend, threads)
+    if modelPath.endswith('.onnx'):
+        return OnnxModel(modelPath, threads)
+    return TorchModel(modelPath, threads)
+
+# Numerically stable softmax over the class axis
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis = -1, keepdims = True))
+    return exp / exp.sum(axis = -1, keepdims = True)
@@ -0,0 +1,459 @@
+# Imports
+import argparse
+import asyncio
+import builtins
+import glob
+import os
+import pty
+import select
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tty
+import types
+from rheedProtocol import (
+    MSG_ACK, MSG_BEAM_OFF, MSG_HELLO_ACK, MSG_PASSWORD_REQUEST, MSG_VERIFY, FrameDecoder, messageNames, unreliable,
+)
+
+# Paths
+firmwarePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microcontrollerCode.py')
+sampleImages = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', '*', '*')
+
+# Pin numbers used by microcontrollerCode.py
+buttonPins = {'start': 0, 'stop': 8}
+
+# MicroPython's ticks wrap at 2**30, keep that so wrap-around bugs show up here too
+TICKS_PERIOD = 1 << 30
+
+# Scaled wall clock: speed = 100 runs the firmware's 10 s shutter dwell in 100 ms
+class VirtualClock:
+    def __init__(self, speed = 1.0, startMs = 0):
+        self.speed = speed
+        self.origin = time.monotonic()
+        self.startMs = startMs
+
+    def now(self):
+        return (time.monotonic() - self.origin) * self.speed + self.startMs / 1000
+
+    def realSeconds(self, virtualSeconds):
+        return max(0.0, virtualSeconds) / self.speed
+
+    def ticks_ms(self):
+        return int(self.now() * 1000) % TICKS_PERIOD
+
+    def ticks_us(self):
+        return int(self.now() * 1000000) % TICKS_PERIOD
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) % TICKS_PERIOD
+
+    def ticks_diff(self, new, old):
+        return ((new - old + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+    def sleep(self, seconds):
+        time.sleep(self.realSeconds(seconds))
+
+    # MicroPython's time module, backed by this clock
+    def timeModule(self):
+        module = types.ModuleType('time')
+        module.sleep = self.sleep
+        module.sleep_ms = lambda ms: self.sleep(ms / 1000)
+        module.sleep_us = lambda us: self.sleep(us / 1000000)
+        module.ticks_ms = self.ticks_ms
+        module.ticks_us = self.ticks_us
+        module.ticks_add = self.ticks_add
+        module.ticks_diff = self.ticks_diff
+        module.time = lambda: int(self.now())
+        return module
+
+    # uasyncio is asyncio with scaled sleeps plus MicroPython's extras
+    def uasyncioModule(self):
+        module = types.ModuleType('uasyncio')
+        for name in asyncio.__all__:
+            setattr(module, name, getattr(asyncio, name))
+        clock = self
+
+        async def sleep(seconds):
+            await asyncio.sleep(clock.realSeconds(seconds))
+
+        async def sleep_ms(ms):
+            await asyncio.sleep(clock.realSeconds(ms / 1000))
+
+        async def wait_for_ms(awaitable, timeout):
+            return await asyncio.wait_for(awaitable, clock.realSeconds(timeout / 1000))
+
+        module.sleep = sleep
+        module.sleep_ms = sleep_ms
+        module.wait_for_ms = wait_for_ms
+        return module
+
+# The simulated board: pins, PWM and a UART wired to a pseudo-terminal
+class VirtualBoard:
+    def __init__(self, clock, uartFd, onTransmit, onReceive):
+        self.clock = clock
+        self.uartFd = uartFd
+        self.onTransmit = onTransmit
+        self.onReceive = onReceive
+        self.pins = {}
+        self.pwm = {}
+        self.module = self.machineModule()
+
+    def machineModule(self):
+        board = self
+        module = types.ModuleType('machine')
+
+        class Pin:
+            IN = 0
+            OUT = 1
+            OPEN_DRAIN = 2
+            PULL_UP = 1
+            PULL_DOWN = 2
+            IRQ_FALLING = 4
+            IRQ_RISING = 8
+
+            def __init__(self, id, mode = -1, pull = -1, value = None):
+                self.id = id
+                self.mode = mode
+                self.level = 1 if pull == Pin.PULL_UP else 0
+                if value is not None:
+                    self.level = value
+                self.handler = None
+                self.trigger = 0
+                board.pins[id] = self
+
+            def value(self, level = None):
+                if level is None:
+                    return self.level
+                self.level = 1 if level else 0
+
+            __call__ = value
+
+            def on(self):
+                self.level = 1
+
+            def off(self):
+                self.level = 0
+
+            def toggle(self):
+                self.level ^= 1
+
+            def irq(self, handler = None, trigger = IRQ_FALLING | IRQ_RISING, hard = False):
+                self.handler = handler
+                self.trigger = trigger
+
+            # Driven from outside the firmware, fires IRQs on the matching edge
+            def drive(self, level):
+                previous, self.level = self.level, level
+                if self.handler is None or previous == level:
+                    return
+                edge = Pin.IRQ_FALLING if level == 0 else Pin.IRQ_RISING
+                if self.trigger & edge:
+                    self.handler(self)
+
+        class PWM:
+            def __init__(self, pin, freq = 50, duty_u16 = 0):
+                self.pin = pin
+                self.frequency = freq
+                self.duty = duty_u16
+                board.pwm[pin.id] = self
+
+            def freq(self, value = None):
+                if value is None:
+                    return self.frequency
+                self.frequency = value
+
+            def duty_u16(self, value = None):
+                if value is None:
+                    return self.duty
+                self.duty = value
+
+            def deinit(self):
+                self.duty = 0
+
+        class UART:
+            def __init__(self, id, baudrate = 115200, **kwargs):
+                self.buffer = bytearray()
+
+            def fill(self):
+                while select.select([board.uartFd], [], [], 0)[0]:
+                    try:
+                        data = os.read(board.uartFd, 4096)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    board.onReceive(data)
+                    self.buffer += data
+
+            def any(self):
+                self.fill()
+                return len(self.buffer)
+
+            def read(self, count = None):
+                self.fill()
+                if not self.buffer:
+                    return None
+                count = len(self.buffer) if count is None else count
+                data, self.buffer = bytes(self.buffer[:count]), self.buffer[count:]
+                return data
+
+            def readline(self):
+                self.fill()
+                end = self.buffer.find(b'\n')
+                return self.read(len(self.buffer) if end < 0 else end + 1)
+
+            def write(self, data):
+                board.onTransmit(bytes(data))
+                return os.write(board.uartFd, data)
+
+        # Hardware timer, its callback runs on a helper thread like an IRQ would
+        class Timer:
+            ONE_SHOT = 0
+            PERIODIC = 1
+
+            def __init__(self, id = -1, **kwargs):
+                self.generation = 0
+                if kwargs:
+                    self.init(**kwargs)
+
+            def init(self, mode = PERIODIC, period = -1, freq = -1, callback = None):
+                self.generation += 1
+                if freq > 0:
+                    period = 1000 / freq
+                threading.Thread(target = self.run, args = (self.generation, mode, period, callback), daemon = True).start()
+
+            def run(self, generation, mode, period, callback):
+                due = board.clock.now()
+                while generation == self.generation:
+                    due += period / 1000
+                    board.clock.sleep(due - board.clock.now())
+                    if generation != self.generation:
+                        return
+                    callback(self)
+                    if mode == Timer.ONE_SHOT:
+                        return
+
+            def deinit(self):
+                self.generation += 1
+
+        module.Pin = Pin
+        module.PWM = PWM
+        module.UART = UART
+        module.Timer = Timer
+        module.freq = lambda *args: 125000000
+        return module
+
+# Runs microcontrollerCode.py under CPython and plays operator and camera around it
+class PicoSimulator:
+    def __init__(self, speed = 1.0, captureDir = '/rheed_images', cycles = None, redoEvery = 0, password = '1234', bounceMs = 0, firmware = firmwarePath):
+        self.clock = VirtualClock(speed)
+        self.captureDir = captureDir
+        self.cycles = cycles
+        self.redoEvery = redoEvery # Press RED on every Nth verification, 0 never
+        self.password = password
+        self.bounceMs = bounceMs # Contact chatter after every press and release, 0 for clean edges
+        self.firmwarePath = firmware
+        self.samples = sorted(glob.glob(sampleImages))
+        self.photoCount = 0
+        self.verifyCount = 0
+        self.completed = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+        # Round trips (send -> ack) per message type and state dwell times, in virtual ms
+        self.txDecoder = FrameDecoder()
+        self.rxDecoder = FrameDecoder()
+        self.inFlight = {}
+        self.roundTrips = {}
+        self.dwell = {}
+        self.actions = []
+
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.portName = os.ttyname(slave)
+        self.slave = slave # Held open so the pty survives host reconnects
+        self.board = VirtualBoard(self.clock, self.master, self.sniffTransmit, self.sniffReceive)
+
+    # Load the firmware with MicroPython's modules swapped in for this module only
+    def loadFirmware(self):
+        replacements = {
+            'machine': self.board.module,
+            'time': self.clock.timeModule(),
+            'utime': self.clock.timeModule(),
+            'uasyncio': self.clock.uasyncioModule(),
+            'micropython': types.SimpleNamespace(const = lambda value: value),
+            'top_secret': types.SimpleNamespace(password = self.password),
+        }
+
+        def importHook(name, globals = None, locals = None, fromlist = (), level = 0):
+            if name in replacements:
+                return replacements[name]
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        module = types.ModuleType('microcontrollerCode')
+        module.__file__ = self.firmwarePath
+        module.__builtins__ = dict(builtins.__dict__, __import__ = importHook)
+        with open(self.firmwarePath) as f:
+            code = compile(f.read(), self.firmwarePath, 'exec')
+        exec(code, module.__dict__)
+        return module
+
+    def sniffTransmit(self, data):
+        now = self.clock.ticks_ms()
+        for msgType, seq, _ in self.txDecoder.feed(data):
+            if msgType not in unreliable:
+                self.inFlight[seq] = (msgType, now)
+            self.schedule(msgType)
+
+    def sniffReceive(self, data):
+        now = self.clock.ticks_ms()
+        for msgType, _, payload in self.rxDecoder.feed(data):
+            if msgType == MSG_ACK and payload and payload[0] in self.inFlight:
+                sentType, sentAt = self.inFlight.pop(payload[0])
+                self.roundTrips.setdefault(messageNames[sentType], []).append(self.clock.ticks_diff(now, sentAt))
+
+    # Operator behaviour, reacting to what the Pico tells the host
+    def schedule(self, msgType):
+        if msgType == MSG_HELLO_ACK:
+            self.later(500, self.pressButton, 'start')
+
+        elif msgType == MSG_VERIFY:
+            self.verifyCount += 1
+            redo = self.redoEvery and self.verifyCount % self.redoEvery == 0
+            self.later(300, self.pressButton, 'stop' if redo else 'start')
+
+        elif msgType == MSG_BEAM_OFF:
+            self.completed += 1
+            if self.cycles and self.completed >= self.cycles:
+                self.done.set()
+            else:
+                self.later(500, self.pressButton, 'start')
+
+        elif msgType == MSG_PASSWORD_REQUEST:
+            print(f"Pico locked, password is {self.password!r}")
+
+    def later(self, delayMs, action, *args):
+        with self.lock:
+            self.actions.append((self.clock.now() + delayMs / 1000, action, args))
+
+    # Hold a button long enough for the firmware's debounce/long-press logic
+    def pressButton(self, name, holdMs = 1200):
+        pin = self.board.pins.get(buttonPins[name])
+        if pin is None:
+            return
+        if pin.level == 0:
+            self.later(50, self.pressButton, name, holdMs) # Still held from the last press
+            return
+        pin.drive(0)
+        self.chatter(pin, 0)
+        self.later(holdMs, pin.drive, 1)
+        self.later(holdMs, self.chatter, pin, 1)
+
+    # A worn contact flips back for 3 ms every 6 ms before settling at level, longer than one 5 ms FSM tick
+    def chatter(self, pin, level):
+        for offset in range(1, self.bounceMs, 6):
+            self.later(offset, pin.drive, level ^ 1)
+            self.later(offset + 3, pin.drive, level)
+
+    # A sample frame lands in the capture folder whenever the camera trigger goes high
+    def captureFrame(self):
+        if not self.samples:
+            return
+        self.photoCount += 1
+        source = self.samples[self.photoCount % len(self.samples)]
+        target = os.path.join(self.captureDir, f"sim_{self.photoCount:06d}{os.path.splitext(source)[1]}")
+        shutil.copyfile(source, target + '.part')
+        os.replace(target + '.part', target)
+
+    # The firmware drives no camera pin, the trigger is the snapPicture flag it raises in S3
+    def cameraTriggered(self, module):
+        return bool(module.fsm.snapPicture)
+
+    # Bench thread: timed operator actions, camera, and state dwell bookkeeping
+    def bench(self, module):
+        lastState = None
+        enteredAt = self.clock.ticks_ms()
+        snapping = False
+
+        while not self.done.is_set():
+            now = self.clock.now()
+            with self.lock:
+                due = [entry for entry in self.actions if entry[0] <= now]
+                self.actions = [entry for entry in self.actions if entry[0] > now]
+            for _, action, args in due:
+                action(*args)
+
+            triggered = self.cameraTriggered(module)
+            if triggered and not snapping:
+                self.captureFrame()
+            snapping = triggered
+
+            state = module.fsm.state
+            if state != lastState:
+                ticks = self.clock.ticks_ms()
+                if lastState is not None:
+                    self.dwell.setdefault(f"S{lastState}->S{state}", []).append(self.clock.ticks_diff(ticks, enteredAt))
+                lastState, enteredAt = state, ticks
+
+            time.sleep(0.0005)
+
+    def run(self, timeout = None):
+        os.makedirs(self.captureDir, exist_ok = True)
+        module = self.loadFirmware()
+        firmware = threading.Thread(target = module.start, daemon = True)
+        firmware.start()
+        bench = threading.Thread(target = self.bench, args = (module,), daemon = True)
+        bench.start()
+        finished = self.done.wait(timeout)
+        self.done.set()
+        bench.join(timeout = 1)
+        return finished
+
+    def report(self):
+        print(f"Completed cycles: {self.completed}, photos: {self.photoCount}, virtual time {self.clock.now():.1f} s")
+        for title, table in (("Round trip (virtual ms)", self.roundTrips), ("State dwell (virtual ms)", self.dwell)):
+            print(title)
+            for name, samples in sorted(table.items()):
+                samples = sorted(samples)
+                p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+                print(f"  {name:>18}: n={len(samples):<6} p50 {statistics.median(samples):9.1f}   p99 {p99:9.1f}   max {samples[-1]:9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Virtual Pi Pico on a pseudo-terminal")
+    parser.add_argument('--speed', type = float, default = 1.0, help = "Virtual seconds per real second")
+    parser.add_argument('--cycles', type = int, default = None, help = "Stop after this many completed runs")
+    parser.add_argument('--timeout', type = float, default = None, help = "Real seconds before giving up")
+    parser.add_argument('--capture-dir', default = os.environ.get('RHEED_IMAGES', '/rheed_images'))
+    parser.add_argument('--redo-every', type = int, default = 0)
+    parser.add_argument('--password', default = '1234')
+    parser.add_argument('--bounce-ms', type = int, default = 0, help = "Let every button press and release chatter this long")
+    parser.add_argument('--launch-host', action = 'store_true', help = "Start machineLearning.py against the simulator")
+    args = parser.parse_args()
+
+    simulator = PicoSimulator(args.speed, args.capture_dir, args.cycles, args.redo_every, args.password, args.bounce_ms)
+    print(f"Virtual Pico listening on {simulator.portName}")
+    print(f"Connect with: RHEED_SERIAL_PORT={simulator.portName} RHEED_IMAGES={args.capture_dir} python machineLearning.py")
+
+    host = None
+    if args.launch_host:
+        environment = dict(os.environ, RHEED_SERIAL_PORT = simulator.portName, RHEED_IMAGES = args.capture_dir)
+        host = subprocess.Popen([sys.executable, 'machineLearning.py'], cwd = os.path.dirname(os.path.abspath(__file__)), env = environment)
+
+    try:
+        finished = simulator.run(args.timeout)
+    except KeyboardInterrupt:
+        finished = False
+    finally:
+        if host:
+            host.terminate()
+            host.wait()
+
+    simulator.report()
+    if args.cycles and not finished:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Imports
+import argparse
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from framePipeline import Frame, cropTo, normalize
+from inferenceWorker import classifications
+from modelLoader import loadModel, resolveRuntime, softmax
+
+# Paths
+model_path = 'rheed_model.pth'
+imageExtensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+checkpointName = 'progress.json'
+
+columns = ['path', 'class_index', 'class_name', 'confidence'] + [f'prob_{name}' for name in classifications] + ['error']
+
+def parquetAvailable():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+def listImages(roots):
+    paths = []
+    for root in roots:
+        if os.path.isfile(root):
+            paths.append(os.path.abspath(root))
+            continue
+        for folder, _, files in os.walk(root):
+            paths.extend(os.path.join(os.path.abspath(folder), name) for name in files if name.lower().endswith(imageExtensions))
+    return sorted(paths)
+
+# Decode-pool task: one batch of paths -> cropped uint8 frames (4x smaller to ship back than float tensors)
+def decodeBatch(paths):
+    crops = []
+    for path in paths:
+        try:
+            crops.append((path, Frame.load(path).cropped(), None))
+        except (ValueError, OSError) as e:
+            crops.append((path, None, str(e)))
+    return crops
+
+# Identifies a run so a checkpoint is only resumed against the same model and file list
+def runKey(modelPath, paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(path.encode())
+        digest.update(b'\0')
+    stat = os.stat(modelPath)
+    return {'model': os.path.abspath(modelPath), 'modelSize': stat.st_size, 'modelMtime': stat.st_mtime, 'files': len(paths), 'filesDigest': digest.hexdigest()}
+
+def loadCheckpoint(outputDir, key):
+    try:
+        with open(os.path.join(outputDir, checkpointName)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return checkpoint if checkpoint.get('key') == key else False
+
+# Written to a temporary file and renamed, so an interruption never leaves a half-written checkpoint
+def saveCheckpoint(outputDir, key, done, parts, fileFormat):
+    path = os.path.join(outputDir, checkpointName)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'done': done, 'parts': parts, 'format': fileFormat}, f, indent = 2)
+    os.replace(path + '.tmp', path)
+
+# One part file per chunk of rows; Parquet when pyarrow is installed, CSV otherwise
+def writePart(outputDir, index, rows, fileFormat):
+    path = os.path.join(outputDir, f"part-{index:06d}.{fileFormat}")
+    if fileFormat == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.table({name: [row[i] for row in rows] for i, name in enumerate(columns)})
+        pyarrow.parquet.write_table(table, path + '.tmp', compression = 'zstd')
+    else:
+        with open(path + '.tmp', 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+    os.replace(path + '.tmp', path)
+    return path
+
+# Decoded batches in order, with up to `prefetch` batches being decoded ahead of inference
+def decoded(decoders, batches, prefetch):
+    inFlight = collections.deque()
+    for batch in batches:
+        inFlight.append(decoders.submit(decodeBatch, batch))
+        if len(inFlight) >= prefetch:
+            yield inFlight.popleft().result()
+    while inFlight:
+        yield inFlight.popleft().result()
+
+# Normalizes the readable crops into the reused batch buffer and runs one forward pass
+def infer(model, crops, batchTensor):
+    count = 0
+    for _, crop, _ in crops:
+        if crop is not None:
+            normalize(crop, batchTensor[count])
+            count += 1
+    if not count:
+        return np.empty((0, len(classifications)), dtype = np.float32)
+    return softmax(model(batchTensor[:count]))
+
+def resultRows(crops, probabilities):
+    rows = []
+    position = 0
+    for path, crop, error in crops:
+        if crop is None:
+            rows.append([path, -1, '', 0.0] + [0.0] * len(classifications) + [error])
+            continue
+        row = probabilities[position]
+        position += 1
+        preds = int(row.argmax())
+        rows.append([path, preds, classifications[preds], float(row[preds])] + [float(p) for p in row] + [''])
+    return rows
+
+# Part file first, then the checkpoint: a crash in between only means that part is rewritten on resume
+def flush(outputDir, parts, done, rows, key, fileFormat):
+    writePart(outputDir, parts, rows, fileFormat)
+    parts += 1
+    done += len(rows)
+    saveCheckpoint(outputDir, key, done, parts, fileFormat)
+    return parts, done
+
+def report(processed, done, total, start, inferenceSeconds):
+    elapsed = time.perf_counter() - start
+    print(f"{done}/{total} frames, {processed / elapsed:.1f} frames/s overall, {processed / max(inferenceSeconds, 1e-9):.1f} frames/s inference only")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Re-run a model over archived RHEED frames")
+    parser.add_argument('inputs', nargs = '+', help = "Image files or folders (searched recursively)")
+    parser.add_argument('--model', default = model_path)
+    parser.add_argument('--output', default = 'reclassified', help = "Folder for part files and the checkpoint")
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--decode-workers', type = int, default = max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument('--prefetch', type = int, default = 4, help = "Decoded batches kept ahead of inference")
+    parser.add_argument('--part-size', type = int, default = 4096, help = "Rows per output file and checkpoint")
+    parser.add_argument('--format', choices = ['parquet', 'csv'], default = None)
+    parser.add_argument('--restart', action = 'store_true', help = "Ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    paths = listImages(args.inputs)
+    if not paths:
+        raise SystemExit("No images found.")
+    os.makedirs(args.output, exist_ok = True)
+
+    key = runKey(args.model, paths)
+    checkpoint = None if args.restart else loadCheckpoint(args.output, key)
+    if checkpoint is False:
+        raise SystemExit(f"{args.output} holds results for a different model or file list, use --restart to overwrite.")
+    fileFormat = (checkpoint or {}).get('format') or args.format or ('parquet' if parquetAvailable() else 'csv')
+    done = checkpoint['done'] if checkpoint else 0
+    parts = checkpoint['parts'] if checkpoint else 0
+    if done:
+        print(f"Resuming after {done} of {len(paths)} frames.")
+    if done >= len(paths):
+        return
+
+    # Same backend/artifact choice as the live station, but all cores go to one batched model
+    modelPath, backend, threads = resolveRuntime(args.model)
+    model = loadModel(modelPath, threads or max(1, (os.cpu_count() or 1) - args.decode_workers), backend)
+    batchTensor = np.empty((args.batch_size, 3, cropTo, cropTo), dtype = np.float32)
+
+    remaining = paths[done:]
+    batches = (remaining[i:i + args.batch_size] for i in range(0, len(remaining), args.batch_size))
+    rows = []
+    processed = 0
+    inferenceSeconds = 0.0
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(args.decode_workers) as decoders:
+        for crops in decoded(decoders, batches, args.prefetch):
+            inferenceStart = time.perf_counter()
+            probabilities = infer(model, crops, batchTensor)
+            inferenceSeconds += time.perf_counter() - inferenceStart
+
+            rows.extend(resultRows(crops, probabilities))
+            processed += len(crops)
+            if len(rows) >= args.part_size:
+                parts, done = flush(args.output, parts, done, rows[:args.part_size], key, fileFormat)
+                rows = rows[args.part_size:]
+                report(processed, done, len(paths), start, inferenceSeconds)
+
+    if rows:
+        parts, done = flush(args.output, parts, done, rows, key, fileFormat)
+    report(processed, done, len(paths), start, inferenceSeconds)
+    print(f"Results in {args.output} ({parts} {fileFormat} part files).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# Binary framing shared by the host and the Pi Pico (keep this file MicroPython compatible)
+#
+# Frame: SYNC | type | seq | length | payload[length] | crc16 (high byte, low byte)
+# The CRC (CCITT, init 0xFFFF) covers type, seq, length and payload.
+
+SYNC = 0xA5
+
+# Message types
+MSG_ACK = 0x00 # payload: seq being acknowledged
+MSG_HELLO = 0x01 # Host -> Pico (was MARCO!), payload: optional session id
+MSG_HELLO_ACK = 0x02 # Pico -> host (was POLO!)
+MSG_PULSE = 0x03 # Host heartbeat
+MSG_READY = 0x04 # Host finished displaying the frame, payload: capture number from its SNAP
+MSG_PASSWORD = 0x05 # payload: password bytes
+MSG_TELEMETRY_RATE = 0x06 # payload: milliseconds between telemetry packets as uint16
+MSG_SCAN_CONFIG = 0x07 # payload: number of azimuths per run as uint8 (1 = single frame)
+MSG_STOP = 0x10
+MSG_TELEMETRY = 0x11 # payload: see encodeTelemetry()
+MSG_BEAM_ON = 0x12
+MSG_BEAM_OFF = 0x13
+MSG_VERIFY = 0x14
+MSG_PROCEED = 0x15
+MSG_REDO = 0x16
+MSG_PASSWORD_REQUEST = 0x17
+MSG_INCORRECT = 0x18
+MSG_CRITICAL = 0x19
+MSG_HANG = 0x1A
+MSG_SNAP = 0x1B # Camera triggered (S3), payload: azimuth index, azimuth count, capture number (wraps at 256)
+MSG_TIMEOUT = 0x1C # Gave up waiting on the host, payload: state it was waiting in
+
+messageNames = {
+    MSG_ACK: 'ACK', MSG_HELLO: 'HELLO', MSG_HELLO_ACK: 'HELLO_ACK', MSG_PULSE: 'PULSE',
+    MSG_READY: 'READY', MSG_PASSWORD: 'PASSWORD', MSG_TELEMETRY_RATE: 'TELEMETRY_RATE',
+    MSG_SCAN_CONFIG: 'SCAN_CONFIG', MSG_STOP: 'STOP', MSG_TELEMETRY: 'TELEMETRY',
+    MSG_BEAM_ON: 'BEAM_ON', MSG_BEAM_OFF: 'BEAM_OFF', MSG_VERIFY: 'VERIFY', MSG_PROCEED: 'PROCEED',
+    MSG_REDO: 'REDO', MSG_PASSWORD_REQUEST: 'PASSWORD_REQUEST', MSG_INCORRECT: 'INCORRECT',
+    MSG_CRITICAL: 'CRITICAL', MSG_HANG: 'HANG', MSG_SNAP: 'SNAP', MSG_TIMEOUT: 'TIMEOUT',
+}
+
+# Periodic messages are simply superseded by the next one, so they are never acked or resent
+# and are numbered separately, so any number of them never moves the reliable sequence
+unreliable = (MSG_ACK, MSG_PULSE, MSG_TELEMETRY)
+
+# Telemetry flag bits
+FLAG_BEAM_ON = 0x01
+FLAG_LOCKOUT = 0x02 # rFlag
+FLAG_SNAP = 0x04
+FLAG_RED = 0x08
+FLAG_YELLOW = 0x10
+FLAG_GREEN = 0x20
+FLAG_BLUE = 0x40
+FLAG_WHITE = 0x80
+
+# CRC16-CCITT lookup table, built once at import
+def makeCrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+crcTable = makeCrcTable()
+
+def crc16(data, crc = 0xFFFF):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ crcTable[(crc >> 8) ^ byte]
+    return crc
+
+def encodeFrame(msgType, seq, payload = b''):
+    body = bytes((msgType, seq, len(payload))) + payload
+    crc = crc16(body)
+    return bytes((SYNC,)) + body + bytes((crc >> 8, crc & 0xFF))
+
+def encodeU16(value):
+    value = max(0, min(0xFFFF, int(value)))
+    return bytes((value >> 8, value & 0xFF))
+
+def decodeU16(payload):
+    return (payload[0] << 8) | payload[1]
+
+# One telemetry packet, 13 bytes big-endian:
+# exposure ms u32 | state u8 | flags u8 | servo angle u8 | FSM ticks u16 | worst tick gap ms u16 | worst step us u16
+telemetryFields = ('exposure_ms', 'state', 'flags', 'servo_deg', 'fsm_ticks', 'max_gap_ms', 'max_step_us')
+
+def encodeTelemetry(exposureMs, state, flags, servoAngle, ticks, maxGapMs, maxStepUs):
+    exposureMs = max(0, min(0xFFFFFFFF, int(exposureMs)))
+    return bytes((
+        exposureMs >> 24, (exposureMs >> 16) & 0xFF, (exposureMs >> 8) & 0xFF, exposureMs & 0xFF,
+        state & 0xFF, flags & 0xFF, max(0, min(0xFF, int(servoAngle))),
+    )) + encodeU16(ticks) + encodeU16(maxGapMs) + encodeU16(maxStepUs)
+
+def decodeTelemetry(payload):
+    exposureMs = (payload[0] << 24) | (payload[1] << 16) | (payload[2] << 8) | payload[3]
+    return (
+        exposureMs, payload[4], payload[5], payload[6],
+        decodeU16(payload[7:9]), decodeU16(payload[9:11]), decodeU16(payload[11:13]),
+    )
+
+# Byte-at-a-time parser, resynchronizes on the next SYNC after a corrupt frame
+class FrameDecoder:
+    def __init__(self):
+        self.reset()
+        self.crcErrors = 0
+
+    def reset(self):
+        self.state = 0
+        self.header = bytearray()
+        self.payload = bytearray()
+        self.length = 0
+        self.crc = 0xFFFF
+        self.received = 0
+
+    # Returns a list of (msgType, seq, payload) for every complete, valid frame
+    def feed(self, data):
+        frames = []
+        for byte in data:
+            if self.state == 0: # Waiting for SYNC
+                if byte == SYNC:
+                    self.reset()
+                    self.state = 1
+
+            elif self.state == 1: # type, seq, length
+                self.header.append(byte)
+                self.crc = ((self.crc << 8) & 0xFFFF) ^ crcTable[(self.crc >> 8) ^ byte]
+                if len(self.header) == 3:
+                    self.length = self.header[2]
+                    self.state = 2 if self.length else 3
+
+            elif self.state == 2: # payload
+                self.payload.append(byte)
+                self.crc = ((self.crc << 8) & 0xFFFF) ^ crcTable[(self.crc >> 8) ^ byte]
+                if len(self.payload) == self.length:
+                    self.state = 3
+
+            else: # crc, high byte then low byte
+                self.received = (self.received << 8) | byte
+                self.state += 1
+                if self.state == 5:
+                    if self.received == self.crc:
+                        frames.append((self.header[0], self.header[1], bytes(self.payload)))
+                    else:
+                        self.crcErrors += 1
+                    self.state = 0
+        return frames
+
+# Sequence numbers, acks and retransmission on top of the frame format
+# write(bytes) sends on the wire, ticks() returns milliseconds and diff(a, b) is a - b in ticks
+class Session:
+    def __init__(self, write, ticks, diff, retransmitMs = 100, maxRetries = 5):
+        self.write = write
+        self.ticks = ticks
+        self.diff = diff
+        self.retransmitMs = retransmitMs
+        self.maxRetries = maxRetries
+        self.decoder = FrameDecoder()
+        self.seq = 0 # Next reliable seq
+        self.periodicSeq = 0 # Next unreliable seq, only useful for spotting gaps
+        self.unacked = {} # seq -> [frame, sentAt, retries, msgType]
+        self.recent = [] # Last reliable seqs delivered, to drop retransmitted duplicates
+        self.peerHello = None # Session id of the peer's last HELLO, so a retransmitted copy does not start over twice
+        self.bytesSent = 0
+        self.retransmits = 0
+        self.dropped = 0
+
+    def send(self, msgType, payload = b''):
+        if msgType == MSG_HELLO:
+            self.unacked.clear() # Starting over, nothing from the previous connection is resent into the new one
+        if msgType in unreliable:
+            seq = self.periodicSeq
+            self.periodicSeq = (seq + 1) & 0xFF
+            frame = encodeFrame(msgType, seq, payload)
+        else:
+            seq = self.seq
+            self.seq = (seq + 1) & 0xFF
+            frame = encodeFrame(msgType, seq, payload)
+            self.unacked[seq] = [frame, self.ticks(), 0, msgType]
+        self.write(frame)
+        self.bytesSent += len(frame)
+        return seq
+
+    # Feed raw bytes from the wire, returns new (msgType, payload) messages in order
+    def receive(self, data):
+        messages = []
+        for msgType, seq, payload in self.decoder.feed(data):
+            if msgType == MSG_ACK:
+                if payload:
+                    self.unacked.pop(payload[0], None)
+                continue
+
+            if msgType == MSG_HELLO and (not payload or bytes(payload) != self.peerHello):
+                # Peer (re)connected: its sequence numbers start over and our frames from before are stale
+                self.recent = []
+                self.unacked.clear()
+                self.peerHello = bytes(payload)
+            elif msgType == MSG_HELLO_ACK:
+                self.recent = []
+
+            if msgType not in unreliable:
+                self.write(encodeFrame(MSG_ACK, 0, bytes((seq,))))
+                if seq in self.recent:
+                    continue
+                self.recent.append(seq)
+                if len(self.recent) > 16:
+                    self.recent.pop(0)
+
+            messages.append((msgType, payload))
+        return messages
+
+    # Resend anything not acked in time, returns the message types that were given up on
+    def service(self):
+        now = self.ticks()
+        lost = []
+        for seq in list(self.unacked):
+            entry = self.unacked[seq]
+            if self.diff(now, entry[1]) < self.retransmitMs:
+                continue
+            if entry[2] >= self.maxRetries:
+                del self.unacked[seq]
+                self.dropped += 1
+                lost.append(entry[3])
+                continue
+            entry[1] = now
+            entry[2] += 1
+            self.retransmits += 1
+            self.write(entry[0])
+            self.bytesSent += len(entry[0])
+        return lost
@@ -0,0 +1,191 @@
+# Imports
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+# Run history in one SQLite file (WAL, so queries can run while the station is writing)
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,         -- unix ms when the beam was unblanked
+    started REAL NOT NULL,
+    ended REAL,
+    sample_id TEXT,
+    azimuths INTEGER,
+    beam_seconds REAL,              -- unblanked time of this run
+    exposure_start REAL,            -- Pico's accumulated exposure (s) when the run began
+    exposure_end REAL,
+    outcome TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,             -- message name, or 'state' for FSM transitions
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER,
+    ts REAL NOT NULL,
+    sample_id TEXT,
+    path TEXT,
+    image_hash TEXT,
+    azimuth INTEGER,
+    predicted INTEGER,
+    label TEXT,
+    confidence REAL,
+    stages TEXT                     -- JSON {stage: seconds}
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+CREATE INDEX IF NOT EXISTS runs_sample ON runs(sample_id, started);
+CREATE INDEX IF NOT EXISTS events_run ON events(run_id, ts);
+CREATE INDEX IF NOT EXISTS events_ts ON events(ts);
+CREATE INDEX IF NOT EXISTS frames_ts ON frames(ts);
+CREATE INDEX IF NOT EXISTS frames_sample ON frames(sample_id, ts);
+CREATE INDEX IF NOT EXISTS frames_predicted ON frames(predicted, ts);
+CREATE INDEX IF NOT EXISTS frames_run ON frames(run_id);
+"""
+
+bucketFormats = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL') # Safe with WAL, one fsync per checkpoint instead of per commit
+    return connection
+
+# Station-side writer: callers only enqueue, one background thread commits in batches
+class RunStore:
+    def __init__(self, path, batchSize = 256, flushMs = 200):
+        self.path = path
+        self.batchSize = batchSize
+        self.flushMs = flushMs
+        self.queue = queue.SimpleQueue()
+        self.written = 0
+        self.failures = 0
+        self.closed = False
+
+        connection = connect(path)
+        connection.executescript(schema)
+        connection.close()
+        self.writer = threading.Thread(target = self.writeLoop, daemon = True)
+        self.writer.start()
+
+    def writeLoop(self):
+        connection = connect(self.path)
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flushMs / 1000
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout = remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                with connection: # One transaction per batch
+                    for sql, params in batch:
+                        connection.execute(sql, params)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                self.failures += len(batch)
+                print(f"WARNING: Could not write run history: {e}\n")
+        connection.close()
+
+    def put(self, sql, params):
+        if not self.closed:
+            self.queue.put((sql, params))
+
+    # Run ids are assigned here, not by SQLite, so nothing waits on an insert
+    def beginRun(self, sampleId, azimuths, exposure):
+        now = time.time()
+        runId = int(now * 1000)
+        self.put('INSERT OR REPLACE INTO runs (id, started, sample_id, azimuths, exposure_start) VALUES (?, ?, ?, ?, ?)', (runId, now, sampleId, azimuths, exposure))
+        return runId
+
+    def endRun(self, runId, outcome, exposure):
+        now = time.time()
+        self.put('UPDATE runs SET ended = ?, beam_seconds = ? - started, exposure_end = ?, outcome = ? WHERE id = ?', (now, now, exposure, outcome, runId))
+
+    def event(self, runId, kind, value = None):
+        self.put('INSERT INTO events (run_id, ts, kind, value) VALUES (?, ?, ?, ?)', (runId, time.time(), kind, value))
+
+    # imageHash is the content half of Frame.fingerprint(), already computed next to the decode
+    def frame(self, runId, sampleId, path, imageHash, azimuth, predicted, label, confidence, stages):
+        self.put(
+            'INSERT INTO frames (run_id, ts, sample_id, path, image_hash, azimuth, predicted, label, confidence, stages) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (runId, time.time(), sampleId, path, imageHash, azimuth, predicted, label, confidence, json.dumps(stages)),
+        )
+
+    def close(self, timeout = 5):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer.join(timeout)
+
+# Read side, usable from a notebook or CLI while the station keeps writing
+class RunHistory:
+    def __init__(self, path):
+        self.connection = connect(path)
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def filters(column, since, until, sampleId):
+        clauses, params = [], []
+        if since is not None:
+            clauses.append(f'{column} >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append(f'{column} < ?')
+            params.append(until)
+        if sampleId is not None:
+            clauses.append('sample_id = ?')
+            params.append(sampleId)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    # [(bucket, runs, beam seconds, worst accumulated exposure seconds)]
+    def exposureTotals(self, bucket = 'day', since = None, until = None, sampleId = None):
+        where, params = self.filters('started', since, until, sampleId)
+        return self.connection.execute(
+            f"SELECT strftime('{bucketFormats[bucket]}', started, 'unixepoch', 'localtime') AS period, COUNT(*),"
+            f" COALESCE(SUM(beam_seconds), 0), MAX(exposure_end) FROM runs{where} GROUP BY period ORDER BY period",
+            params,
+        ).fetchall()
+
+    # [(bucket, label, frames, average confidence)]
+    def classTrend(self, bucket = 'day', since = None, until = None, sampleId = None):
+        where, params = self.filters('ts', since, until, sampleId)
+        return self.connection.execute(
+            f"SELECT strftime('{bucketFormats[bucket]}', ts, 'unixepoch', 'localtime') AS period, label, COUNT(*), AVG(confidence)"
+            f" FROM frames{where} GROUP BY period, label ORDER BY period, label",
+            params,
+        ).fetchall()
+
+    def recentRuns(self, limit = 20, sampleId = None):
+        where, params = self.filters('started', None, None, sampleId)
+        return self.connection.execute(
+            f"SELECT id, started, ended, sample_id, azimuths, beam_seconds, outcome FROM runs{where} ORDER BY started DESC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+
+    def runEvents(self, runId):
+        return self.connection.execute('SELECT ts, kind, value FROM events WHERE run_id = ? ORDER BY ts', (runId,)).fetchall()
+
+    def runFrames(self, runId):
+        return self.connection.execute(
+            'SELECT ts, path, image_hash, azimuth, label, confidence, stages FROM frames WHERE run_id = ? ORDER BY ts', (runId,),
+        ).fetchall()
@@ -0,0 +1,122 @@
+# Imports
+import asyncio
+import concurrent.futures
+import io
+import threading
+import time
+import serial
+from rheedProtocol import Session, messageNames
+
+# Framed, acknowledged asyncio link to the Pico over a pyserial port (see rheedProtocol.py)
+class SerialLink:
+    def __init__(self, ser, retransmitMs = 100, maxRetries = 5):
+        self.ser = ser
+        self.session = Session(self.rawWrite, lambda: int(time.monotonic() * 1000), lambda a, b: a - b, retransmitMs, maxRetries)
+        self.messages = None
+        self.loop = None
+        self.serviceHandle = None
+        self.readerThread = None
+        self.usesReader = False
+        self.closed = False
+        self.lastWrite = None
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1) # Keeps writes in order
+
+    # Must be called from inside the running event loop
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.messages = asyncio.Queue()
+        self.ser.timeout = 0 # Reads never block
+
+        try:
+            self.loop.add_reader(self.ser.fileno(), self.onReadable)
+            self.usesReader = True
+
+        except (AttributeError, NotImplementedError, io.UnsupportedOperation):
+            # No selectable handle (e.g. Windows COM ports), read on a helper thread instead
+            self.ser.timeout = 0.1
+            self.readerThread = threading.Thread(target = self.readBlocking, daemon = True)
+            self.readerThread.start()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.usesReader:
+            self.loop.remove_reader(self.ser.fileno())
+        if self.serviceHandle:
+            self.serviceHandle.cancel()
+        self.writer.shutdown(wait = False)
+        self.messages.put_nowait(None)
+        try:
+            self.ser.close()
+        except serial.SerialException:
+            pass
+
+    def onReadable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError):
+            self.close()
+            return
+        if data:
+            self.feed(data, time.perf_counter())
+
+    def readBlocking(self):
+        while not self.closed:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError):
+                self.loop.call_soon_threadsafe(self.close)
+                return
+            if data:
+                self.loop.call_soon_threadsafe(self.feed, data, time.perf_counter())
+
+    # Decode frames; acks and duplicate suppression happen inside the session
+    def feed(self, data, arrival):
+        for msgType, payload in self.session.receive(data):
+            self.messages.put_nowait((msgType, payload, arrival))
+        self.scheduleService()
+
+    def rawWrite(self, data):
+        if self.closed:
+            return
+        self.lastWrite = self.writer.submit(self.ser.write, data)
+        self.lastWrite.add_done_callback(self.onWritten)
+
+    def onWritten(self, future):
+        if future.exception() is not None:
+            self.loop.call_soon_threadsafe(self.close)
+
+    # Retransmit timer only runs while something is waiting for an ack
+    def scheduleService(self):
+        if self.session.unacked and self.serviceHandle is None and not self.closed:
+            self.serviceHandle = self.loop.call_later(self.session.retransmitMs / 2000, self.serviceTick)
+
+    def serviceTick(self):
+        self.serviceHandle = None
+        for msgType in self.session.service():
+            print(f"WARNING: Pico never acknowledged {messageNames.get(msgType, msgType)}.\n")
+        self.scheduleService()
+
+    # Next message as (msgType, payload, perf_counter() time its bytes arrived)
+    async def readMessage(self, timeout = None):
+        if timeout is None:
+            item = await self.messages.get()
+        else:
+            item = await asyncio.wait_for(self.messages.get(), timeout)
+
+        if item is None:
+            self.messages.put_nowait(None) # Wake every other reader too
+            raise ConnectionError("Serial link closed")
+        return item
+
+    async def send(self, msgType, payload = b''):
+        if self.closed:
+            raise ConnectionError("Serial link closed")
+        self.session.send(msgType, payload)
+        self.scheduleService()
+        try:
+            await asyncio.wrap_future(self.lastWrite)
+        except (serial.SerialException, OSError) as e:
+            self.close()
+            raise ConnectionError("Serial write failed") from e
@@ -0,0 +1,79 @@
+# Imports
+import numpy as np
+import time
+from rheedProtocol import (
+    FLAG_BEAM_ON, FLAG_BLUE, FLAG_GREEN, FLAG_LOCKOUT, FLAG_RED, FLAG_SNAP, FLAG_WHITE, FLAG_YELLOW,
+    decodeTelemetry, telemetryFields,
+)
+
+flagNames = {
+    FLAG_BEAM_ON: 'beam', FLAG_LOCKOUT: 'lockout', FLAG_SNAP: 'snap', FLAG_RED: 'red',
+    FLAG_YELLOW: 'yellow', FLAG_GREEN: 'green', FLAG_BLUE: 'blue', FLAG_WHITE: 'white',
+}
+
+# Numeric fields worth min/avg/max (state and flags are categorical)
+numericFields = ('exposure_ms', 'servo_deg', 'fsm_ticks', 'max_gap_ms', 'max_step_us')
+
+# Fixed-size ring buffer of decoded telemetry packets plus running totals since connecting
+class TelemetryLog:
+    def __init__(self, capacity = 14400): # One hour at the default 250 ms
+        self.capacity = capacity
+        self.times = np.zeros(capacity) # time.perf_counter() at arrival
+        self.values = np.zeros((capacity, len(telemetryFields)), dtype = np.int64)
+        self.head = 0
+        self.count = 0
+        self.received = 0
+        self.latest = None
+        self.minimum = np.full(len(telemetryFields), np.iinfo(np.int64).max)
+        self.maximum = np.full(len(telemetryFields), np.iinfo(np.int64).min)
+        self.total = np.zeros(len(telemetryFields))
+
+    def add(self, payload, arrival = None):
+        row = decodeTelemetry(payload)
+        self.times[self.head] = time.perf_counter() if arrival is None else arrival
+        self.values[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.received += 1
+        self.latest = dict(zip(telemetryFields, row))
+        np.minimum(self.minimum, row, out = self.minimum)
+        np.maximum(self.maximum, row, out = self.maximum)
+        self.total += row
+        return self.latest
+
+    # (times, values) oldest first, optionally only the last `seconds`
+    def series(self, seconds = None):
+        order = (np.arange(self.count) + self.head - self.count) % self.capacity
+        times, values = self.times[order], self.values[order]
+        if seconds is not None and self.count:
+            keep = times >= times[-1] - seconds
+            times, values = times[keep], values[keep]
+        return times, values
+
+    # {field: (min, avg, max)} over a recent window, or since connecting when seconds is None
+    def stats(self, seconds = None):
+        columns = [telemetryFields.index(name) for name in numericFields]
+        if seconds is None:
+            if not self.received:
+                return {}
+            return {
+                name: (int(self.minimum[i]), self.total[i] / self.received, int(self.maximum[i]))
+                for name, i in zip(numericFields, columns)
+            }
+
+        _, values = self.series(seconds)
+        if not len(values):
+            return {}
+        return {
+            name: (int(values[:, i].min()), float(values[:, i].mean()), int(values[:, i].max()))
+            for name, i in zip(numericFields, columns)
+        }
+
+    def describe(self, seconds = 60):
+        if self.latest is None:
+            return "No telemetry received yet.\n"
+        flags = [name for bit, name in flagNames.items() if self.latest['flags'] & bit]
+        lines = [f"Pico state S{self.latest['state']}, flags: {', '.join(flags) or 'none'}"]
+        for name, (low, mean, high) in self.stats(seconds).items():
+            lines.append(f"  {name:>12}: min {low:8d}   avg {mean:10.1f}   max {high:8d}")
+        return '\n'.join(lines) + '\n'
@@ -1,18 +1,21 @@
-import matplotlib.pyplot as plt
+import argparse
+import json
 import numpy as np
 import os
 from PIL import Image
-import tensorflow as tf
-from keras import layers, models
+import time
 import torch
 from torchvision import datasets, transforms, models
 from torch.utils.data import DataLoader, Dataset
 import torch.nn as nn
-import torch.optim as optim
+from datasetShards import ShardDataset, evalBatch, shardLoader
+from framePipeline import Frame
+from modelLoader import loadModel, softmax
 
 # Paths
 data_dir = "/rheed_images/films/"  # Path to your test images
 output_model_path = "rheed_model.pth"  # Path to the trained model (base or augmented)
+report_path = "evaluation.json"
 
 # Test transforms (should match your training transforms)
 test_transform = transforms.Compose([
@@ -22,36 +25,243 @@ test_transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
-# Load the test dataset
-test_dataset = datasets.ImageFolder(data_dir, transform=test_transform)
-test_loader = DataLoader(test_dataset, batch_size=4, shuffle=False)
+# The test images through framePipeline.Frame, exactly as the live station prepares a capture
+class FrameFolder(Dataset):
+    def __init__(self, data_dir):
+        folder = datasets.ImageFolder(data_dir)
+        self.classes = folder.classes
+        self.samples = folder.samples
 
-# Load the model (base or augmented)
-model = models.resnet50(pretrained=False)  # Initialize the model without pre-trained weights
-model.fc = nn.Linear(model.fc.in_features, 2)  # Ensure the model's final layer matches the number of classes
+    def __len__(self):
+        return len(self.samples)
 
-# Load the trained model weights
-model.load_state_dict(torch.load(output_model_path))
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model.to(device)
+    def __getitem__(self, index):
+        path, label = self.samples[index]
+        return torch.from_numpy(Frame.load(path).writeTensor()), label
 
-# Set the model to evaluation mode
-model.eval()
+# Load the test dataset (workers decode batches in parallel with inference)
+# pipeline 'torchvision' is the training-time PIL transform, 'frame' the live station's preprocessing
+def loadTestSet(data_dir=data_dir, batch_size=4, workers=0, pipeline='torchvision'):
+    if pipeline == 'frame':
+        test_dataset = FrameFolder(data_dir)
+    else:
+        test_dataset = datasets.ImageFolder(data_dir, transform=test_transform)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=workers, persistent_workers=workers > 0)
+    return test_dataset, test_loader
 
-# Evaluate the model
-correct = 0
-total = 0
+# Same evaluation set from shards packed by datasetShards.py, center-cropped and normalized per batch
+def loadTestShards(shard_dir, batch_size=4, workers=2):
+    test_dataset = ShardDataset(shard_dir, transform = evalBatch)
+    test_loader = shardLoader(test_dataset, batch_size, workers = workers)
+    return test_dataset, test_loader
+
+# File of every sample, in loader order
+def samplePaths(test_dataset):
+    if isinstance(test_dataset, ShardDataset):
+        return test_dataset.paths
+    return [path for path, _ in test_dataset.samples]
+
+# Model variant from "path[:backend]": the .pth runs eagerly on the chosen device, exports go through
+# modelLoader and other backends through inferenceBackends (both CPU). Returns a batch -> logits function
+def loadVariant(spec, device, threads = None):
+    path, _, backend = spec.partition(':')
+    if backend and backend != 'fp32':
+        from inferenceBackends import buildBackend
+        model = buildBackend(path, backend, threads)
+        return lambda inputs: model.forward(inputs).numpy()
+    if not path.endswith('.pth'):
+        model = loadModel(path, threads)
+        return lambda inputs: model(inputs.numpy())
+
+    if threads:
+        torch.set_num_threads(threads)
+    model = models.resnet50(pretrained=False)
+    model.fc = nn.Linear(model.fc.in_features, 2)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    model.to(device)
+    model.eval()
+
+    def predict(inputs):
+        with torch.inference_mode():
+            return model(inputs.to(device)).float().cpu().numpy()
+    return predict
+
+def percentiles(seconds):
+    if not seconds:
+        return {'p50': 0.0, 'p99': 0.0}
+    return {'p50': float(np.percentile(seconds, 50) * 1000), 'p99': float(np.percentile(seconds, 99) * 1000)}
+
+# Reliability curve over max-probability bins plus the expected calibration error
+def calibration(confidences, correct, bins):
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    which = np.clip(np.digitize(confidences, edges[1:-1]), 0, bins - 1)
+    curve = []
+    ece = 0.0
+    for b in range(bins):
+        inBin = which == b
+        count = int(inBin.sum())
+        if not count:
+            continue
+        confidence = float(confidences[inBin].mean())
+        accuracy = float(correct[inBin].mean())
+        ece += count / len(confidences) * abs(accuracy - confidence)
+        curve.append({'lower': float(edges[b]), 'upper': float(edges[b + 1]), 'count': count, 'confidence': confidence, 'accuracy': accuracy})
+    return {'bins': curve, 'ece': ece}
+
+def classMetrics(confusion, classes):
+    metrics = {}
+    for i, name in enumerate(classes):
+        tp = confusion[i, i]
+        precision = tp / max(confusion[:, i].sum(), 1)
+        recall = tp / max(confusion[i].sum(), 1)
+        metrics[name] = {
+            'precision': float(precision),
+            'recall': float(recall),
+            'f1': float(2 * precision * recall / max(precision + recall, 1e-12)),
+            'support': int(confusion[i].sum()),
+        }
+    return metrics
+
+# Evaluate one variant: quality, calibration, misclassified files and throughput in one pass
+def evaluate(predict, test_loader, paths, classes, latencyFrames=32, bins=10):
+    confusion = np.zeros((len(classes), len(classes)), dtype=np.int64)
+    confidences = []
+    correct = []
+    misclassified = []
+    batchLatencies = []
+    singles = []
+    index = 0
+    started = time.perf_counter()
 
-with torch.no_grad():
     for inputs, labels in test_loader:
-        inputs, labels = inputs.to('cpu'), labels.to('cpu')
-        outputs = model(inputs)
-        _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
+        if not singles:
+            predict(inputs[:1]) # Warm-up so lazy initialization is not timed
+            singles = list(inputs[:latencyFrames])
+
+        start = time.perf_counter()
+        logits = predict(inputs)
+        batchLatencies.append(time.perf_counter() - start)
+
+        probabilities = softmax(logits)
+        predicted = probabilities.argmax(1)
+        labels = labels.numpy()
+        for offset, (label, guess) in enumerate(zip(labels, predicted)):
+            confusion[label, guess] += 1
+            if label != guess:
+                misclassified.append({
+                    'path': paths[index + offset], 'label': classes[label], 'predicted': classes[guess],
+                    'confidence': float(probabilities[offset, guess]),
+                })
+        confidences.extend(probabilities.max(1).tolist())
+        correct.extend((predicted == labels).tolist())
+        index += len(labels)
+
+    wall = time.perf_counter() - started
+
+    # Batch-of-one latency, what the live station sees per frame
+    singleLatencies = []
+    for frame in singles:
+        start = time.perf_counter()
+        predict(frame.unsqueeze(0))
+        singleLatencies.append(time.perf_counter() - start)
+
+    inferenceSeconds = sum(batchLatencies)
+    return {
+        'images': index,
+        'accuracy': float(confusion.trace() / max(confusion.sum(), 1)),
+        'confusion': confusion.tolist(),
+        'classes': classMetrics(confusion, classes),
+        'calibration': calibration(np.array(confidences), np.array(correct, dtype=np.float64), bins),
+        'misclassified': misclassified,
+        'throughput': {
+            'images_per_sec': index / max(inferenceSeconds, 1e-9),
+            'images_per_sec_with_loading': index / max(wall, 1e-9),
+            'batch_latency_ms': percentiles(batchLatencies),
+            'single_latency_ms': percentiles(singleLatencies),
+        },
+    }
+
+def printResult(name, result, classes):
+    print(f"\n{name}: accuracy {result['accuracy']:.2%} on {result['images']} images, ECE {result['calibration']['ece']:.3f}")
+    print("  confusion (rows = label, columns = predicted):")
+    for label, row in zip(classes, result['confusion']):
+        print(f"    {label:>16} " + ' '.join(f"{count:6d}" for count in row))
+    for label, metrics in result['classes'].items():
+        print(f"  {label:>16}: precision {metrics['precision']:.3f}, recall {metrics['recall']:.3f}, f1 {metrics['f1']:.3f}")
+    throughput = result['throughput']
+    print(
+        f"  {throughput['images_per_sec']:.1f} images/s ({throughput['images_per_sec_with_loading']:.1f} with loading), "
+        f"batch p50 {throughput['batch_latency_ms']['p50']:.1f} ms p99 {throughput['batch_latency_ms']['p99']:.1f} ms, "
+        f"single frame p50 {throughput['single_latency_ms']['p50']:.1f} ms p99 {throughput['single_latency_ms']['p99']:.1f} ms"
+    )
+    print(f"  {len(result['misclassified'])} misclassified")
+
+# Same model on the training-time transform and on the live Frame preprocessing
+def pipelineDifference(reference, live):
+    wrongReference = {entry['path'] for entry in reference['misclassified']}
+    wrongLive = {entry['path'] for entry in live['misclassified']}
+    return {
+        'accuracy_delta': live['accuracy'] - reference['accuracy'],
+        'fixed': len(wrongReference - wrongLive),
+        'broken': len(wrongLive - wrongReference),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Evaluate one or more model variants on the test images")
+    parser.add_argument('--data', default = data_dir)
+    parser.add_argument('--shards', default = None, help = "Folder packed by datasetShards.py instead of --data")
+    parser.add_argument('--models', nargs = '+', default = [output_model_path], help = "path[:backend], e.g. rheed_model.pth rheed_model.onnx rheed_model.pth:bf16")
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--workers', type = int, default = min(4, os.cpu_count() or 1), help = "Loader processes decoding in parallel with inference")
+    parser.add_argument('--threads', type = int, default = None)
+    parser.add_argument('--latency-frames', type = int, default = 32)
+    parser.add_argument('--bins', type = int, default = 10, help = "Calibration curve bins")
+    parser.add_argument('--pipeline', choices = ['torchvision', 'frame', 'both'], default = 'torchvision',
+                        help = "Preprocessing: training-time PIL transforms, the live station's Frame, or both compared")
+    parser.add_argument('--report', default = report_path)
+    args = parser.parse_args()
+
+    if args.shards:
+        if args.pipeline != 'torchvision':
+            raise SystemExit("--pipeline frame needs the original images, not --shards")
+        loaders = {'torchvision': loadTestShards(args.shards, args.batch_size, args.workers)}
+    else:
+        pipelines = ['torchvision', 'frame'] if args.pipeline == 'both' else [args.pipeline]
+        loaders = {pipeline: loadTestSet(args.data, args.batch_size, args.workers, pipeline) for pipeline in pipelines}
+    test_dataset = next(iter(loaders.values()))[0]
+    classes = test_dataset.classes
+    paths = samplePaths(test_dataset)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    report = {'data': args.shards or args.data, 'classes': classes, 'batch_size': args.batch_size, 'device': str(device), 'models': {}}
+    for spec in args.models:
+        try:
+            predict = loadVariant(spec, device, args.threads)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"\n{spec}: could not be loaded ({e})")
+            report['models'][spec] = {'error': repr(e)}
+            continue
+        results = {}
+        for pipeline, (_, test_loader) in loaders.items():
+            name = spec if pipeline == 'torchvision' else f"{spec} [frame]"
+            results[pipeline] = report['models'][name] = evaluate(predict, test_loader, paths, classes, args.latency_frames, args.bins)
+            printResult(name, results[pipeline], classes)
+        if len(results) == 2:
+            difference = pipelineDifference(results['torchvision'], results['frame'])
+            report['models'][spec]['frame_pipeline'] = difference
+            print(
+                f"  Live Frame preprocessing: accuracy {difference['accuracy_delta']:+.2%}, "
+                f"{difference['fixed']} images fixed and {difference['broken']} broken against the training transform"
+            )
 
-# Calculate accuracy
-accuracy = 100 * correct / total
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent = 2)
 
-# print(f'Accuracy of the model on the test images: {accuracy:.2f}%')
-print('Accuracy of the model on the test images: {:.2f}%'.format(accuracy))
+    # One line per variant, so speed and quality can be compared at a glance
+    print(f"\n{'model':>32} {'accuracy':>9} {'ECE':>6} {'images/s':>9} {'p50 ms':>7} {'p99 ms':>7}")
+    for spec, result in report['models'].items():
+        if 'error' in result:
+            continue
+        latency = result['throughput']['single_latency_ms']
+        print(f"{spec:>32} {result['accuracy']:>9.2%} {result['calibration']['ece']:>6.3f} {result['throughput']['images_per_sec']:>9.1f} {latency['p50']:>7.1f} {latency['p99']:>7.1f}")
+    print(f"Report written to {args.report}")
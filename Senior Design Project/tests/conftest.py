@@ -0,0 +1,5 @@
+# The modules live one folder up and import each other by bare name
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,130 @@
+# Imports
+import json
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+Image = pytest.importorskip('PIL.Image')
+import datasetShards
+from datasetShards import BatchAugment, ShardDataset, evalBatch, pack, stale
+
+def makeImages(root, counts):
+    for name, count in counts.items():
+        os.makedirs(os.path.join(root, name), exist_ok = True)
+        for i in range(count):
+            pixels = np.full((40, 60, 3), 40 * i + (100 if name == 'b' else 0), dtype = np.uint8)
+            Image.fromarray(pixels).save(os.path.join(root, name, f"{i}.png"))
+
+def test_pack_round_trip(tmp_path):
+    root, output = str(tmp_path / 'images'), str(tmp_path / 'shards')
+    makeImages(root, {'a': 3, 'b': 2})
+    index = pack(root, output, shardSize = 2, size = 32, workers = 1)
+    assert index['classes'] == ['a', 'b'] and len(index['shards']) == 3
+    assert not stale(root, output)
+    assert not os.path.exists(output + '.partial') and not os.path.exists(output + '.old')
+
+    dataset = ShardDataset(output)
+    images, labels = dataset[[0, 3, 4]]
+    assert images.shape == (3, 3, 32, 48) and images.dtype == torch.uint8 # The whole 40x60 frame, not a center square
+    assert dataset.sizes.tolist() == [[32, 48]] * 5
+    assert labels.tolist() == [0, 1, 1]
+    assert int(images[1, 0, 0, 0]) == 100 # b/0.png
+
+def test_interrupted_repack_keeps_previous_shards(tmp_path, monkeypatch):
+    root, output = str(tmp_path / 'images'), str(tmp_path / 'shards')
+    makeImages(root, {'a': 2, 'b': 2})
+    pack(root, output, size = 32, workers = 1)
+    before = open(os.path.join(output, 'index.json')).read()
+
+    makeImages(root, {'a': 4})
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(datasetShards.json, 'dump', crash)
+    with pytest.raises(KeyboardInterrupt):
+        pack(root, output, size = 32, workers = 1)
+
+    assert open(os.path.join(output, 'index.json')).read() == before
+    images, labels = ShardDataset(output, checkSource = False)[[0, 1, 2, 3]]
+    assert labels.tolist() == [0, 0, 1, 1]
+    assert images[:, 0, 0, 0].tolist() == [0, 40, 100, 140] # Still the pixels the index describes
+
+def test_stale_shards_warn(tmp_path, capsys):
+    root, output = str(tmp_path / 'images'), str(tmp_path / 'shards')
+    makeImages(root, {'a': 2, 'b': 1})
+    pack(root, output, size = 32, workers = 1)
+    ShardDataset(output)
+    assert 'WARNING' not in capsys.readouterr().out
+    makeImages(root, {'b': 2})
+    assert stale(root, output)
+    ShardDataset(output)
+    assert 'out of date' in capsys.readouterr().out
+
+def test_batch_augment_identity_theta():
+    augment = BatchAugment(degrees = 0, scale = (1.0, 1.0), ratio = (1.0, 1.0))
+    augment.theta(4) # Flips are random, so check the magnitudes
+    theta = augment.theta(64)
+    assert torch.allclose(theta[:, :, :2].abs(), torch.eye(2).expand(64, 2, 2))
+    assert torch.allclose(theta[:, :, 2], torch.zeros(64, 2))
+
+def test_batch_augment_crop_stays_inside():
+    generator = torch.Generator().manual_seed(0)
+    theta = BatchAugment(degrees = 0, generator = generator).theta(256)
+    corners = torch.tensor([[-1.0, -1.0, 1.0], [1.0, -1.0, 1.0], [-1.0, 1.0, 1.0], [1.0, 1.0, 1.0]])
+    mapped = torch.einsum('nij,kj->nki', theta, corners)
+    assert mapped.abs().max() <= 1.0 + 1e-5
+
+# Crops on a 4:3 frame reach its sides, not only the central square, and never leave the frame
+def test_batch_augment_covers_the_whole_frame():
+    augment = BatchAugment(degrees = 0, generator = torch.Generator().manual_seed(0))
+    sizes = torch.tensor([[256, 341]] * 512)
+    theta = augment.theta(512, sizes, (256, 400))
+    corners = torch.tensor([[-1.0, -1.0, 1.0], [1.0, -1.0, 1.0], [-1.0, 1.0, 1.0], [1.0, 1.0, 1.0]])
+    mapped = torch.einsum('nij,kj->nki', theta, corners)
+    right = 2 * 341 / 400 - 1
+    assert mapped[..., 0].min() >= -1 - 1e-5 and mapped[..., 0].max() <= right + 1e-5
+    assert mapped[..., 1].abs().max() <= 1 + 1e-5
+    assert mapped[..., 0].min() < -0.95 and mapped[..., 0].max() > right - 0.05
+
+# With square crops, rotation and resize are a similarity in pixel space whatever the frame's aspect
+def test_batch_augment_is_a_pixel_similarity():
+    augment = BatchAugment(scale = (0.08, 0.5), ratio = (1.0, 1.0), generator = torch.Generator().manual_seed(1)) # Crops that fit unclamped
+    theta = augment.theta(64, torch.tensor([[256, 341]] * 64), (256, 400))
+    linear = torch.diag(torch.tensor([400 / 2, 256 / 2])) @ theta[:, :, :2]
+    columns = linear.transpose(1, 2)
+    assert torch.allclose((columns[:, 0] * columns[:, 1]).sum(1), torch.zeros(64), atol = 1e-3)
+    assert torch.allclose(columns[:, 0].norm(dim = 1), columns[:, 1].norm(dim = 1), rtol = 1e-4)
+
+def test_batch_augment_output():
+    images = torch.randint(0, 256, (5, 3, 64, 64), dtype = torch.uint8)
+    out = BatchAugment(size = 48, generator = torch.Generator().manual_seed(0))(images, torch.tensor([[64, 48]] * 5))
+    assert out.shape == (5, 3, 48, 48) and out.dtype == torch.float32
+
+# Frames of every orientation and aspect, the last one longer than the canvas limit
+def test_eval_batch_matches_torchvision(tmp_path):
+    transforms = pytest.importorskip('torchvision.transforms')
+    root, output = str(tmp_path / 'images'), str(tmp_path / 'shards')
+    generator = np.random.default_rng(0)
+    shapes = [(480, 640), (640, 480), (300, 301), (257, 1100), (224, 224)]
+    os.makedirs(os.path.join(root, 'a'))
+    for i, shape in enumerate(shapes):
+        Image.fromarray(generator.integers(0, 256, shape + (3,), dtype = np.uint8)).save(os.path.join(root, 'a', f"{i}.png"))
+    pack(root, output, workers = 1)
+
+    dataset = ShardDataset(output, transform = evalBatch)
+    assert dataset.canvas == (341, 512)
+    images, _ = dataset[list(range(len(shapes)))]
+    reference = transforms.Compose([
+        transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+    ])
+    for i in range(len(shapes)):
+        expected = reference(Image.open(os.path.join(root, 'a', f"{i}.png")))
+        assert torch.allclose(images[i], expected, atol = 1e-5)
+
+def test_old_square_shards_are_refused(tmp_path):
+    output = tmp_path / 'shards'
+    output.mkdir()
+    (output / 'index.json').write_text(json.dumps({'root': str(tmp_path), 'size': 256, 'classes': [], 'shards': [], 'labels': []}))
+    with pytest.raises(SystemExit, match = 'repack'):
+        ShardDataset(str(output))
@@ -0,0 +1,53 @@
+# Imports
+from frameCache import ResultCache, hammingDistance
+
+def test_hamming_distance():
+    assert hammingDistance(0, 0) == 0
+    assert hammingDistance(0b1011, 0b0001) == 2
+    assert hammingDistance(0, (1 << 64) - 1) == 64
+
+def test_exact_hit_in_any_scope():
+    cache = ResultCache()
+    cache.put(('aa', 0), 'film', scope = 1)
+    assert cache.get(('aa', 0), scope = 2) == 'film'
+    assert cache.get(('aa', 0)) == 'film'
+    assert cache.hits == 2
+
+def test_near_hit_only_within_scope():
+    cache = ResultCache(maxDistance = 4)
+    cache.put(('aa', 0b1111), 'film', scope = 1)
+    assert cache.get(('bb', 0b0111), scope = 1) == 'film' # 1 bit away, same run
+    assert cache.get(('bb', 0b0111), scope = 2) is None # Same look, another run
+    assert cache.get(('bb', 0b0111)) is None # Unscoped lookups never match near
+    assert (cache.nearHits, cache.misses) == (1, 2)
+
+def test_near_hit_respects_distance_and_picks_closest():
+    cache = ResultCache(maxDistance = 2)
+    cache.put(('aa', 0b0000), 'far', scope = 1)
+    cache.put(('bb', 0b1110), 'close', scope = 1)
+    assert cache.get(('cc', 0b1111), scope = 1) == 'close'
+    assert cache.get(('dd', 0b11110000), scope = 1) is None
+
+def test_exact_only_mode():
+    cache = ResultCache(maxDistance = None)
+    cache.put(('aa', 0), 'film', scope = 1)
+    assert cache.get(('bb', 0), scope = 1) is None
+
+def test_lru_eviction():
+    cache = ResultCache(capacity = 2)
+    cache.put(('a', 1), 1)
+    cache.put(('b', 2), 2)
+    cache.get(('a', 1)) # a is now the most recent
+    cache.put(('c', 3), 3)
+    assert cache.get(('b', 2)) is None
+    assert cache.get(('a', 1)) == 1 and len(cache) == 2 and cache.evictions == 1
+
+# Neighbouring azimuths of one scan share the run but must each be classified
+def test_near_duplicate_azimuths_both_miss():
+    cache = ResultCache(maxDistance = 4)
+    assert cache.get(('az0', 0b1111), scope = (3, 0)) is None
+    cache.put(('az0', 0b1111), 'first azimuth', scope = (3, 0))
+    assert cache.get(('az1', 0b0111), scope = (3, 1)) is None
+    cache.put(('az1', 0b0111), 'second azimuth', scope = (3, 1))
+    assert cache.get(('retake', 0b0011), scope = (3, 1)) == 'second azimuth'
+    assert (cache.nearHits, cache.misses) == (1, 2)
@@ -0,0 +1,49 @@
+# Imports
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+Image = pytest.importorskip('PIL.Image')
+transforms = pytest.importorskip('torchvision.transforms')
+from framePipeline import Frame
+
+reference = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224)])
+
+def randomFrame(height, width, seed):
+    generator = np.random.default_rng(seed)
+    # Smooth gradients plus noise, so both rounding and filter edges are exercised
+    rows, columns = np.mgrid[0:height, 0:width]
+    base = (rows * 255 // max(height - 1, 1) + columns * 127 // max(width - 1, 1))[..., None] + np.array([0, 60, 120])
+    pixels = (base + generator.integers(-40, 41, (height, width, 3))) % 256
+    return pixels.astype(np.uint8)
+
+@pytest.mark.parametrize('height, width', [(480, 640), (256, 341), (300, 301), (1000, 257), (777, 1234), (224, 224), (256, 256), (257, 2000)])
+def test_cropped_matches_torchvision(height, width):
+    rgb = randomFrame(height, width, height * width)
+    expected = np.asarray(reference(Image.fromarray(rgb)))
+    cropped = Frame('synthetic', np.ascontiguousarray(rgb[..., ::-1])).cropped()
+    assert cropped.shape == (224, 224, 3)
+    assert np.array_equal(cropped[..., ::-1], expected)
+
+def test_tensor_matches_torchvision():
+    torch = pytest.importorskip('torch')
+    rgb = randomFrame(480, 640, 7)
+    tensorTransform = transforms.Compose([reference, transforms.ToTensor(), transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+    expected = tensorTransform(Image.fromarray(rgb)).numpy()
+    tensor = Frame('synthetic', np.ascontiguousarray(rgb[..., ::-1])).writeTensor()
+    assert np.abs(tensor - expected).max() < 1e-5
+
+# A camera JPEG tagged as rotated: torchvision's PIL path ignores the Orientation tag, so Frame must too
+def test_exif_orientation_is_ignored(tmp_path):
+    rgb = randomFrame(240, 320, 11)
+    exif = Image.Exif()
+    exif[0x0112] = 6 # Rotate 90 CW to display
+    path = str(tmp_path / 'rotated.jpg')
+    Image.fromarray(rgb).save(path, quality = 95, exif = exif)
+
+    with Image.open(path) as image:
+        assert image.getexif()[0x0112] == 6
+        expected = np.asarray(reference(image.convert('RGB')))
+    frame = Frame.load(path)
+    assert frame.pixels.shape[:2] == (240, 320)
+    assert np.array_equal(frame.cropped()[..., ::-1], expected)
@@ -0,0 +1,61 @@
+# Imports
+import asyncio
+import os
+import time
+import pytest
+from imageWatcher import ImageWatcher
+
+def writeFrame(folder, name):
+    path = os.path.join(folder, name)
+    with open(path + '.part', 'wb') as f:
+        f.write(b'frame')
+    os.replace(path + '.part', path)
+    return path
+
+def test_wait_sees_new_frames_and_deletions(tmp_path):
+    old = writeFrame(str(tmp_path), 'old.png')
+    watcher = ImageWatcher(str(tmp_path), settleTime = 0.05)
+    try:
+        assert watcher.newest() == old
+        new = writeFrame(str(tmp_path), 'new.png')
+        writeFrame(str(tmp_path), 'notes.txt')
+        assert watcher.wait(timeout = 2) == [new]
+        assert watcher.newest() == new
+
+        os.remove(new)
+        watcher.wait(timeout = 0.1)
+        assert watcher.newest() == old
+    finally:
+        watcher.close()
+
+def test_polling_fallback(tmp_path):
+    watcher = ImageWatcher(str(tmp_path), settleTime = 0.05, pollInterval = 0.02, usePolling = True)
+    assert watcher.inotify is None
+    new = writeFrame(str(tmp_path), 'a.jpg')
+    assert watcher.wait(timeout = 2) == [new]
+
+# A frame that lands while the consumer sits at yield (watchImages waiting for GREEN/RED)
+# must not keep the level-triggered reader firing
+def test_frames_idles_while_consumer_is_suspended(tmp_path):
+    watcher = ImageWatcher(str(tmp_path), settleTime = 0.05)
+    if watcher.inotify is None:
+        pytest.skip('inotify unavailable')
+
+    async def scenario():
+        frames = watcher.frames()
+        first = writeFrame(str(tmp_path), 'first.png')
+        assert await asyncio.wait_for(frames.__anext__(), 2) == first
+
+        second = writeFrame(str(tmp_path), 'second.png')
+        started = time.process_time()
+        await asyncio.sleep(1.0) # Consumer busy elsewhere, generator suspended at yield
+        busy = time.process_time() - started
+
+        assert await asyncio.wait_for(frames.__anext__(), 2) == second
+        await frames.aclose()
+        return busy
+
+    try:
+        assert asyncio.run(scenario()) < 0.3
+    finally:
+        watcher.close()
@@ -0,0 +1,12 @@
+# Imports
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+import inferenceBackends
+from inferenceBackends import threadCounts
+
+@pytest.mark.parametrize('cores, expected', [(1, [1]), (2, [1, 2]), (6, [1, 2, 4, 6]), (8, [1, 2, 4, 8]), (None, [1])])
+def test_thread_counts(monkeypatch, cores, expected):
+    monkeypatch.setattr(inferenceBackends.os, 'cpu_count', lambda: cores)
+    assert threadCounts() == expected
@@ -0,0 +1,57 @@
+# Imports
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from inferenceWorker import InferencePool, frameShape
+from modelLoader import loadModel, softmax
+
+# A random two-class ResNet50 saved the way trainML.py saves it
+@pytest.fixture(scope = 'module')
+def modelPath(tmp_path_factory):
+    from torchvision import models
+    torch.manual_seed(0)
+    model = models.resnet50(weights = None)
+    model.fc = torch.nn.Linear(model.fc.in_features, 2)
+    path = tmp_path_factory.mktemp('model') / 'model.pth'
+    torch.save(model.state_dict(), path)
+    return str(path)
+
+def randomFrames(count):
+    rng = np.random.default_rng(0)
+    return [rng.standard_normal(frameShape).astype(np.float32) for _ in range(count)]
+
+# Frames queued faster than one forward pass are batched, and each future still gets its own frame's answer
+def test_batched_results_match_in_order(modelPath):
+    frames = randomFrames(8)
+    probabilities = softmax(loadModel(modelPath, threads = 1)(np.stack(frames)))
+
+    pool = InferencePool(modelPath, workers = 1, threads = 1, maxBatch = 4, maxWaitMs = 50)
+    try:
+        assert pool.waitReady(timeout = 120)
+        predictions = [future.result(timeout = 60) for future in [pool.submit(frame) for frame in frames]]
+    finally:
+        pool.close()
+
+    for prediction, expected in zip(predictions, probabilities):
+        assert prediction.classIndex == int(expected.argmax())
+        assert prediction.confidence == pytest.approx(float(expected.max()), abs = 1e-4)
+    assert max(prediction.batchSize for prediction in predictions) > 1
+    assert all(prediction.batchSize <= 4 for prediction in predictions)
+
+# A worker that dies fails the frames waiting on it and refuses new ones instead of hanging
+def test_worker_death_fails_pending_futures(modelPath):
+    frame = randomFrames(1)[0]
+    pool = InferencePool(modelPath, workers = 1, threads = 1)
+    try:
+        assert pool.waitReady(timeout = 120)
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        future = pool.submit(frame)
+        with pytest.raises(RuntimeError):
+            future.result(timeout = 10)
+        with pytest.raises(RuntimeError):
+            pool.submit(frame)
+    finally:
+        pool.close()
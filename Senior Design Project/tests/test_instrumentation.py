@@ -0,0 +1,32 @@
+# Imports
+import math
+import random
+from instrumentation import LatencyHistogram, subBuckets
+
+def test_buckets_cover_every_value_within_one_sub_bucket():
+    generator = random.Random(3)
+    values = [generator.uniform(0, 20) for _ in range(500)] + [10 ** generator.uniform(1, 8) for _ in range(2000)]
+    for micros in values + [0, 15.999, 16, 31.999, 32, 1 << 20]:
+        bucket = LatencyHistogram.bucketOf(micros)
+        lower = LatencyHistogram.upperBound(bucket - 1) if bucket else 0
+        upper = LatencyHistogram.upperBound(bucket)
+        assert lower <= micros < upper
+        assert upper - lower <= max(1, upper / subBuckets)
+
+def test_buckets_are_ordered():
+    bounds = [LatencyHistogram.upperBound(bucket) for bucket in range(20 * subBuckets)]
+    assert bounds == sorted(set(bounds))
+
+def test_percentiles_follow_the_samples():
+    histogram = LatencyHistogram()
+    for millis in range(1, 1001):
+        histogram.record(millis / 1000)
+    summary = histogram.summary()
+    assert summary['count'] == 1000 and math.isclose(summary['mean'], 0.5005)
+    for percent, exact in [(50, 0.5), (90, 0.9), (99, 0.99)]:
+        assert exact <= histogram.percentile(percent) <= exact * (1 + 1 / subBuckets)
+    assert histogram.percentile(100) == 1.0 # Capped at the largest sample, not the bucket edge
+
+def test_empty_histogram():
+    summary = LatencyHistogram().summary()
+    assert summary['count'] == 0 and summary['p99'] == 0.0 and summary['min'] == 0.0
@@ -0,0 +1,55 @@
+# Imports
+import types
+import pytest
+
+pty = pytest.importorskip('pty')
+from picoSimulator import PicoSimulator
+
+# The firmware loaded on the virtual board but not started, with a hand-driven tick counter
+@pytest.fixture
+def firmware(tmp_path):
+    simulator = PicoSimulator(captureDir = str(tmp_path))
+    module = simulator.loadFirmware()
+    clock = simulator.clock
+    ticks = [1000]
+    module.time = types.SimpleNamespace(ticks_ms = lambda: ticks[0], ticks_diff = clock.ticks_diff)
+    module.buttonEvents.clear()
+    return module, ticks
+
+def events(module):
+    seen = []
+    while True:
+        event = module.buttonEvents.get()
+        if event == module.NO_EVENT:
+            return seen
+        seen.append(event)
+
+# Advance in FSM ticks, driving the pin at the given (tick, level) edges on the way
+def run(module, button, ticks, untilMs, edges = ()):
+    edges = sorted(edges)
+    while ticks[0] < untilMs:
+        ticks[0] += 1
+        while edges and edges[0][0] <= ticks[0]:
+            button.pin.drive(edges.pop(0)[1])
+        if ticks[0] % module.tickMs == 0:
+            button.check(ticks[0])
+
+def test_bouncing_press_still_reaches_long_press(firmware):
+    module, ticks = firmware
+    button = module.Button(20, module.START_PRESS, module.START_LONG)
+
+    # Pressed at 1101, the contact reads high again across the 1105 tick, then stays down
+    run(module, button, ticks, 2300, [(1101, 0), (1103, 1), (1107, 0), (1109, 1), (1111, 0)])
+    assert events(module) == [module.START_PRESS, module.START_LONG]
+    assert button.held
+
+def test_bouncing_release_is_one_release(firmware):
+    module, ticks = firmware
+    button = module.Button(20, module.STOP_PRESS, module.STOP_LONG)
+    run(module, button, ticks, 1300, [(1101, 0)])
+    run(module, button, ticks, 1500, [(1301, 1), (1304, 0), (1307, 1), (1310, 0), (1313, 1)])
+    assert not button.held
+    assert events(module) == [module.STOP_PRESS] # Short press, and the chatter raised no second press
+
+    run(module, button, ticks, 1600, [(1550, 0)])
+    assert events(module) == [module.STOP_PRESS]
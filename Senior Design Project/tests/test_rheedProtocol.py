@@ -0,0 +1,192 @@
+# Imports
+import random
+from rheedProtocol import (
+    MSG_ACK, MSG_HELLO, MSG_PROCEED, MSG_PULSE, MSG_READY, MSG_TELEMETRY, MSG_VERIFY,
+    FrameDecoder, Session, crc16, decodeTelemetry, encodeFrame, encodeTelemetry,
+)
+
+# Two sessions joined back to back, with a hand-driven millisecond clock and an optional drop filter
+class Link:
+    def __init__(self, retransmitMs = 100, maxRetries = 5):
+        self.now = 0
+        self.wires = {'a': [], 'b': []} # Bytes waiting to be read by each side
+        self.drop = lambda side, frame: False
+        self.a = Session(lambda data: self.put('b', data), lambda: self.now, lambda x, y: x - y, retransmitMs, maxRetries)
+        self.b = Session(lambda data: self.put('a', data), lambda: self.now, lambda x, y: x - y, retransmitMs, maxRetries)
+
+    def put(self, side, data):
+        if not self.drop(side, data):
+            self.wires[side].append(data)
+
+    # Deliver everything in flight until both wires are empty, returns the messages each side got
+    def pump(self):
+        got = {'a': [], 'b': []}
+        while self.wires['a'] or self.wires['b']:
+            for side, session in (('a', self.a), ('b', self.b)):
+                pending, self.wires[side] = self.wires[side], []
+                for data in pending:
+                    got[side].extend(session.receive(data))
+        return got
+
+def test_crc16_check_value():
+    assert crc16(b'123456789') == 0x29B1 # CRC-16/CCITT-FALSE
+
+def test_decoder_round_trip_and_resync():
+    decoder = FrameDecoder()
+    good = encodeFrame(MSG_VERIFY, 7, b'\x01\x02')
+    corrupt = bytearray(encodeFrame(MSG_READY, 8))
+    corrupt[-1] ^= 0xFF
+    assert decoder.feed(b'\x00\x13' + bytes(corrupt) + good) == [(MSG_VERIFY, 7, b'\x01\x02')]
+    assert decoder.crcErrors == 1
+
+def test_decoder_split_across_reads():
+    decoder = FrameDecoder()
+    frame = encodeFrame(MSG_PROCEED, 3, b'abc')
+    frames = []
+    for byte in frame:
+        frames.extend(decoder.feed(bytes((byte,))))
+    assert frames == [(MSG_PROCEED, 3, b'abc')]
+
+def test_telemetry_round_trip():
+    payload = encodeTelemetry(123456789, 4, 0x21, 90, 65535, 12, 345)
+    assert len(payload) == 13
+    assert decodeTelemetry(payload) == (123456789, 4, 0x21, 90, 65535, 12, 345)
+
+def test_reliable_message_is_acked():
+    link = Link()
+    link.a.send(MSG_VERIFY)
+    assert link.a.unacked
+    assert link.pump()['b'] == [(MSG_VERIFY, b'')]
+    assert not link.a.unacked
+
+def test_lost_frame_is_retransmitted_once_delivered():
+    link = Link()
+    dropped = []
+    link.drop = lambda side, data: side == 'b' and not dropped and not dropped.append(data)
+    link.a.send(MSG_READY)
+    assert link.pump()['b'] == []
+    link.now += 100
+    assert link.a.service() == []
+    assert link.pump()['b'] == [(MSG_READY, b'')]
+    assert link.a.retransmits == 1 and not link.a.unacked
+
+def test_lost_ack_duplicate_is_dropped():
+    link = Link()
+    link.drop = lambda side, data: side == 'a' and data[1] == MSG_ACK and link.now == 0
+    link.a.send(MSG_PROCEED)
+    assert link.pump()['b'] == [(MSG_PROCEED, b'')]
+    link.now += 100
+    link.a.service()
+    assert link.pump()['b'] == [] # Resent copy acked again but not delivered twice
+    assert not link.a.unacked
+
+def test_gives_up_after_max_retries():
+    link = Link(maxRetries = 2)
+    link.drop = lambda side, data: side == 'b'
+    link.a.send(MSG_VERIFY)
+    lost = []
+    for _ in range(4):
+        link.now += 100
+        lost.extend(link.a.service())
+    assert lost == [MSG_VERIFY]
+    assert link.a.dropped == 1 and link.a.retransmits == 2
+
+def test_unreliable_frames_do_not_move_reliable_seq():
+    link = Link()
+    link.a.send(MSG_VERIFY)
+    for _ in range(300):
+        link.a.send(MSG_TELEMETRY, bytes(13))
+    assert link.a.send(MSG_PROCEED) == 1
+
+# Any run of periodic frames between reliable ones must never alias a recently seen seq
+def test_reliable_survives_periodic_seq_wrap():
+    for count in list(range(245, 260)) + list(range(500, 515)):
+        link = Link()
+        for _ in range(5):
+            link.a.send(MSG_VERIFY)
+        link.pump()
+        for _ in range(count):
+            link.a.send(MSG_TELEMETRY, bytes(13))
+        link.a.send(MSG_PROCEED)
+        assert link.pump()['b'][-1] == (MSG_PROCEED, b''), count
+
+def test_reliable_seq_wraps_without_loss():
+    link = Link()
+    generator = random.Random(0)
+    sent = 0
+    received = []
+    for _ in range(2000):
+        if generator.random() < 0.3:
+            link.a.send(MSG_READY, bytes((sent & 0xFF,)))
+            sent += 1
+        else:
+            link.a.send(MSG_TELEMETRY, bytes(13))
+        received.extend(message for message in link.pump()['b'] if message[0] == MSG_READY)
+    assert sent > 256
+    assert [payload[0] for _, payload in received] == [i & 0xFF for i in range(sent)]
+
+def test_hello_resets_duplicate_window():
+    link = Link()
+    link.a.send(MSG_VERIFY)
+    link.pump()
+    restarted = Session(lambda data: link.put('b', data), lambda: link.now, lambda x, y: x - y)
+    link.a = restarted # Peer rebooted, its seq starts over at 0
+    link.a.send(MSG_HELLO)
+    link.a.send(MSG_VERIFY)
+    assert link.pump()['b'] == [(MSG_HELLO, b''), (MSG_VERIFY, b'')]
+
+# Firmware cadence: telemetry every 250 ms and a VERIFY -> READY -> PROCEED round every 5-20 s, for an hour
+def test_capture_cycle_under_steady_telemetry():
+    link = Link()
+    pico, host = link.a, link.b
+    generator = random.Random(1)
+    nextRound = 0
+    rounds = 0
+    for tick in range(4 * 3600):
+        link.now = tick * 250
+        pico.send(MSG_TELEMETRY, bytes(13))
+        if tick % 4 == 0:
+            host.send(MSG_PULSE) # Host heartbeat, also periodic
+        if tick == nextRound:
+            pico.send(MSG_VERIFY)
+            assert (MSG_VERIFY, b'') in link.pump()['b'], tick
+            host.send(MSG_READY)
+            assert (MSG_READY, b'') in link.pump()['a'], tick
+            pico.send(MSG_PROCEED)
+            assert (MSG_PROCEED, b'') in link.pump()['b'], tick
+            nextRound += generator.randint(20, 80)
+            rounds += 1
+        link.pump()
+    assert rounds > 200
+    assert not pico.unacked and not host.unacked
+
+# Host reconnects to a Pico that still has frames from the old connection waiting for acks
+def test_hello_drops_frames_of_the_previous_connection():
+    link = Link()
+    link.drop = lambda side, data: True # Link goes dead
+    link.a.send(MSG_READY)
+    link.b.send(MSG_VERIFY)
+    link.pump()
+    assert link.a.unacked and link.b.unacked
+
+    link.drop = lambda side, data: False
+    link.a.send(MSG_HELLO, b'\x12\x34')
+    assert [entry[3] for entry in link.a.unacked.values()] == [MSG_HELLO] # Host: stale READY not resent
+    assert link.pump()['b'] == [(MSG_HELLO, b'\x12\x34')]
+    assert not link.b.unacked # Pico: stale VERIFY not resent after HELLO
+    link.now += 1000
+    assert link.a.service() == [] and link.b.service() == []
+    assert link.pump() == {'a': [], 'b': []}
+
+# The HELLO's ack is lost, so the host resends it after the Pico already answered and sent more
+def test_retransmitted_hello_is_not_a_new_connection():
+    link = Link()
+    link.drop = lambda side, data: side == 'a' and data[1] == MSG_ACK and link.now == 0
+    link.a.send(MSG_HELLO, b'\x56\x78')
+    assert link.pump()['b'] == [(MSG_HELLO, b'\x56\x78')]
+    link.drop = lambda side, data: side == 'a' # Pico's frames not through yet
+    link.b.send(MSG_VERIFY)
+    link.now += 100
+    link.a.service()
+    assert link.pump()['b'] == [] # Acked, not delivered again
+    assert [entry[3] for entry in link.b.unacked.values()] == [MSG_VERIFY]
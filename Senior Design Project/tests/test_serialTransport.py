@@ -0,0 +1,108 @@
+# Imports
+import asyncio
+import os
+import time
+import pytest
+
+pty = pytest.importorskip('pty')
+serial = pytest.importorskip('serial')
+from rheedProtocol import MSG_PROCEED, MSG_VERIFY, FrameDecoder, Session
+from serialTransport import SerialLink
+
+# The Pico end of a pseudo-terminal: a Session on the master fd, fed from the event loop
+class FakePico:
+    def __init__(self):
+        self.master, slave = pty.openpty()
+        self.portName = os.ttyname(slave)
+        self.slave = slave
+        self.session = Session(lambda data: os.write(self.master, data), lambda: int(time.monotonic() * 1000), lambda a, b: a - b)
+        self.received = []
+        self.raw = FrameDecoder() # Every frame on the wire, retransmits included
+        self.frames = []
+        self.ignore = 0 # Reads to throw away, as if the bytes were lost on the wire
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.master, self.onReadable)
+
+    def onReadable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return
+        if self.ignore:
+            self.ignore -= 1
+            return
+        self.frames.extend(msgType for msgType, _, _ in self.raw.feed(data))
+        self.received.extend(self.session.receive(data))
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+async def waitFor(condition, timeout = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def openLink(pico):
+    return SerialLink(serial.Serial(pico.portName, 115200, timeout = 0))
+
+def test_round_trip_with_acks():
+    async def scenario():
+        pico = FakePico()
+        pico.start()
+        link = openLink(pico)
+        link.start()
+        await link.send(MSG_VERIFY, b'\x01')
+        await waitFor(lambda: pico.received)
+        assert pico.received == [(MSG_VERIFY, b'\x01')]
+        await waitFor(lambda: not link.session.unacked) # Pico's ACK came back through the reader
+
+        pico.session.send(MSG_PROCEED, b'go')
+        msgType, payload, arrival = await link.readMessage(timeout = 2)
+        assert (msgType, payload) == (MSG_PROCEED, b'go') and arrival <= time.perf_counter()
+        await waitFor(lambda: not pico.session.unacked)
+        link.close()
+        pico.close()
+
+    asyncio.run(scenario())
+
+def test_lost_frame_is_retransmitted():
+    async def scenario():
+        pico = FakePico()
+        pico.start()
+        pico.ignore = 1
+        link = openLink(pico)
+        link.start()
+        await link.send(MSG_VERIFY)
+        await waitFor(lambda: pico.received, timeout = 3)
+        assert pico.received == [(MSG_VERIFY, b'')] and link.session.retransmits >= 1
+        await waitFor(lambda: not link.session.unacked)
+        await asyncio.sleep(0.3)
+        assert pico.frames.count(MSG_VERIFY) == 1 # Acked, so the retransmit timer stopped
+        link.close()
+        pico.close()
+
+    asyncio.run(scenario())
+
+# Unplugging the Pico closes the link: waiting readers and later sends raise ConnectionError
+def test_disconnect_closes_the_link():
+    async def scenario():
+        pico = FakePico()
+        link = openLink(pico)
+        link.start()
+        reader = asyncio.create_task(link.readMessage())
+        await asyncio.sleep(0.05)
+        os.close(pico.master)
+        os.close(pico.slave)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(reader, 2)
+        assert link.closed
+        with pytest.raises(ConnectionError):
+            await link.readMessage(timeout = 1)
+        with pytest.raises(ConnectionError):
+            await link.send(MSG_VERIFY)
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+# Imports
+import pytest
+
+torch = pytest.importorskip('torch')
+from torch.utils.data import DataLoader, Dataset
+from trainingEngine import EpochSampler, Trainer
+
+def test_sampler_is_reproducible_and_skips_a_prefix():
+    sampler = EpochSampler(10, repeats = 3, seed = 5)
+    sampler.setEpoch(2)
+    full = list(sampler)
+    assert sorted(full) == sorted(list(range(10)) * 3)
+    assert list(sampler) == full
+
+    sampler.setEpoch(2, skip = 7)
+    assert len(sampler) == 23 and list(sampler) == full[7:]
+    sampler.setEpoch(3)
+    assert list(sampler) != full
+
+# Remembers which samples were fetched, in order
+class Numbers(Dataset):
+    def __init__(self, length):
+        self.seen = []
+        self.inputs = torch.randn(length, 3, generator = torch.Generator().manual_seed(0))
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        self.seen.append(index)
+        return self.inputs[index], index % 2
+
+# Fails on the given call, as if the run had been killed
+class Crash:
+    def __init__(self, at):
+        self.calls = 0
+        self.at = at
+
+    def __call__(self, outputs, labels):
+        self.calls += 1
+        if self.calls == self.at:
+            raise KeyboardInterrupt
+        return torch.nn.functional.cross_entropy(outputs, labels)
+
+def makeTrainer(path, criterion, checkpointEvery = 0):
+    torch.manual_seed(1)
+    model = torch.nn.Linear(3, 2)
+    dataset = Numbers(24)
+    sampler = EpochSampler(len(dataset), seed = 9)
+    loader = DataLoader(dataset, batch_size = 4, sampler = sampler)
+    optimizer = torch.optim.SGD(model.parameters(), lr = 0.1, momentum = 0.9)
+    return Trainer(model, optimizer, criterion, loader, sampler, 4, torch.device('cpu'), checkpointPath = path, checkpointEvery = checkpointEvery), dataset
+
+def test_resume_continues_where_the_checkpoint_stopped(tmp_path):
+    reference, referenceData = makeTrainer(None, Crash(at = 0))
+    reference.fit(2)
+
+    path = str(tmp_path / 'checkpoint.pth')
+    interrupted, _ = makeTrainer(path, Crash(at = 6 + 4), checkpointEvery = 1) # Dies on the 4th batch of epoch 2
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.fit(2)
+
+    resumed, resumedData = makeTrainer(path, Crash(at = 0))
+    assert resumed.resume() and (resumed.epoch, resumed.batch) == (1, 3)
+    resumed.fit(2)
+    assert resumedData.seen == referenceData.seen[24 + 12:]
+    assert resumed.step == reference.step
+    for mine, theirs in zip(resumed.model.parameters(), reference.model.parameters()):
+        assert torch.equal(mine, theirs)
@@ -1,18 +1,21 @@
-import matplotlib.pyplot as plt
+import argparse
+import hashlib
 import numpy as np
 import os
 from PIL import Image
-import tensorflow as tf
-from keras import layers, models
+import time
 import torch
 from torchvision import datasets, transforms, models
 from torch.utils.data import DataLoader, Dataset
 import torch.nn as nn
 import torch.optim as optim
+from datasetShards import BatchAugment, ShardDataset, shardLoader
+from trainingEngine import EpochSampler, Trainer, loaderOptions
 
 # Paths
 data_dir = "/rheed_images/films/"
 output_model_path = "rheed_model.pth"
+feature_cache_dir = "feature_cache" # Backbone embeddings for --mode head
 
 # Resize dataset
 train_transform = transforms.Compose([
@@ -25,45 +28,241 @@ train_transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
-# Dataset and DataLoader
-train_dataset = datasets.ImageFolder(data_dir, transform = train_transform)
-augmented_dataset = torch.utils.data.ConcatDataset([train_dataset, train_dataset, train_dataset, train_dataset])
-train_loader = torch.utils.data.DataLoader(augmented_dataset, batch_size=4, shuffle=True)
-
-# Confirm dataset
-print("Classes in the dataset: {}".format(train_dataset.classes))
-print("Number of samples: {}".format(len(train_dataset)))
-
-# Model setup
-model = models.resnet50(pretrained = True)
-model.fc = nn.Linear(model.fc.in_features, 2)
-
-# Use CPU for training
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model.to(device)
-
-# Loss and Optimizer
-criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr = 0.001)
-
-# Train the model
-epochs = 10
-for epoch in range(epochs):
-    model.train()
-    running_loss = 0.0
-    for inputs, labels in train_loader:
-        # Move data to CPU (no CUDA here)
-        inputs, labels = inputs.to(device), labels.to(device)
-        
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.item()
-    
-    print("Epoch {}/{}. Loss: {:.4f}".format(epoch+1, epochs, running_loss/len(train_loader)))
-
-# Save the model
-torch.save(model.state_dict(), output_model_path)
-print("Training complete. Model saved.")
\ No newline at end of file
+# View 0 in head mode: the same crop the station classifies
+eval_transform = transforms.Compose([
+    transforms.Resize(256),
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+# Fine-tune the whole network (slow, needed when the backbone itself should change)
+def fullTrain(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # Dataset and DataLoader (packed shards skip the per-sample decode, augmentation runs per batch)
+    # Four shuffled passes per epoch, as with the old 4x ConcatDataset
+    options = loaderOptions(args.workers, args.prefetch, device)
+    if args.shards:
+        train_dataset = ShardDataset(args.shards, transform = BatchAugment())
+        sampler = EpochSampler(len(train_dataset), repeats = 4, seed = args.seed)
+        train_loader = shardLoader(train_dataset, args.batch_size, sampler = sampler, **options)
+    else:
+        train_dataset = datasets.ImageFolder(args.data, transform = train_transform)
+        sampler = EpochSampler(len(train_dataset), repeats = 4, seed = args.seed)
+        train_loader = DataLoader(train_dataset, batch_size = args.batch_size, sampler = sampler, **options)
+
+    # Confirm dataset
+    print("Classes in the dataset: {}".format(train_dataset.classes))
+    print("Number of samples: {}".format(len(train_dataset)))
+    print(f"Batch {args.batch_size} x {args.accumulate} accumulated, {args.precision}, {args.workers} loader workers")
+
+    # Model setup
+    model = models.resnet50(pretrained = True)
+    model.fc = nn.Linear(model.fc.in_features, 2)
+    model.to(device)
+
+    # Loss and Optimizer
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr = args.lr)
+
+    trainer = Trainer(
+        model, optimizer, criterion, train_loader, sampler, args.batch_size, device,
+        precision = args.precision, accumulate = args.accumulate,
+        checkpointPath = args.checkpoint or args.output + '.ckpt', checkpointEvery = args.checkpoint_every, logEvery = args.log_every,
+    )
+    if args.resume and not trainer.resume():
+        print("No checkpoint found, starting from the pretrained weights.")
+    return trainer.fit(args.epochs)
+
+# Content hash, so renamed or re-copied images keep their cached embeddings
+def fileHash(path):
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Hash of the frozen backbone weights (fc excluded, so retraining the head keeps the cache valid)
+def modelHash(model):
+    digest = hashlib.blake2b(digest_size = 16)
+    for name, tensor in model.state_dict().items():
+        if name.startswith('fc.'):
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+# ImageNet weights, or the backbone of an earlier trained model
+def loadBackbone(source):
+    if source == 'imagenet':
+        model = models.resnet50(pretrained = True)
+    else:
+        model = models.resnet50(pretrained = False)
+        model.fc = nn.Linear(model.fc.in_features, 2)
+        model.load_state_dict(torch.load(source, map_location = 'cpu'))
+    model.fc = nn.Identity()
+    model.eval()
+    return model
+
+# View 0 is the center crop, later views are train_transform seeded by file and view, so a view never changes
+def viewTensor(image, key, view):
+    if view == 0:
+        return eval_transform(image)
+    with torch.random.fork_rng(devices = []):
+        torch.manual_seed(int(key[:15], 16) + view)
+        return train_transform(image)
+
+# One float16 (views, 2048) array per image under a folder named after the backbone hash
+class FeatureCache:
+    def __init__(self, root, backboneKey):
+        self.folder = os.path.join(root, backboneKey)
+        os.makedirs(self.folder, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npy')
+
+    def load(self, key):
+        try:
+            return np.load(self.path(key))
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, features):
+        temporary = self.path(key) + '.tmp.npy'
+        np.save(temporary, features)
+        os.replace(temporary, self.path(key))
+
+# Embeds only the views the cache does not have yet; returns (features, labels) with one row per view
+def embedDataset(backbone, samples, cache, views, batchSize, loader):
+    stored = {}
+    changed = set()
+    pending = [] # (key, view, tensor)
+    computed = 0
+
+    def flush():
+        nonlocal computed
+        with torch.inference_mode():
+            features = backbone(torch.stack([tensor for _, _, tensor in pending])).numpy().astype(np.float16)
+        for (key, view, _), row in zip(pending, features):
+            stored[key][view] = row
+        computed += len(pending)
+        pending.clear()
+
+    keys = []
+    for path, _ in samples:
+        key = fileHash(path)
+        keys.append(key)
+        if key in stored:
+            continue
+        cached = cache.load(key)
+        have = 0 if cached is None else min(len(cached), views)
+        stored[key] = [cached[view] for view in range(have)] + [None] * (views - have)
+        if have == views:
+            continue
+        image = loader(path)
+        changed.add(key)
+        for view in range(have, views):
+            pending.append((key, view, viewTensor(image, key, view)))
+            if len(pending) >= batchSize:
+                flush()
+    if pending:
+        flush()
+
+    for key in changed:
+        cache.save(key, np.stack(stored[key]))
+    print(f"Embedded {computed} new views, reused {len(samples) * views - computed} from {cache.folder}")
+
+    features = np.stack([np.stack(stored[key]) for key in keys]).reshape(len(keys) * views, -1)
+    labels = np.repeat([label for _, label in samples], views)
+    return torch.from_numpy(features.astype(np.float32)), torch.from_numpy(labels)
+
+# Logistic-regression style fit of the fc layer on cached features, seconds on a CPU
+def trainHead(features, labels, epochs, lr, batchSize):
+    head = nn.Linear(features.shape[1], 2)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(head.parameters(), lr = lr, weight_decay = 1e-4)
+    generator = torch.Generator().manual_seed(0)
+
+    for epoch in range(epochs):
+        order = torch.randperm(len(features), generator = generator)
+        running_loss = 0.0
+        for start in range(0, len(order), batchSize):
+            batch = order[start:start + batchSize]
+            optimizer.zero_grad()
+            loss = criterion(head(features[batch]), labels[batch])
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * len(batch)
+        if (epoch + 1) % max(1, epochs // 10) == 0:
+            print("Epoch {}/{}. Loss: {:.4f}".format(epoch+1, epochs, running_loss/len(order)))
+
+    with torch.no_grad():
+        accuracy = (head(features).argmax(1) == labels).float().mean().item()
+    print(f"Training accuracy over all views: {accuracy:.2%}")
+    return head
+
+# Retrain only the classifier head on a frozen backbone, re-embedding only new or changed images
+def headTrain(args):
+    source = args.backbone or (args.output if os.path.exists(args.output) else 'imagenet')
+    backbone = loadBackbone(source)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    backboneKey = modelHash(backbone)
+    cache = FeatureCache(args.cache_dir, backboneKey)
+
+    dataset = datasets.ImageFolder(args.data)
+    print("Classes in the dataset: {}".format(dataset.classes))
+    print("Number of samples: {}".format(len(dataset)))
+    print(f"Backbone {source} ({backboneKey}), {args.views} view(s) per image")
+
+    start = time.perf_counter()
+    features, labels = embedDataset(backbone, dataset.samples, cache, args.views, args.batch_size, dataset.loader)
+    print(f"Features ready in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    head = trainHead(features, labels, args.head_epochs, args.lr, args.head_batch_size)
+    print(f"Head trained in {time.perf_counter() - start:.1f} s")
+
+    # Same layout as a fully fine-tuned model, so every loader keeps working
+    backbone.fc = head
+    return backbone
+
+def main():
+    parser = argparse.ArgumentParser(description = "Train the RHEED film classifier")
+    parser.add_argument('--mode', choices = ['full', 'head'], default = 'full', help = "head: frozen backbone, cached features, fc only")
+    parser.add_argument('--data', default = data_dir)
+    parser.add_argument('--output', default = output_model_path)
+    parser.add_argument('--epochs', type = int, default = 10)
+    parser.add_argument('--shards', default = None, help = "full mode: folder packed by datasetShards.py instead of --data (whole Resize(256) frames, sides past 2:1 center-cropped)")
+    parser.add_argument('--workers', type = int, default = min(4, os.cpu_count() or 1), help = "full mode: DataLoader worker processes")
+    parser.add_argument('--prefetch', type = int, default = 4, help = "full mode: batches each worker keeps ready")
+    parser.add_argument('--precision', choices = ['fp32', 'bf16'], default = 'fp32', help = "full mode: bf16 runs forward/backward under autocast")
+    parser.add_argument('--accumulate', type = int, default = 1, help = "full mode: micro-batches per optimizer step")
+    parser.add_argument('--checkpoint', default = None, help = "full mode: checkpoint file (default <output>.ckpt)")
+    parser.add_argument('--checkpoint-every', type = int, default = 0, help = "full mode: optimizer steps between mid-epoch checkpoints")
+    parser.add_argument('--resume', action = 'store_true', help = "full mode: continue from the checkpoint")
+    parser.add_argument('--log-every', type = int, default = 0, help = "full mode: optimizer steps between progress lines")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--backbone', default = None, help = "head mode: .pth to take the backbone from or 'imagenet' (default: --output if it exists)")
+    parser.add_argument('--views', type = int, default = 4, help = "head mode: center crop plus augmented views per image")
+    parser.add_argument('--cache-dir', default = feature_cache_dir)
+    parser.add_argument('--batch-size', type = int, default = None, help = "Micro-batch size (default 4 in full mode, 32 in head mode)")
+    parser.add_argument('--head-epochs', type = int, default = 100)
+    parser.add_argument('--head-batch-size', type = int, default = 256)
+    parser.add_argument('--lr', type = float, default = 0.001)
+    parser.add_argument('--threads', type = int, default = None)
+    args = parser.parse_args()
+    if args.batch_size is None:
+        args.batch_size = 32 if args.mode == 'head' else 4
+
+    model = headTrain(args) if args.mode == 'head' else fullTrain(args)
+
+    # Save the model
+    torch.save(model.state_dict(), args.output)
+    print("Training complete. Model saved.")
+
+if __name__ == "__main__":
+    main()
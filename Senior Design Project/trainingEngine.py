@@ -0,0 +1,152 @@
+# Imports
+import os
+import time
+import torch
+from torch.utils.data import Sampler
+
+# Shuffled order for one epoch over `repeats` passes of the data (the old 4x ConcatDataset),
+# reproducible from (seed, epoch) so a resumed run can skip exactly the samples already seen
+class EpochSampler(Sampler):
+    def __init__(self, length, repeats = 1, seed = 0):
+        self.length = length
+        self.repeats = repeats
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+
+    # Read in the main process on every new iteration, so persistent workers see the change too
+    def setEpoch(self, epoch, skip = 0):
+        self.epoch = epoch
+        self.skip = skip
+
+    def __len__(self):
+        return self.length * self.repeats - self.skip
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.length * self.repeats, generator = generator) % self.length
+        return iter(order[self.skip:].tolist())
+
+def loaderOptions(workers, prefetch = 4, device = None):
+    options = {'num_workers': workers, 'pin_memory': device is not None and device.type == 'cuda'}
+    if workers > 0:
+        options['persistent_workers'] = True # Workers (and their mmaps) live across epochs
+        options['prefetch_factor'] = prefetch
+    return options
+
+# Written next to the target and renamed, so a crash mid-save keeps the previous checkpoint
+def saveAtomic(state, path):
+    temporary = path + '.tmp'
+    torch.save(state, temporary)
+    os.replace(temporary, path)
+
+# Epoch loop with bf16 autocast, gradient accumulation, periodic checkpoints and throughput logging
+# loader yields (inputs, labels) micro-batches of batchSize samples; sampler is its EpochSampler
+class Trainer:
+    def __init__(self, model, optimizer, criterion, loader, sampler, batchSize, device,
+                 precision = 'fp32', accumulate = 1, checkpointPath = None, checkpointEvery = 0, logEvery = 0):
+        self.model = model
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.loader = loader
+        self.sampler = sampler
+        self.batchSize = batchSize
+        self.device = device
+        self.precision = precision
+        self.accumulate = accumulate
+        self.checkpointPath = checkpointPath
+        self.checkpointEvery = checkpointEvery # Optimizer steps between mid-epoch checkpoints, 0 = end of epoch only
+        self.logEvery = logEvery
+        self.epoch = 0
+        self.batch = 0 # Micro-batches finished in the current epoch
+        self.step = 0 # Optimizer steps overall
+
+    def checkpoint(self):
+        if not self.checkpointPath:
+            return
+        started = time.perf_counter()
+        saveAtomic({
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'epoch': self.epoch,
+            'batch': self.batch,
+            'step': self.step,
+            'batchSize': self.batchSize,
+            'rng': torch.get_rng_state(),
+        }, self.checkpointPath)
+        print(f"Checkpoint saved to {self.checkpointPath} (resumes at epoch {self.epoch + 1}, batch {self.batch}) in {time.perf_counter() - started:.1f} s")
+
+    def resume(self):
+        if not self.checkpointPath or not os.path.exists(self.checkpointPath):
+            return False
+        state = torch.load(self.checkpointPath, map_location = 'cpu')
+        if state['batchSize'] != self.batchSize:
+            raise SystemExit(f"{self.checkpointPath} was written with batch size {state['batchSize']}, resume with the same --batch-size")
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.epoch, self.batch, self.step = state['epoch'], state['batch'], state['step']
+        torch.set_rng_state(state['rng'])
+        print(f"Resuming at epoch {self.epoch + 1}, batch {self.batch} ({self.step} optimizer steps done)")
+        return True
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype = torch.bfloat16, enabled = self.precision == 'bf16')
+
+    def runEpoch(self, epochs):
+        self.model.train()
+        self.sampler.setEpoch(self.epoch, self.batch * self.batchSize)
+        self.optimizer.zero_grad(set_to_none = True)
+        samples = 0
+        running_loss = 0.0
+        dataWait = 0.0
+        compute = 0.0
+        pending = 0 # Micro-batches accumulated since the last optimizer step
+        started = time.perf_counter()
+        fetchStart = started
+
+        for inputs, labels in self.loader:
+            computeStart = time.perf_counter()
+            dataWait += computeStart - fetchStart
+            inputs, labels = inputs.to(self.device, non_blocking = True), labels.to(self.device, non_blocking = True)
+
+            with self.autocast():
+                loss = self.criterion(self.model(inputs), labels)
+            (loss / self.accumulate).backward()
+            pending += 1
+            self.batch += 1
+            samples += len(labels)
+            running_loss += loss.item() * len(labels)
+
+            if pending == self.accumulate:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none = True)
+                pending = 0
+                self.step += 1
+                if self.checkpointEvery and self.step % self.checkpointEvery == 0:
+                    self.checkpoint()
+                if self.logEvery and self.step % self.logEvery == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"  step {self.step}: loss {running_loss / samples:.4f}, {samples / elapsed:.1f} samples/s")
+
+            fetchStart = time.perf_counter()
+            compute += fetchStart - computeStart
+
+        if pending: # Leftover micro-batches at the end of the epoch still count
+            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none = True)
+            self.step += 1
+
+        elapsed = time.perf_counter() - started
+        print("Epoch {}/{}. Loss: {:.4f}".format(self.epoch + 1, epochs, running_loss / max(samples, 1)))
+        print(
+            f"  {samples} samples in {elapsed:.1f} s ({samples / max(elapsed, 1e-9):.1f} samples/s), "
+            f"data wait {dataWait:.1f} s ({dataWait / max(elapsed, 1e-9):.0%}), compute {compute:.1f} s"
+        )
+
+    def fit(self, epochs):
+        while self.epoch < epochs:
+            self.runEpoch(epochs)
+            self.epoch += 1
+            self.batch = 0
+            self.checkpoint()
+        return self.model